@@ -2,12 +2,40 @@ from __future__ import (absolute_import, division, print_function)
 
 __metaclass__ = type
 
+from ansible.module_utils.six.moves import shlex_quote
 from ansible.plugins.action import ActionBase
-from ansible.utils.unsafe_proxy import AnsibleUnsafeText
-from os.path import isdir, isfile, abspath, basename as p_bn, join as p_jp
-from glob import glob
+from ansible.module_utils._text import to_bytes
+from os.path import isdir, isfile, abspath, expanduser, dirname as p_dn, basename as p_bn, join as p_jp
+from base64 import b64decode
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
+from os import fdopen, getpid, listdir, makedirs, rename, stat, unlink
+from tarfile import open as tar_open
+from tempfile import mkstemp
+from time import sleep, strftime, time
+from uuid import uuid4
 from math import trunc as m_trunc
-from re import findall
+from re import compile as re_compile
+import json
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+try:
+    from ansible.module_utils.srvrmgr_mask import SecretMasker
+except ImportError:
+    # module_utils of this repository are not in ansible.module_utils namespace on the controller
+    import ansible.module_utils
+    ansible.module_utils.__path__.append(p_jp(p_dn(p_dn(abspath(__file__))), 'module_utils'))
+    from ansible.module_utils.srvrmgr_mask import SecretMasker
+from ansible.module_utils.srvrmgr_checkpoint import CHECKPOINT_SUBDIR, file_digest, is_session_cmd, parse_checkpoint, \
+    stack_key
 
 try:
     from __main__ import display
@@ -16,76 +44,380 @@ except ImportError:
     display = Display()
 
 
+FILTER_CACHE = '~/.ansible/srvrmgr/filter_cache.json'
+FILTER_CACHE_SIZE = 100000
+FILTER_WORKERS = 16
+FILTER_CHUNK = 1024 * 1024
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+SESSION_DIR = '~/.ansible/srvrmgr'
+# scripts not used for this number of days are removed from script_cache, the cleanup runs once a day
+SCRIPT_CACHE_DAYS = 30
+# prints cached blobs of the arguments which match their sha1 (when sha1sum exists), touching them for the cleanup
+SCRIPT_CACHE_CMD = ('cd {0} 2>/dev/null || exit 0; '
+                    'for b in {1}; do [ -f "$b" ] || continue; '
+                    'if command -v sha1sum >/dev/null 2>&1 && [ "$(sha1sum < "$b" | cut -c1-40)" != "${{b%%/*}}" ]; '
+                    'then rm -f "$b"; continue; fi; touch "$b"; echo "$b"; done; '
+                    'if [ -z "$(find .cleanup -mtime -1 2>/dev/null)" ]; then touch .cleanup; '
+                    'find . -mindepth 2 -maxdepth 2 -type f -mtime +{2} -exec rm -f {{}} +; '
+                    'find . -mindepth 1 -maxdepth 1 -type d -empty -exec rmdir {{}} +; fi')
+PROGRESS_DIR = '~/.ansible/srvrmgr/progress'
+
+
+def path_kind(el_v, entry=None):
+    if entry is not None:
+        return 'dir' if entry.is_dir() else 'file' if entry.is_file() else 'cmd'
+    return 'dir' if isdir(el_v) else 'file' if isfile(el_v) else 'cmd'
+
+
+def list_scripts(dir_path):
+    """Returns sorted (path, kind) of "*.cmd" entries of directory, hidden entries are skipped like by glob."""
+    if scandir is None:
+        return [(p_jp(dir_path, n), path_kind(p_jp(dir_path, n)))
+                for n in sorted(listdir(dir_path)) if n.endswith('.cmd') and not n.startswith('.')]
+    return sorted((p_jp(dir_path, e.name), path_kind(None, e))
+                  for e in scandir(dir_path) if e.name.endswith('.cmd') and not e.name.startswith('.'))
+
+
+def collect_scripts(entries, listings):
+    """Walks directories of entries once, fills listings {directory: entries} and returns all found scripts."""
+    scripts = []
+    pending = list(entries)
+    while pending:
+        el_v, kind = pending.pop()
+        if kind == 'dir' and el_v not in listings:
+            listings[el_v] = list_scripts(el_v)
+            pending.extend(listings[el_v])
+        elif kind == 'file':
+            scripts.append(el_v)
+    return scripts
+
+
+def load_filter_cache():
+    try:
+        with open(expanduser(FILTER_CACHE)) as cache_f:
+            return json.load(cache_f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_filter_cache(cache, used_keys):
+    if len(cache) > FILTER_CACHE_SIZE:
+        cache = dict((k, cache[k]) for k in used_keys if k in cache)
+    cache_path = expanduser(FILTER_CACHE)
+    try:
+        if not isdir(p_dn(cache_path)):
+            makedirs(p_dn(cache_path))
+        tmp_path = '{0}.{1}'.format(cache_path, getpid())
+        with open(tmp_path, 'w') as cache_f:
+            json.dump(cache, cache_f)
+        rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        display.vvv('Unable to save filter cache: {0}'.format(e))
+
+
+def search_script(scr_path, regex, overlap):
+    """
+    Searches filter in the script read by chunks (read releases the GIL, so reads of the pool threads overlap),
+    stops on the first match. Chunks overlap by overlap bytes, a regex filter (overlap None) is searched in
+    the whole file since its match length is not known.
+    """
+    try:
+        with open(scr_path, 'rb') as scr_f:
+            if overlap is None:
+                return regex.search(scr_f.read()) is not None
+            data = scr_f.read(FILTER_CHUNK)
+            while regex.search(data) is None:
+                chunk = scr_f.read(FILTER_CHUNK)
+                if not chunk:
+                    return False
+                data = data[len(data) - overlap:] + chunk
+            return True
+    except (IOError, OSError) as e:
+        return e
+
+
+def check_filter(scripts, filter_str):
+    """
+    Checks scripts by filter on thread pool. Results are cached by (path, mtime, size, filter) across runs.
+    Returns {script: True, False or IOError}.
+    """
+    regex = re_compile(to_bytes(filter_str))
+    # a literal filter can not match across chunks overlapping by its length - 1
+    overlap = None if REGEX_CHARS & set(filter_str) else max(len(to_bytes(filter_str)) - 1, 0)
+    cache = load_filter_cache()
+    result, pending, used_keys = {}, [], []
+    for scr in set(scripts):
+        try:
+            st = stat(scr)
+        except OSError as e:
+            result[scr] = e
+            continue
+        key = '\0'.join([abspath(scr), repr(st.st_mtime), str(st.st_size), filter_str])
+        used_keys.append(key)
+        if key in cache:
+            result[scr] = cache[key]
+        else:
+            pending.append((scr, key))
+
+    display.vvv('Filter cache: {0} hits, {1} misses'.format(len(used_keys) - len(pending), len(pending)))
+    if pending:
+        pool = ThreadPool(min(FILTER_WORKERS, len(pending)))
+        try:
+            checked = pool.map(lambda p: search_script(p[0], regex, overlap), pending)
+        finally:
+            pool.close()
+            pool.join()
+        for (scr, key), res in zip(pending, checked):
+            result[scr] = res
+            if not isinstance(res, Exception):
+                cache[key] = res
+        save_filter_cache(cache, used_keys)
+    return result
+
+
 def parse_data(in_data, sec_data={}, indent_multiplier=1, filter_str=None):
+    entries = [(el_v, path_kind(el_v)) for el_v in in_data]
+    listings = {}
+    scripts = collect_scripts(entries, listings)
+    matched = check_filter(scripts, filter_str) if filter_str else {}
+    return parse_entries(entries, listings, matched, SecretMasker(sec_data, 'Authorization'),
+                         indent_multiplier, filter_str)
+
+
+def parse_entries(entries, listings, matched, masker, indent_multiplier=1, filter_str=None):
     def counter(max_val):
         for c in range(1, max_val + 1):
             yield c
 
-    def check_filter(data):
-        if len(findall(filter_str, data)) > 0:
-            display.v(msg="{0} checking script by filter {1}-> matched".format('*' * (indent_multiplier + 1),
-                                                                               "\"{0}\"".format(filter_str)
-                                                                               if filter_str else ""))
-            return True
-        else:
-            display.v(msg="{0} checking script  by filter {1}-> not matched".format('*' * (indent_multiplier + 1),
-                                                                                    "\"{0}\"".format(filter_str)
-                                                                                    if filter_str else ""))
-            return False
-
     f_list = {}
     res_data = {}
-    task_num = counter(len(in_data))
-    for el_v in in_data:
-        if isdir(el_v):
+    task_num = counter(len(entries))
+    for el_v, kind in entries:
+        if kind == 'dir':
             display.v(msg="{0} found directory - {1}".format('*' * indent_multiplier, el_v))
-            _f, _t = parse_data(sorted(glob(p_jp(el_v, "*.cmd"))),
-                                indent_multiplier=indent_multiplier + 1,
-                                filter_str=filter_str)
+            _f, _t = parse_entries(listings[el_v], listings, matched, masker,
+                                   indent_multiplier=indent_multiplier + 1,
+                                   filter_str=filter_str)
             dir_task_num = next(task_num)
             for _fi, _fv in _f.items():
                 f_list[float("{0}.{1}".format(dir_task_num, m_trunc(_fi)))] = _fv
-        elif isfile(el_v):
+        elif kind == 'file':
             display.v(msg="{0} found script - {1}".format('*' * indent_multiplier, el_v))
             if filter_str:
-                try:
-                    with open(el_v, mode='r') as scr_f:
-                        script_body = scr_f.read()
-                        if check_filter(script_body):
-                            f_list[float(next(task_num))] = abspath(el_v)
-                except IOError as e:
-                    display.error('Fail on checking script by filter: {0}'.format(e), True)
+                if isinstance(matched[el_v], Exception):
+                    display.error('Fail on checking script by filter: {0}'.format(matched[el_v]), True)
+                elif matched[el_v]:
+                    display.v(msg="{0} checking script by filter \"{1}\"-> matched".
+                              format('*' * (indent_multiplier + 1), filter_str))
+                    f_list[float(next(task_num))] = abspath(el_v)
+                else:
+                    display.v(msg="{0} checking script  by filter \"{1}\"-> not matched".
+                              format('*' * (indent_multiplier + 1), filter_str))
             else:
                 f_list[float(next(task_num))] = abspath(el_v)
         else:
-            display.v(msg="{0} found command - {1}".format('*' * indent_multiplier, sec_clean(el_v, sec_data)))
+            display.v(msg="{0} found command - {1}".format('*' * indent_multiplier, masker.mask_str(el_v)))
             res_data[float(next(task_num))] = el_v
 
     res_data.update(dict.fromkeys(f_list))
     return f_list, res_data
 
 
-def sec_clean(data, sec_data):
-    def clean_data(sc_data, sec_str, mask='******'):
-        if isinstance(sc_data, (unicode, str, AnsibleUnsafeText)):
-            return sc_data.replace(sec_str, mask)
-        elif isinstance(sc_data, list):
-            return [clean_data(l, sec_str, mask) for l in sc_data]
-        elif isinstance(sc_data, dict):
-            for i in sc_data:
-                sc_data[i] = clean_data(sc_data[i], sec_str, mask)
-            return sc_data
-        else:
-            return sc_data
+PROFILE_FIELDS = ['queue', 'first_byte', 'total', 'bytes', 'rows']
+
+
+def profile_table(results, phases):
+    """Summary table of command timings and run phases."""
+    rows = [['cmd'] + PROFILE_FIELDS]
+    rows += [[r['cmd']] + ['{0}'.format(r['timing'][f]) for f in PROFILE_FIELDS] for r in results if 'timing' in r]
+    widths = [max(len(row[ndx]) for row in rows) for ndx in range(len(rows[0]))]
+    lines = ['  '.join(v.ljust(w) if ndx == 0 else v.rjust(w) for ndx, (v, w) in enumerate(zip(row, widths)))
+             for row in rows]
+    lines.append(', '.join('{0}: {1}'.format(k, v) for k, v in sorted(phases.items())))
+    return '\n'.join(lines)
+
 
-    data = clean_data(data, sec_data['sadmin_pw'], "Authorization")
-    if "other" in sec_data.keys():
-        for sd in sec_data['other']:
-            data = clean_data(data, sd)
-    return data
+def csv_value(value):
+    value = '' if value is None else '{0}'.format(value)
+    return '"{0}"'.format(value.replace('"', '""')) if any(c in value for c in ',"\n') else value
+
+
+def save_profile(profile_file, host, results, phases):
+    """
+    Appends profile of the run to profile_file: one row per command if it is *.csv, one JSON document otherwise.
+    """
+    stamp = strftime('%Y-%m-%dT%H:%M:%S')
+    profile_file = expanduser(profile_file)
+    timed = [r for r in results if 'timing' in r]
+    if profile_file.endswith('.csv'):
+        data = ''
+        if not isfile(profile_file):
+            data = ','.join(['time', 'host', 'cmd'] + PROFILE_FIELDS) + '\n'
+        data += ''.join(','.join(csv_value(v) for v in [stamp, host, r['cmd']] +
+                                 [r['timing'][f] for f in PROFILE_FIELDS]) + '\n' for r in timed)
+    else:
+        data = json.dumps(dict(time=stamp, host=host, phases=phases,
+                               commands=[dict(cmd=r['cmd'], **r['timing']) for r in timed]), sort_keys=True) + '\n'
+    # one write per run, so runs of several hosts are not interleaved
+    with open(profile_file, 'a') as prof_f:
+        prof_f.write(data)
+
+
+def report_result(r, target=None):
+    target = target or r.get('target')
+    prefix = "Srvrmgr task: {0}\"{1}\" ->".format('[{0}] '.format(target) if target else '', r['cmd'])
+    if 'err' in r.keys():
+        display.error('{0} Fail'.format(prefix), True)
+    elif 'warn' in r.keys():
+        display.warning('{0} Skipped with errors:\n - {1}'.format(prefix, '\n - '.join(r['warn']['parsed'][1::])),
+                        True)
+    else:
+        display.display(msg="{0} Ok".format(prefix), color='green')
 
 
 class ActionModule(ActionBase):
+    _supports_async = True
+
+    def _transfer_scripts(self, members, remote_tmp):
+        """Packs scripts into one archive (members is list of (name in archive, file)) and transfers it at once."""
+        arc_fd, arc_path = mkstemp(suffix='.tar.gz')
+        try:
+            with fdopen(arc_fd, 'wb') as arc_f:
+                arc = tar_open(fileobj=arc_f, mode='w:gz')
+                try:
+                    for arc_name, f_name in members:
+                        display.v(msg="Packing file {0}".format(f_name))
+                        arc.add(f_name, arcname=arc_name)
+                finally:
+                    arc.close()
+            display.v(msg="Copying {0} files in archive".format(len(members)))
+            return self._transfer_file(arc_path, p_jp(remote_tmp, 'srvrmgr_scripts.tar.gz'))
+        finally:
+            unlink(arc_path)
+
+    def _cached_scripts(self, files_for_copy, cache_dir):
+        """
+        Content-hash cache of scripts on the target, every script is stored as <cache_dir>/<sha1>/<basename>.
+        Only blobs of the task are checked (a damaged blob is removed and transferred again),
+        blobs unused for SCRIPT_CACHE_DAYS are removed.
+        Returns remote paths of scripts by task number and list of scripts missing in the cache.
+        """
+        blobs = {}
+        for f_ndx, f_name in files_for_copy.items():
+            with open(f_name, 'rb') as scr_f:
+                blobs[f_ndx] = '{0}/{1}'.format(sha1(scr_f.read()).hexdigest(), p_bn(f_name))
+
+        res = self._low_level_execute_command(SCRIPT_CACHE_CMD.format(
+            shlex_quote(cache_dir), ' '.join(shlex_quote(blob) for blob in sorted(set(blobs.values()))),
+            SCRIPT_CACHE_DAYS))
+        cached = set(res.get('stdout', '').splitlines())
+        display.vvv('Scripts found in cache {0}: {1} of {2}'.format(cache_dir, len(set(blobs.values()) & cached),
+                                                                    len(set(blobs.values()))))
+        missing = dict((blob, files_for_copy[f_ndx]) for f_ndx, blob in blobs.items() if blob not in cached)
+        return (dict((f_ndx, p_jp(cache_dir, blob)) for f_ndx, blob in blobs.items()),
+                sorted(missing.items()))
+
+    def _report_progress(self, progress_file, offset):
+        """Reports commands appended to the remote progress file after offset (bytes), returns the new offset."""
+        res = self._low_level_execute_command('tail -c +{0} {1} 2>/dev/null'.format(offset + 1,
+                                                                                   shlex_quote(progress_file)))
+        data = res.get('stdout', '')
+        # the last line may be incomplete while it is written
+        data = data[:data.rfind('\n') + 1]
+        for line in data.splitlines():
+            report_result(json.loads(line))
+        return offset + len(to_bytes(data))
+
+    def _wait_async(self, started, progress_file, task_vars):
+        """
+        Polls async job of the module and reports commands as they finish.
+        Returns the final result of the job, the job is cleaned up and the task executor does not poll it again:
+        its last async_status result would replace the result processed by this plugin.
+        """
+        offset = 0
+        deadline = time() + self._task.async_val
+        status_args = dict(jid=started['ansible_job_id'])
+        if hasattr(self, 'get_shell_option'):
+            # async_status module of ansible 2.8+ gets async dir from its action plugin
+            status_args['_async_dir'] = self._remote_expand_user(self.get_shell_option('async_dir',
+                                                                                       default='~/.ansible_async'))
+        try:
+            while True:
+                status = self._execute_module(module_name='async_status', module_args=status_args,
+                                              task_vars=task_vars)
+                offset = self._report_progress(progress_file, offset)
+                if status.get('finished') or status.get('failed'):
+                    break
+                if time() > deadline:
+                    status = dict(failed=True, async_result=status,
+                                  msg='async task did not complete within the requested time - {0}s'.format(
+                                      self._task.async_val))
+                    break
+                sleep(self._task.poll)
+        finally:
+            self._low_level_execute_command('rm -f {0}'.format(shlex_quote(progress_file)))
+        if status.get('finished'):
+            self._execute_module(module_name='async_status', module_args=dict(status_args, mode='cleanup'),
+                                 task_vars=task_vars)
+            # the task executor keeps remote tmp dir of async tasks, async_status leaves it once the job is done
+            tmpdir = self._connection._shell.tmpdir
+            if tmpdir:
+                self._low_level_execute_command(self._connection._shell.remove(tmpdir, recurse=True), sudoable=False)
+                self._connection._shell.tmpdir = None
+            for key in ('ansible_job_id', 'started', 'finished', 'results_file'):
+                status.pop(key, None)
+        else:
+            status['ansible_job_id'] = started['ansible_job_id']
+        self._task.poll = 0
+        return status
+
+    def _fetch_spools(self, results, dest_dir, host, task_vars):
+        """
+        Copies spool files of truncated outputs to dest_dir/host on the controller and removes them on the target.
+        With become the files belong to the become user, they are read by slurp as the fetch action does.
+        """
+        for r in results:
+            spool = r.get('out', {}).get('spool')
+            if not spool:
+                continue
+            local_path = p_jp(expanduser(dest_dir), host, p_bn(spool))
+            if not isdir(p_dn(local_path)):
+                makedirs(p_dn(local_path))
+            if self._play_context.become:
+                slurped = self._execute_module(module_name='slurp', module_args=dict(src=spool), task_vars=task_vars)
+                if slurped.get('failed'):
+                    display.warning('Spool file {0} is not fetched: {1}'.format(spool, slurped.get('msg')))
+                    continue
+                with open(local_path, 'wb') as local_f:
+                    local_f.write(b64decode(slurped['content']))
+            else:
+                self._connection.fetch_file(spool, local_path)
+            self._low_level_execute_command('rm -f {0}'.format(shlex_quote(spool)))
+            display.vvv('Spool file {0} is fetched to {1}'.format(spool, local_path))
+            r['out']['spool'] = local_path
+
+    def _resume_stack(self, module_args, files_for_copy):
+        """
+        Reads checkpoint of the stack on the target, completed tasks are removed from the stack
+        and their scripts are not transferred. Returns the checkpoint key and list of removed tasks.
+        """
+        steps = [(ndx, file_digest(files_for_copy[ndx]) if ndx in files_for_copy else cmd)
+                 for ndx, cmd in module_args['cmd_stack'].items()]
+        key = stack_key(module_args['sieb_gateway'], module_args['sieb_enterprise'], steps)
+        checkpoint = p_jp(self._remote_expand_user(module_args['session_dir'] or SESSION_DIR), CHECKPOINT_SUBDIR, key)
+        res = self._low_level_execute_command('cat {0} 2>/dev/null'.format(shlex_quote(checkpoint)))
+        done = parse_checkpoint(res.get('stdout', ''))
+        # set and unset stay in the stack, the module replays them
+        skipped = sorted(ndx for ndx in done if ndx in module_args['cmd_stack'] and
+                         not is_session_cmd(module_args['cmd_stack'][ndx]))
+        if skipped:
+            display.display(msg="Resume: {0} of {1} tasks are completed before".format(
+                len(skipped), len(module_args['cmd_stack'])), color='yellow')
+        for ndx in skipped:
+            del module_args['cmd_stack'][ndx]
+            files_for_copy.pop(ndx, None)
+        return key, skipped
+
     def run(self, tmp=None, task_vars=None):
         def update_result_msg(data):
             if 'msg' in result.keys():
@@ -102,11 +434,17 @@ class ActionModule(ActionBase):
         # Get module parameters
         module_args = dict()
         for a in ['add_env', 'filter', 'cmd_stack', 'creds', 'skip_errors',
-                  'sieb_path', 'sieb_gateway', 'sieb_enterprise']:
+                  'sieb_path', 'sieb_gateway', 'sieb_enterprise', 'sieb_user', 'cmd_timeout',
+                  'persistent', 'session_ttl', 'session_dir', 'parallel',
+                  'refresh_env', 'parsed_only', 'columns', 'where', 'script_cache', 'profile', 'profile_file',
+                  'pipeline', 'resume', 'targets', 'target_workers',
+                  'result_format', 'coerce_types', 'diff_params', 'max_output_bytes', 'spool_output',
+                  'fetch_spool']:
             module_args[a] = self._task.args.get(a, None)
 
         # Analyse received parameters
-        for req_p in ['cmd_stack', 'creds', 'sieb_path', 'sieb_gateway', 'sieb_enterprise']:
+        for req_p in ['cmd_stack', 'creds', 'sieb_path'] + ([] if module_args['targets'] else ['sieb_gateway',
+                                                                                              'sieb_enterprise']):
             if type(module_args[req_p]) is None:
                 result['failed'] = True
                 update_result_msg('Parameter "{0}" is required\n'.format(req_p))
@@ -131,42 +469,100 @@ class ActionModule(ActionBase):
             display.vvv('{0} defined as temp dir'.format(remote_tmp))
 
         # Analyse "cmd_stack" parameter
+        phases = {}
+        start = time()
         display.display(msg="Analyse tasks...", color='yellow')
         files_for_copy, module_args['cmd_stack'] = parse_data(module_args['cmd_stack'],
                                                               sec_data=module_args['creds'],
                                                               filter_str=module_args['filter']
                                                               )
+        module_args['checkpoint_key'] = None
+        skipped_steps = []
+        if module_args['resume'] and not module_args['targets']:
+            # with targets checkpoints are different for every target, they are checked by the module
+            module_args['checkpoint_key'], skipped_steps = self._resume_stack(module_args, files_for_copy)
 
         # Copy files
-        for f_ndx, f_name in files_for_copy.items():
-            display.v(msg="Copying file {0}".format(f_name))
-            module_args['cmd_stack'][f_ndx] = 'read {0}'.format(
-                self._transfer_file(f_name, p_jp(remote_tmp, p_bn(f_name))))
+        phases['analyse'] = round(time() - start, 3)
+        start = time()
+        module_args['scripts_archive'] = None
+        module_args['scripts_dir'] = None
+        if files_for_copy and module_args['script_cache']:
+            module_args['scripts_dir'] = self._remote_expand_user(module_args['script_cache'])
+            remote_files, members = self._cached_scripts(files_for_copy, module_args['scripts_dir'])
+        else:
+            remote_files = dict((f_ndx, p_jp(remote_tmp, p_bn(f_name))) for f_ndx, f_name in files_for_copy.items())
+            members = [(p_bn(files_for_copy[f_ndx]), files_for_copy[f_ndx]) for f_ndx in sorted(files_for_copy)]
+        if members:
+            module_args['scripts_archive'] = self._transfer_scripts(members, remote_tmp)
+        for f_ndx, remote_f in remote_files.items():
+            module_args['cmd_stack'][f_ndx] = 'read {0}'.format(remote_f)
         display.vvv("SRVRMGR_CMD_STACK: {0}".format(module_args['cmd_stack']))
         self._fixup_perms2((remote_tmp,), remote_usr)
 
         display.display(msg="Execute tasks [{0}]...".format(len(module_args['cmd_stack'])), color='yellow')
+        phases['transfer'] = round(time() - start, 3)
+        start = time()
+        profile_file = module_args.pop('profile_file')
+        fetch_spool = module_args.pop('fetch_spool')
+        if fetch_spool:
+            module_args['spool_output'] = True
+        module_args['profile'] = bool(module_args['profile'] or profile_file)
         del module_args['filter']
+        del module_args['script_cache']
+        wrap_async = bool(self._task.async_val) and not self._connection.has_native_async
+        module_args['progress_file'] = None
+        if wrap_async and self._task.poll > 0:
+            # outside of remote_tmp, which is removed when the async job starts; the file is removed by _wait_async
+            module_args['progress_file'] = p_jp(self._remote_expand_user(PROGRESS_DIR),
+                                                '{0}.jsonl'.format(uuid4().hex))
         module_res = self._execute_module(
             module_name='srvrmgr',
-            module_args=module_args,
+            # unset parameters are not passed, module defaults are used for them
+            module_args=dict((k, v) for k, v in module_args.items() if v is not None),
             task_vars=task_vars,
             tmp=remote_tmp,
-            delete_remote_tmp=True
+            delete_remote_tmp=True,
+            wrap_async=wrap_async
         )
+        reported = False
+        if wrap_async and self._task.poll > 0 and 'ansible_job_id' in module_res and not module_res.get('failed'):
+            module_res = self._wait_async(module_res, module_args['progress_file'], task_vars)
+            reported = True
+        phases['execute'] = round(time() - start, 3)
         result.update(module_res)
-        result = sec_clean(result, module_args['creds'])
+        if skipped_steps:
+            result['skipped_steps'] = sorted(set(result.get('skipped_steps', [])) | set(skipped_steps))
+        # command results are masked on the target while output is read
+        cmd_results = result.pop('results', None)
+        target_results = result.pop('targets', None)
+        result = SecretMasker(module_args['creds'], 'Authorization').mask(result)
+        if cmd_results is not None:
+            result['results'] = cmd_results
+        if target_results is not None:
+            result['targets'] = target_results
+
+        if fetch_spool and (not wrap_async or reported):
+            host = task_vars.get('inventory_hostname') or 'localhost'
+            self._fetch_spools(result.get('results', []), fetch_spool, host, task_vars)
+            for outcome in (result.get('targets') or {}).values():
+                self._fetch_spools(outcome['results'], fetch_spool, host, task_vars)
 
         # report of execution
-        if 'results' in result.keys():
+        if 'results' in result.keys() and not reported:
             for r in result['results']:
-                prefix = "Srvrmgr task: \"{0}\" ->".format(r['cmd'])
-                if 'err' in r.keys():
-                    display.error('{0} Fail'.format(prefix), True)
-                elif 'warn' in r.keys():
-                    display.warning('{0} Skipped with errors:\n - {1}'.format(prefix,
-                                                                              '\n - '.join(r['warn']['parsed'][1::])),
-                                    True)
-                else:
-                    display.display(msg="{0} Ok".format(prefix), color='green')
+                report_result(r)
+        all_results = list(result.get('results', []))
+        for name, outcome in sorted((result.get('targets') or {}).items()):
+            for r in outcome['results']:
+                if not reported:
+                    report_result(r, name)
+                all_results.append(dict(r, cmd='[{0}] {1}'.format(name, r['cmd'])))
+
+        if module_args['profile']:
+            result.setdefault('profile', {}).update(('controller_' + k, v) for k, v in phases.items())
+            if self._task.args.get('profile'):
+                display.display(msg=profile_table(all_results, result['profile']))
+            if profile_file:
+                save_profile(profile_file, task_vars.get('inventory_hostname'), all_results, result['profile'])
         return result
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fake srvrmgr for benchmarks, no Siebel installation is needed.
+
+Emulates login banner, "srvrmgr> " prompt, "^$^" delimited list output and errors.
+Settings are taken from environment:
+    FAKE_SRVRMGR_PASSWORD   password expected on login (default "secret")
+    FAKE_SRVRMGR_ROWS       rows in output of "list ..." commands (default 100)
+    FAKE_SRVRMGR_LATENCY    delay in seconds before output of every command (default 0)
+    FAKE_SRVRMGR_ECHO       echo commands after the prompt if set to 1 (default 0)
+Commands starting with "error" write SBL-ADM-01067 to stderr, "list" commands of an object named "Missing" write
+SBL-ADM-60070 to stderr, "list params" returns MaxTasks=100 and MinMTServers=1, "quit" and "exit" end the session.
+"set server <name>" limits list output to rows of the server and adds the name to the prompt, "unset server"
+resets it.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import sys
+from os import environ
+from time import sleep
+
+PASSWORD = environ.get('FAKE_SRVRMGR_PASSWORD', 'secret')
+ROWS = int(environ.get('FAKE_SRVRMGR_ROWS', 100))
+LATENCY = float(environ.get('FAKE_SRVRMGR_LATENCY', 0))
+ECHO = environ.get('FAKE_SRVRMGR_ECHO') == '1'
+FIELDS = ['SV_NAME', 'CC_ALIAS', 'CC_NAME', 'CP_DISP_RUN_STATE', 'CP_NUM_RUN_TASKS', 'CP_MAX_TASKS']
+PROMPT = '\nsrvrmgr> '
+SERVER_PROMPT = '\nsrvrmgr:{0}> '
+
+
+def list_output(rows, server=None):
+    widths = [len(f) + 10 for f in FIELDS]
+    lines = ['^$^'.join(f.ljust(w) for f, w in zip(FIELDS, widths)) + '^$^',
+             '^$^'.join('-' * w for w in widths) + '^$^']
+    for ndx in range(rows):
+        values = ['srv{0}'.format(ndx % 4), 'Comp{0}'.format(ndx), 'Component number {0}'.format(ndx),
+                  'Online' if ndx % 3 else 'Shutdown', str(ndx % 20), '100']
+        if server is None or values[0] == server:
+            lines.append('^$^'.join(v.ljust(w) for v, w in zip(values, widths)) + '^$^')
+    return '\n{0}\n\n{1} rows returned.\n'.format('\n'.join(lines), len(lines) - 2)
+
+
+def params_output():
+    return ('\nPA_ALIAS    ^$^PA_VALUE  ^$^\n------------^$^----------^$^\nMaxTasks    ^$^100       ^$^\n'
+            'MinMTServers^$^1         ^$^\n\n2 rows returned.\n')
+
+
+def main():
+    out = sys.stdout
+    out.write('Siebel Enterprise Applications Siebel Server Manager, Version 8.1.1.11 [23030] LANG_INDEPENDENT\n'
+              'Copyright (c) 2008 Siebel. All rights reserved.\n\nPassword:')
+    out.flush()
+    if sys.stdin.readline().strip() != PASSWORD:
+        sys.stderr.write('SBL-ADM-02071: The specified user name or password is invalid\n')
+        return 1
+    out.write('\nConnected to 4 server(s) out of a total of 4 server(s) in the enterprise\n' + PROMPT)
+    out.flush()
+    server, prompt = None, PROMPT
+
+    for line in iter(sys.stdin.readline, ''):
+        cmd = line.strip()
+        if ECHO:
+            out.write(cmd + '\n')
+        if LATENCY:
+            sleep(LATENCY)
+        if cmd in ('quit', 'exit'):
+            out.write('\nDisconnecting from server.\n')
+            out.flush()
+            break
+        elif cmd.startswith('list') and 'Missing' in cmd.split():
+            sys.stderr.write('SBL-ADM-60070: Error reading object definition: Missing\n')
+            sys.stderr.flush()
+            out.write(prompt)
+        elif cmd.startswith('list params'):
+            out.write(params_output() + prompt)
+        elif cmd.startswith('list'):
+            out.write(list_output(ROWS, server) + prompt)
+        elif cmd.startswith('error'):
+            sys.stderr.write('SBL-ADM-01067: Error: {0}\n'.format(cmd))
+            sys.stderr.flush()
+            out.write(prompt)
+        else:
+            if cmd.split()[:2] == ['set', 'server']:
+                server = cmd.split()[2]
+            elif cmd.split()[:2] == ['unset', 'server']:
+                server = None
+            prompt = SERVER_PROMPT.format(server) if server else PROMPT
+            out.write('\nCommand completed successfully.\n' + prompt)
+        out.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of srvrmgr module, action and lookup plugins and fails checks. Runs on Linux without Siebel,
+srvrmgr is emulated by fake_srvrmgr.py. Ansible must be importable.
+
+    python benchmarks/run_benchmarks.py [--quick] [--save result.json] [--compare result.json] [--threshold 20]
+
+Every benchmark reports iterations, median and 95th percentile latency and throughput.
+With --compare the median of every benchmark is compared with a saved result, exit code is 1
+if any benchmark is slower than the threshold (percent).
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import json
+import sys
+from argparse import ArgumentParser
+from os import chmod, environ, makedirs, path, pathsep
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+REPO_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+FAKE_SRVRMGR = path.join(REPO_DIR, 'benchmarks', 'fake_srvrmgr.py')
+PASSWORD = 'secret'
+
+
+def load_plugin(name, *rel_path):
+    """Loads a file of the repository as module name once, the tests load plugins by this helper too."""
+    if name in sys.modules:
+        return sys.modules[name]
+    f_path = path.join(REPO_DIR, *rel_path)
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        from imp import load_source
+        return load_source(name, f_path)
+    spec = spec_from_file_location(name, f_path)
+    module = module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_module():
+    # module_utils of this repository are shipped with the module by ansible, here they are added to the package path
+    import ansible.module_utils
+    utils_dir = path.join(REPO_DIR, 'module_utils')
+    if utils_dir not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(utils_dir)
+    return load_plugin('srvrmgr_module', 'library', 'srvrmgr.py')
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+def bench(name, func, iterations, units=1, unit_name='ops'):
+    """Calls func iterations times, units is amount of work done by one call (rows, paths, bytes)."""
+    durations = []
+    for _ in range(iterations):
+        start = time()
+        func()
+        durations.append(time() - start)
+    median = percentile(durations, 50)
+    return dict(name=name, iterations=iterations, median=median, p95=percentile(durations, 95),
+                throughput=units / median if median else 0.0, unit=unit_name)
+
+
+def fake_bin(work_dir):
+    """Creates "srvrmgr" executable in work_dir running the fake srvrmgr by the current interpreter."""
+    bin_dir = path.join(work_dir, 'bin')
+    makedirs(bin_dir)
+    bin_path = path.join(bin_dir, 'srvrmgr')
+    with open(bin_path, 'w') as bin_f:
+        bin_f.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable, FAKE_SRVRMGR))
+    chmod(bin_path, 0o755)
+    return bin_dir
+
+
+def srvrmgr_output(rows):
+    fake = load_plugin('fake_srvrmgr', 'benchmarks', 'fake_srvrmgr.py')
+    return fake.list_output(rows) + '\nsrvrmgr> '
+
+
+def bench_module(module, work_dir, opts):
+    results = []
+    env = dict(environ, PATH=fake_bin(work_dir) + pathsep + environ.get('PATH', ''),
+               FAKE_SRVRMGR_PASSWORD=PASSWORD, FAKE_SRVRMGR_ROWS=str(opts.rows),
+               FAKE_SRVRMGR_LATENCY=str(opts.latency))
+    params = dict(sieb_gateway='gw', sieb_enterprise='ent', sieb_user='sadmin')
+    masker = module.masker_for(dict(sadmin_pw=PASSWORD))
+
+    start = time()
+    pipe = module.spawn_srvrmgr(params, env)
+    module.exec_cmd(pipe, PASSWORD, [], masker)
+    results.append(dict(name='srvrmgr spawn and login', iterations=1, median=time() - start, p95=time() - start,
+                        throughput=0.0, unit='-'))
+    try:
+        results.append(bench('exec_cmd list ({0} rows)'.format(opts.rows),
+                             lambda: module.exec_cmd(pipe, 'list comp', [], masker), opts.iterations,
+                             opts.rows, 'rows'))
+        results.append(bench('exec_cmd list parsed only',
+                             lambda: module.exec_cmd(pipe, 'list comp', [], masker, keep_raw=False),
+                             opts.iterations, opts.rows, 'rows'))
+        results.append(bench('exec_cmd error', lambda: module.exec_cmd(pipe, 'error cmd', ['SBL-ADM-01067'], masker),
+                             opts.iterations))
+        results.append(bench('exec_cmd command', lambda: module.exec_cmd(pipe, 'set server srv1', [], masker),
+                             opts.iterations))
+    finally:
+        module.stop_srvrmgr(pipe)
+
+    output = srvrmgr_output(opts.rows)
+    results.append(bench('module parse_data ({0} rows)'.format(opts.rows), lambda: module.parse_data(output),
+                         opts.iterations, opts.rows, 'rows'))
+    sec_masker = module.masker_for(dict(sadmin_pw=PASSWORD, other=['Comp1{0}'.format(n) for n in range(10)]))
+    results.append(bench('mask output ({0} bytes)'.format(len(output)), lambda: sec_masker.mask_str(output),
+                         opts.iterations, len(output), 'bytes'))
+    return results
+
+
+def script_tree(work_dir, dirs, files):
+    root = path.join(work_dir, 'scripts')
+    for d_ndx in range(dirs):
+        d_path = path.join(root, '{0:03d}_dir.cmd'.format(d_ndx))
+        makedirs(d_path)
+        for f_ndx in range(files):
+            with open(path.join(d_path, '{0:03d}_script.cmd'.format(f_ndx)), 'w') as scr_f:
+                scr_f.write('list comp\n' * 50 + ('activate component definition Comp{0}\n'.format(f_ndx)
+                                                  if f_ndx % 2 else 'list servers\n'))
+    return root
+
+
+def bench_action(work_dir, opts):
+    action = load_plugin('srvrmgr_action', 'action_plugins', 'srvrmgr.py')
+    action.FILTER_CACHE = path.join(work_dir, 'filter_cache.json')
+    root = script_tree(work_dir, opts.dirs, opts.files)
+    scripts = opts.dirs * opts.files
+    stack = ['list servers', root, 'list comp']
+    return [
+        bench('action parse_data ({0} scripts)'.format(scripts),
+              lambda: action.parse_data(stack, sec_data=dict(sadmin_pw=PASSWORD)), opts.iterations, scripts,
+              'scripts'),
+        bench('action parse_data with filter',
+              lambda: action.parse_data(stack, sec_data=dict(sadmin_pw=PASSWORD), filter_str='activate'),
+              opts.iterations, scripts, 'scripts'),
+    ]
+
+
+def bench_lookup(work_dir, opts):
+    lookup = load_plugin('map_from_file', 'lookup_plugins', 'map_from_file.py')
+    paths_file = path.join(work_dir, 'paths.txt')
+    with open(paths_file, 'w') as paths_f:
+        for ndx in range(opts.paths):
+            paths_f.write('/home/usr{0}/fs{1}/dir{2}/file{3}.txt\n'.format(ndx % 10, ndx % 7, ndx % 100, ndx))
+    m_dict = dict(('/home/usr{0}/fs{1}'.format(u, f), ['/mnt/usr{0}/fs{1}_0'.format(u, f),
+                                                       '/mnt/usr{0}/fs{1}_1'.format(u, f)])
+                  for u in range(10) for f in range(7))
+    term = 'file={0} map_dict={1}'.format(paths_file, m_dict)
+
+    class Loader(object):
+        def _get_file_contents(self, f_path):
+            with open(f_path, 'rb') as f_data:
+                return f_data.read(), False
+
+    class Lookup(lookup.LookupModule):
+        def find_file_in_search_path(self, variables, subdir, needle, ignore_missing=False):
+            return needle
+
+    module = Lookup(loader=Loader())
+
+    def cold():
+        lookup.MAPPING_CACHE.data.clear()
+        lookup.FILE_CACHE.data.clear()
+        module.run([term], {})
+
+    return [
+        bench('map_from_file ({0} paths)'.format(opts.paths), cold, opts.iterations, opts.paths, 'paths'),
+        bench('map_from_file cached', lambda: module.run([term], {}), opts.iterations, opts.paths, 'paths'),
+        bench('map_from_file stream', lambda: module.run([term], {}, stream=True), opts.iterations, opts.paths,
+              'paths'),
+    ]
+
+
+def bench_fails(opts):
+    fails = load_plugin('check_for_fails', 'test_plugins', 'check_for_fails.py')
+    lines = ['{0} INFO component Comp{1} started'.format(ndx, ndx) for ndx in range(opts.lines)]
+    target = dict(stdout='\n'.join(lines), stdout_lines=lines, stderr='')
+    conds = dict(STDOUT=[dict(cond='in', data='SBL-ERR'), dict(cond='in', data='ERROR'),
+                         dict(cond='regex', data=r'SBL-[A-Z]{3}-\d+'), dict(cond='not in', data='started')],
+                 STDERR=[dict(cond='not empty')])
+    size = len(target['stdout'])
+    return [
+        bench('fails_in_outs ({0} lines)'.format(opts.lines), lambda: fails.fails_in_outs(target, conds),
+              opts.iterations, size, 'bytes'),
+        bench('fails_in_lines', lambda: fails.fails_in_lines(target, conds), opts.iterations, size, 'bytes'),
+    ]
+
+
+def report(results, baseline=None, threshold=20.0):
+    slower = []
+    print('{0:<40} {1:>6} {2:>10} {3:>10} {4:>14} {5:>8}'.format('benchmark', 'iter', 'median ms', 'p95 ms',
+                                                                 'throughput/s', 'delta'))
+    for res in results:
+        delta = ''
+        if baseline and res['name'] in baseline and baseline[res['name']]['median']:
+            change = (res['median'] / baseline[res['name']]['median'] - 1) * 100
+            delta = '{0:+.1f}%'.format(change)
+            if change > threshold:
+                slower.append(res['name'])
+        print('{0:<40} {1:>6} {2:>10.3f} {3:>10.3f} {4:>14} {5:>8}'.format(
+            res['name'], res['iterations'], res['median'] * 1000, res['p95'] * 1000,
+            '{0:.0f} {1}'.format(res['throughput'], res['unit']) if res['throughput'] else '-', delta))
+    return slower
+
+
+def main():
+    parser = ArgumentParser(description='Benchmarks of srvrmgr plugins')
+    parser.add_argument('--quick', action='store_true', help='small data sets and few iterations')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=5000, help='rows in srvrmgr list output')
+    parser.add_argument('--latency', type=float, default=0, help='delay of fake srvrmgr per command, seconds')
+    parser.add_argument('--dirs', type=int, default=20, help='directories in generated script tree')
+    parser.add_argument('--files', type=int, default=50, help='scripts in every directory')
+    parser.add_argument('--paths', type=int, default=100000, help='paths in generated map_from_file list')
+    parser.add_argument('--lines', type=int, default=200000, help='lines of output checked for fails')
+    parser.add_argument('--save', help='save results to JSON file')
+    parser.add_argument('--compare', help='compare with results saved by --save')
+    parser.add_argument('--threshold', type=float, default=20.0, help='allowed slowdown in percent')
+    opts = parser.parse_args()
+    if opts.quick:
+        opts.iterations, opts.rows, opts.dirs, opts.files, opts.paths, opts.lines = 5, 500, 5, 10, 5000, 10000
+
+    work_dir = mkdtemp(prefix='srvrmgr_bench_')
+    try:
+        results = bench_module(load_module(), work_dir, opts)
+        results += bench_action(work_dir, opts)
+        results += bench_lookup(work_dir, opts)
+        results += bench_fails(opts)
+    finally:
+        rmtree(work_dir)
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as base_f:
+            baseline = dict((r['name'], r) for r in json.load(base_f))
+    slower = report(results, baseline, opts.threshold)
+    if opts.save:
+        with open(opts.save, 'w') as save_f:
+            json.dump(results, save_f, indent=2)
+    if slower:
+        print('Slower than baseline by more than {0}%: {1}'.format(opts.threshold, ', '.join(slower)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'Kostrenko A.V. (kostrenko.av@gmail.com)'
+}
+
+import sys
+from os.path import abspath, dirname as p_dn, join as p_jp
+
+SHARED_MODULE = 'check_for_fails_shared'
+
+
+def load_check_for_fails():
+    """
+    Conditions are implemented by the test plugin of this repository. The module loaded by ansible is reused,
+    otherwise it is loaded by path once, imp is used only where importlib.util is missing (python 2).
+    """
+    if SHARED_MODULE in sys.modules:
+        return sys.modules[SHARED_MODULE]
+    f_path = p_jp(p_dn(abspath(__file__)), '..', 'test_plugins', 'check_for_fails.py')
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        from imp import load_source
+        return load_source(SHARED_MODULE, f_path)
+    spec = spec_from_file_location(SHARED_MODULE, f_path)
+    module = module_from_spec(spec)
+    sys.modules[SHARED_MODULE] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+find_fail = load_check_for_fails().find_fail
+
+
+class FilterModule(object):
+    def filters(self):
+        return {
+            'fail_details': find_fail,
+        }
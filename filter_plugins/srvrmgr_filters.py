@@ -1,9 +1,236 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division, print_function)
 
+from collections import OrderedDict
+from numbers import Number
+from re import compile as re_compile
+
+from ansible.errors import AnsibleFilterError
+from ansible.module_utils.six import string_types
+
+# same rule as type coercion of the module, ids with leading zeros like '0012' stay text
+NUM_RE = re_compile(r'^\s*-?(?:(?:0|[1-9]\d*)(?:\.\d*)?|\.\d+)\s*$')
+OPERATORS = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a > b,
+    'ge': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'le': lambda a, b: a <= b,
+}
+
+
+def is_columnar(in_data):
+    return isinstance(in_data, dict) and 'columns' in in_data and 'rows' in in_data
+
+
+def as_number(value):
+    if isinstance(value, string_types) and NUM_RE.match(value):
+        return float(value)
+    return value
+
+
+def is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def compare(op, value, expected):
+    """
+    Numeric strings (without leading zeros) are compared as numbers, a number is never ordered against a text or
+    empty value.
+    """
+    value, expected = as_number(value), as_number(expected)
+    if op in ('eq', 'ne'):
+        return OPERATORS[op](value, expected)
+    if value is None or expected is None or is_number(value) != is_number(expected):
+        return False
+    return OPERATORS[op](value, expected)
+
+
+class TableIndex(object):
+    """
+    Parsed srvrmgr table (records or columnar) with column indexes built on the first query by the column.
+    Selected rows are returned in the format of the input.
+    Every filter call indexes its input again (templating hands a new copy of the table to each call),
+    which costs one pass over the table plus one pass per queried column. To look up many keys in a loop,
+    build the lookup once with srvrmgr_index_by or srvrmgr_group_by and index the result by key.
+    """
+
+    def __init__(self, in_data):
+        self.data = in_data
+        self.columnar = is_columnar(in_data)
+        if self.columnar:
+            self.columns = list(in_data['columns'])
+            self.rows = in_data['rows']
+        else:
+            columns = OrderedDict()
+            for rec in in_data:
+                for c in rec:
+                    columns.setdefault(c, None)
+            self.columns = list(columns)
+            self.rows = [[rec.get(c) for c in self.columns] for rec in in_data]
+        self.col_ndx = dict((c, ndx) for ndx, c in enumerate(self.columns))
+        self.indexes = {}
+        self.eq_indexes = {}
+
+    def index(self, columns):
+        """{value (tuple of values for several columns): [row numbers]}"""
+        columns = tuple(columns) if isinstance(columns, (list, tuple)) else (columns,)
+        if columns not in self.indexes:
+            ndxs = [self.col_ndx.get(c) for c in columns]
+            index = {}
+            for row_ndx, row in enumerate(self.rows):
+                values = tuple(row[ndx] if ndx is not None and ndx < len(row) else None for ndx in ndxs)
+                index.setdefault(values if len(values) > 1 else values[0], []).append(row_ndx)
+            self.indexes[columns] = index
+        return self.indexes[columns]
+
+    def eq_index(self, column):
+        """{value: [row numbers]} where numeric strings are stored as numbers."""
+        if column not in self.eq_indexes:
+            index = {}
+            for value, row_ndxs in self.index(column).items():
+                index.setdefault(as_number(value), []).extend(row_ndxs)
+            self.eq_indexes[column] = index
+        return self.eq_indexes[column]
+
+    def value(self, row_ndx, column):
+        ndx = self.col_ndx.get(column)
+        row = self.rows[row_ndx]
+        return row[ndx] if ndx is not None and ndx < len(row) else None
+
+    def select(self, conds):
+        """
+        Row numbers matching all conditions {column: value or list of values}.
+        Column may have suffix __ne, __gt, __ge, __lt, __le, numeric strings are compared as numbers.
+        Ordering operators never match empty or text values when compared with a number.
+        """
+        selected = None
+        scans = []
+        for key, value in (conds or {}).items():
+            column, _, op = key.partition('__')
+            if op and op not in OPERATORS:
+                raise AnsibleFilterError('Unknown operator "{0}" in condition "{1}"'.format(op, key))
+            if op in ('', 'eq'):
+                index = self.eq_index(column)
+                values = value if isinstance(value, (list, tuple)) else [value]
+                matched = set()
+                for v in values:
+                    matched.update(index.get(as_number(v), ()))
+                selected = matched if selected is None else selected & matched
+            else:
+                scans.append((column, op, value))
+        row_ndxs = sorted(selected) if selected is not None else range(len(self.rows))
+        if scans:
+            row_ndxs = [row_ndx for row_ndx in row_ndxs
+                        if all(compare(op, self.value(row_ndx, column), value) for column, op, value in scans)]
+        return list(row_ndxs)
+
+    def record(self, row_ndx):
+        if self.columnar:
+            return dict(zip(self.columns, self.rows[row_ndx]))
+        return self.data[row_ndx]
+
+    def table(self, row_ndxs):
+        if self.columnar:
+            return dict(columns=self.columns, rows=[self.rows[ndx] for ndx in row_ndxs])
+        return [self.data[ndx] for ndx in row_ndxs]
+
+
+def merge_conds(conds, kwargs):
+    merged = dict(conds or {})
+    merged.update(kwargs)
+    return merged
+
+
+def srvrmgr_where(in_data, conds=None, **kwargs):
+    """Rows matching all conditions: parsed | srvrmgr_where(SV_NAME='srv1', CP_MAX_TASKS__gt=10)"""
+    index = TableIndex(in_data)
+    return index.table(index.select(merge_conds(conds, kwargs)))
+
+
+def srvrmgr_group_by(in_data, column, conds=None, **kwargs):
+    """{value of column: rows}, rows can be filtered by conditions of srvrmgr_where."""
+    index = TableIndex(in_data)
+    selected = set(index.select(merge_conds(conds, kwargs))) if conds or kwargs else None
+    groups = {}
+    for value, row_ndxs in index.index(column).items():
+        if selected is not None:
+            row_ndxs = [ndx for ndx in row_ndxs if ndx in selected]
+        if row_ndxs:
+            groups[value] = index.table(row_ndxs)
+    return groups
+
+
+def srvrmgr_index_by(in_data, columns):
+    """{value of column (values of columns joined by "/"): record}, the first row wins for duplicate keys."""
+    index = TableIndex(in_data)
+    result = {}
+    for value, row_ndxs in index.index(columns).items():
+        key = '/'.join('{0}'.format(v) for v in value) if isinstance(value, tuple) else value
+        result[key] = index.record(row_ndxs[0])
+    return result
+
+
+def srvrmgr_count(in_data, column=None, conds=None, **kwargs):
+    """Number of rows matching conditions, or {value of column: number of rows} if column is given."""
+    index = TableIndex(in_data)
+    conds = merge_conds(conds, kwargs)
+    if column is None:
+        return len(index.select(conds)) if conds else len(index.rows)
+    selected = set(index.select(conds)) if conds else None
+    counts = {}
+    for value, row_ndxs in index.index(column).items():
+        count = len(row_ndxs) if selected is None else len([ndx for ndx in row_ndxs if ndx in selected])
+        if count:
+            counts[value] = count
+    return counts
+
+
+def srvrmgr_diff(old_data, new_data, key=None, columns=None):
+    """
+    Difference of two snapshots of a table by key columns (all columns by default).
+    Returns {added: [records], removed: [records], changed: [{key: {...}, changes: {column: {old, new}}}]}.
+    """
+    old_index, new_index = TableIndex(old_data), TableIndex(new_data)
+    key = [key] if isinstance(key, string_types) else list(key or old_index.columns)
+    columns = [c for c in (columns or OrderedDict.fromkeys(old_index.columns + new_index.columns)) if c not in key]
+    old_keys, new_keys = old_index.index(key), new_index.index(key)
+    result = dict(added=[new_index.record(ndxs[0]) for k, ndxs in new_keys.items() if k not in old_keys],
+                  removed=[old_index.record(ndxs[0]) for k, ndxs in old_keys.items() if k not in new_keys],
+                  changed=[])
+    for k, ndxs in new_keys.items():
+        if k not in old_keys:
+            continue
+        old_ndx = old_keys[k][0]
+        changes = dict((c, dict(old=old_index.value(old_ndx, c), new=new_index.value(ndxs[0], c))) for c in columns
+                       if old_index.value(old_ndx, c) != new_index.value(ndxs[0], c))
+        if changes:
+            values = k if isinstance(k, tuple) else (k,)
+            result['changed'].append(dict(key=dict(zip(key, values)), changes=changes))
+    return result
+
+
+def select_rows(in_data, column, values):
+    """Rows where column is one of values, parsed table is returned in the same format (records or columnar)."""
+    return srvrmgr_where(in_data, {column: list(values)})
+
+
+def to_records(in_data):
+    """Columnar table {columns, rows} as list of dictionaries, records are returned as is."""
+    if is_columnar(in_data):
+        return [dict(zip(in_data['columns'], r)) for r in in_data['rows']]
+    return in_data
+
 
 class FilterModule(object):
     def filters(self):
         return {
-            'comp_active': lambda in_data: [i for i in in_data if i['CP_DISP_RUN_STATE'] in ('Online', 'Running')]
+            'comp_active': lambda in_data: select_rows(in_data, 'CP_DISP_RUN_STATE', ('Online', 'Running')),
+            'srvrmgr_records': to_records,
+            'srvrmgr_where': srvrmgr_where,
+            'srvrmgr_group_by': srvrmgr_group_by,
+            'srvrmgr_index_by': srvrmgr_index_by,
+            'srvrmgr_count': srvrmgr_count,
+            'srvrmgr_diff': srvrmgr_diff,
         }
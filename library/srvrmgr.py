@@ -1,12 +1,28 @@
 #!/usr/bin/python
 # coding: utf-8
 
-from os import fstat, environ, path
-from re import findall, match
+import json
+import socket
+from fcntl import flock, LOCK_EX
+from hashlib import sha1
+from collections import deque, OrderedDict
+from itertools import groupby
+from os import chmod, close, closerange, devnull as devnull_path, dup2, environ, fdopen, fork, getpid, listdir, \
+    makedirs, path, pipe, rename, setsid, stat, sysconf, unlink, waitpid, open as open_fd, read as os_read, \
+    write as os_write, O_CREAT, O_RDWR, O_TRUNC, O_WRONLY, _exit
+from re import compile as re_compile, IGNORECASE, MULTILINE
+from select import select
 from subprocess import Popen, PIPE, check_output
-from time import sleep
+from tarfile import open as tar_open
+from tempfile import mkstemp
+from threading import Lock, Thread
+from time import time
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_bytes, to_native, to_text
+from ansible.module_utils.srvrmgr_checkpoint import CHECKPOINT_SUBDIR, file_digest, is_session_cmd, parse_checkpoint, \
+    stack_key
+from ansible.module_utils.srvrmgr_mask import MASK, SecretMasker
 
 ANSIBLE_METADATA = {
     'metadata_version': '1.0',
@@ -48,14 +64,177 @@ options:
     required: true
   sieb_gateway:
     description:
-        - Name of siebel gateway
+        - Name of siebel gateway, required without targets
     default: None
-    required: true
+    required: false
   sieb_enterprise:
     description:
-        - Name of siebel enterprise
+        - Name of siebel enterprise, required without targets
     default: None
-    required: true
+    required: false
+  targets:
+    description:
+        - List of targets {gateway, enterprise, user (optional)}. Command stack is executed against every target,
+          scripts are transferred and environment is prepared once. Results are returned in "targets" by
+          "gateway/enterprise" ("gateway/enterprise/user" for targets with user), a failed target does not stop
+          the others. Every target must be listed once.
+    default: None
+    required: false
+  target_workers:
+    description:
+        - Number of targets executed at the same time
+    default: 4
+    required: false
+  sieb_user:
+    description:
+        - Name of siebel user for srvrmgr login
+    default: sadmin
+    required: false
+  cmd_timeout:
+    description:
+        - Maximum number of seconds to wait for the output of one command. 0 means wait without limit
+    default: 0
+    required: false
+  persistent:
+    description:
+        - Keep srvrmgr session running on the target host and reuse it in next tasks with same sieb_path,
+          sieb_gateway, sieb_enterprise, sieb_user and add_env. Session is reached over a unix socket
+          and exits after session_ttl seconds without requests.
+    default: false
+    required: false
+  session_ttl:
+    description:
+        - Idle time in seconds after which persistent session exits
+    default: 600
+    required: false
+  session_dir:
+    description:
+        - Directory for sockets of persistent sessions
+    default: ~/.ansible/srvrmgr
+    required: false
+  parallel:
+    description:
+        - Number of srvrmgr sessions for command stack execution. Scripts of one directory (task numbers N.x)
+          are executed in parallel over the sessions, other steps are executed one after another in the first
+          session. Results are returned in the original order. Commands changing session state (e.g. "set server")
+          affect only the first session.
+    default: 1
+    required: false
+  columns:
+    description:
+        - List of columns kept in parsed rows of list commands output
+    default: None
+    required: false
+  where:
+    description:
+        - Dictionary {column: value or list of values}, only parsed rows matching all columns are returned.
+          Use with parsed_only to avoid raw copies of the whole output.
+    default: None
+    required: false
+  parsed_only:
+    description:
+        - Return only "parsed" block of command output, without "raw" and "lines" copies.
+          Blocks "err" and "warn" are returned in full.
+    default: false
+    required: false
+  result_format:
+    description:
+        - Format of parsed tables (list commands output). "records" is a list of dictionaries {column: value}.
+          "columnar" is {columns: [names], rows: [[values], ...]}, column names are not repeated in every row.
+          Filters of filter_plugins/srvrmgr_filters.py accept both formats.
+    choices: [ 'records', 'columnar' ]
+    default: records
+    required: false
+  coerce_types:
+    description:
+        - Convert columns of parsed tables where all values are numbers (counts, PIDs, ...) to int or float,
+          empty values of such columns become null. A value with leading zeros (e.g. numeric ID "0012")
+          keeps its column as text.
+    default: false
+    required: false
+  pipeline:
+    description:
+        - Number of commands written ahead to one srvrmgr session, output is split back by prompts.
+          Cuts round trips on long stacks of quick commands. 1 switches pipelining off.
+          Output is split at prompts followed by a line break, which assumes that srvrmgr does not echo commands
+          read from stdin after the prompt. Output with an echoed command fails the task with a hint to set
+          pipeline to 1. Only "list" and "help" commands are written ahead, other commands are written to an idle
+          session, so no command runs after a failed one. Errors (stderr) are not split by prompts: if stderr is
+          read while commands are written ahead, their outputs are dropped and they are run again one by one.
+    default: 1
+    required: false
+  progress_file:
+    description:
+        - File on the target, short result of every finished command (cmd, err, warn, timing) is appended to it
+          as one JSON line. Set by action plugin for async tasks with poll > 0 to show progress of commands while
+          they run, the plugin removes the file when the job finishes. The module does not remove it.
+    default: None
+    required: false
+  resume:
+    description:
+        - Record indices of completed tasks in a checkpoint file on the target and skip them when the same
+          stack is started again after a failure. Stack is identified by gateway, enterprise, commands and
+          content of scripts. Checkpoint is removed when the whole stack succeeds.
+          Skipped task indices are returned in "skipped_steps". Checkpoints are kept in session_dir/checkpoints.
+          "set" and "unset" commands are never skipped, they are run again to restore state of the session.
+    default: false
+    required: false
+  diff_params:
+    description:
+        - Apply only changed parameters. Current values of every scope of "change param Name=Value for <scope>"
+          commands are listed once ("list params for <scope> show PA_ALIAS, PA_VALUE"), assignments equal to
+          them are removed and commands without changes are not executed. Changes are returned in "param_diff"
+          and in diff mode. Commands after "set", "unset" or a script and commands of scripts are not diffed.
+          "changed" is true only if commands other than "list", "help", "set" and "unset" are executed.
+          In check mode only the queries, other read-only commands and "set" / "unset" (for the session state of
+          the queries) are executed, commands which would run are returned in "check_skipped".
+    default: false
+    required: false
+  checkpoint_key:
+    description:
+        - Key of the stack checkpoint. Set by action plugin, which skips upload of scripts completed before.
+    default: None
+    required: false
+  profile:
+    description:
+        - Add "timing" to every command result (queue wait, time to first byte, total time in seconds,
+          bytes read, parsed rows) and run phases (env, login, commands, teardown) to "profile" of the result.
+    default: false
+    required: false
+  max_output_bytes:
+    description:
+        - Maximum size of output of one command kept in memory and returned. Only the first and the last
+          max_output_bytes / 2 bytes are returned in "raw" and "lines", "parsed" has rows (lines) of the
+          first max_output_bytes bytes. Such results have "truncated" and full "size" (in bytes) in "out".
+          stderr of a command is limited the same way. 0 means no limit.
+    default: 0
+    required: false
+  spool_output:
+    description:
+        - With max_output_bytes the whole (masked) output of truncated commands is written to a spool file
+          in session_dir/spool on the target, its path is returned in "spool" of "out".
+          Set fetch_spool of the task to copy spool files to the controller, they are removed from the target then.
+          Spool files which are not fetched are removed by the first task with spool_output a day later.
+    default: false
+    required: false
+  scripts_archive:
+    description:
+        - Archive with scripts, it is extracted into its directory before execution.
+          Set by action plugin, scripts are transferred in one archive instead of file by file.
+    default: None
+    required: false
+  scripts_dir:
+    description:
+        - Directory for extraction of scripts_archive. Set by action plugin to the remote script cache
+          when script_cache parameter of the task is defined.
+    default: None
+    required: false
+  refresh_env:
+    description:
+        - Rebuild cached environment of siebenv.sh. The environment is cached in ~/.cache/ansible-srvrmgr and
+          rebuilt automatically when siebenv.sh or a script sourced by it is changed.
+    default: false
+    required: false
   skip_errors:
     description:
         - List error codes for skipping
@@ -79,6 +258,16 @@ EXAMPLES = '''
       sieb_enterprise: 'CRM_ENTERPRISE'
       creds: { sadmin_pw: 'secrep_sadmin_password' }
       skip_errors: ['SBL-ADM-01067','SBL-ADM-01049']
+
+# Scripts are cached on the target by content hash, only new or changed scripts are transferred.
+# Cached scripts not used for 30 days are removed.
+    srvrmgr:
+      cmd_stack: [ "/srvrmgr_scripts_dir" ]
+      script_cache: '~/.ansible/srvrmgr/scripts'
+      sieb_path: '/siebel/siebsrvr'
+      sieb_gateway: 'test_siebel_gw'
+      sieb_enterprise: 'CRM_ENTERPRISE'
+      creds: { sadmin_pw: 'secrep_sadmin_password' }
       
 # Simple example
     srvrmgr:
@@ -88,6 +277,61 @@ EXAMPLES = '''
       sieb_gateway: 'test_siebel_gw'
       sieb_enterprise: 'CRM_ENTERPRISE'
       creds: { sadmin_pw: 'secrep_sadmin_password', other: ['another_sec_data'] }
+
+# Reuse one logged in srvrmgr session in several tasks
+    srvrmgr:
+      cmd_stack: [ "list comp" ]
+      sieb_path: '/siebel/siebsrvr'
+      sieb_gateway: 'test_siebel_gw'
+      sieb_enterprise: 'CRM_ENTERPRISE'
+      creds: { sadmin_pw: 'secrep_sadmin_password' }
+      parsed_only: true
+      columns: [ 'SV_NAME', 'CC_ALIAS', 'CP_DISP_RUN_STATE' ]
+      where: { CP_DISP_RUN_STATE: [ 'Online', 'Running' ] }
+      persistent: true
+      session_ttl: 300
+
+# Health check of several enterprises in one task
+    srvrmgr:
+      cmd_stack: [ "list comp" ]
+      sieb_path: '/siebel/siebsrvr'
+      targets:
+        - { gateway: 'gw1', enterprise: 'CRM_ENTERPRISE' }
+        - { gateway: 'gw2', enterprise: 'CRM_ENTERPRISE_2', user: 'sadmin2' }
+      target_workers: 2
+      creds: { sadmin_pw: 'secrep_sadmin_password' }
+      parsed_only: true
+
+# Change only parameters which differ from current values, check mode shows the same diff
+    srvrmgr:
+      cmd_stack: [ "change param MaxTasks=100,MinMTServers=2 for comp EAIObjMgr_enu server srv1",
+                   "change param MaxTasks=50 for comp SCBroker server srv1" ]
+      sieb_path: '/siebel/siebsrvr'
+      sieb_gateway: 'test_siebel_gw'
+      sieb_enterprise: 'CRM_ENTERPRISE'
+      creds: { sadmin_pw: 'secrep_sadmin_password' }
+      diff_params: true
+
+# Large output is not kept in memory, full output is copied to the controller
+    srvrmgr:
+      cmd_stack: [ "list events" ]
+      sieb_path: '/siebel/siebsrvr'
+      sieb_gateway: 'test_siebel_gw'
+      sieb_enterprise: 'CRM_ENTERPRISE'
+      creds: { sadmin_pw: 'secrep_sadmin_password' }
+      max_output_bytes: 1048576
+      spool_output: true
+      fetch_spool: '~/srvrmgr_spool'
+
+# Print timing of commands and append it to a profile file on the controller (*.csv or JSON lines)
+    srvrmgr:
+      cmd_stack: [ "/srvrmgr_scripts_dir" ]
+      sieb_path: '/siebel/siebsrvr'
+      sieb_gateway: 'test_siebel_gw'
+      sieb_enterprise: 'CRM_ENTERPRISE'
+      creds: { sadmin_pw: 'secrep_sadmin_password' }
+      profile: true
+      profile_file: '~/srvrmgr_profile.csv'
 '''
 
 RETURN = '''
@@ -97,7 +341,10 @@ RETURN = '''
              "out": {
                  "lines": [], 
                  "parsed": [], 
-                 "raw": ""
+                 "raw": "",
+                 "truncated": true,
+                 "size": 0,
+                 "spool": ""
              },
              "err": {
                  "lines": [], 
@@ -108,100 +355,1353 @@ RETURN = '''
                  "lines": [], 
                  "parsed": [], 
                  "raw": ""
+             },
+             "timing": {
+                 "queue": 0.0,
+                 "first_byte": 0.0,
+                 "total": 0.0,
+                 "bytes": 0,
+                 "rows": 0
              }
          }, 
      ]
+"profile": { "env": 0.0, "login": 0.0, "commands": 0.0, "teardown": 0.0 }
+"param_diff": [ { "scope": "comp SCBroker server srv1", "param": "MaxTasks", "before": "20", "after": "50" } ]
+"check_skipped": [ "change param MaxTasks=50 for comp SCBroker server srv1" ]
      
-WARNING! Blocks "err" and "warn", returns only if exists them.
+With targets every target result is returned in "targets": { "gateway/enterprise": { "results": [], "failed": ... } },
+ the key of a target with user is "gateway/enterprise/user".
+WARNING! Block "timing" and "profile" are returned only with profile: true, "param_diff" only with diff_params: true,
+ "check_skipped" only in check mode.
+ "truncated", "size" and "spool" of "out" are returned only for output larger than max_output_bytes.
+ Blocks "err" and "warn", returns only if exists them.
+In persistent mode login result is returned only by the task which started the session, "quit" is never returned.
 '''
 
 
-def parse_data(data):
-    result = tuple()
-    if len(data.strip()) > 0:
-        if data.split()[0].strip() == 'Password:':
-            ud = match(r'Connected to (?P<available_servers>\d+).*total of (?P<total_servers>\d+)',
-                       data.split('\n')[-2])
-            if ud:
-                result += (ud.groupdict(),)
-        elif '^$^' in data:
-            ud = filter(len, map(str.strip, data.split('\n')))
-            fields = tuple(filter(len, map(str.strip, ud[0].split('^$^'))))
-            for line_ndx in range(2, len(ud) - 1):
-                result += (dict(zip(fields, map(str.strip, ud[line_ndx].split("^$^")))),)
+LOGIN_RE = re_compile(r'Connected to (?P<available_servers>\d+).*total of (?P<total_servers>\d+)')
+PROMPT_LINE_RE = re_compile(r'^srvrmgr(?::[^>\n]*)?> $')
+
+
+# numbers with leading zeros are IDs or names, their text would be lost by conversion
+INT_RE = re_compile(r'^-?(?:0|[1-9]\d*)$')
+NUM_RE = re_compile(r'^-?(?:(?:0|[1-9]\d*)(?:\.\d*)?|\.\d+)$')
+
+
+def coerce_rows(rows, width):
+    """Converts columns where all non-empty values are numbers to int or float, empty values become None."""
+    for ndx in range(width):
+        values = [row[ndx] for row in rows if ndx < len(row) and row[ndx] not in ('', None)]
+        if not values or not all(NUM_RE.match(v) for v in values):
+            continue
+        conv = int if all(INT_RE.match(v) for v in values) else float
+        for row in rows:
+            if ndx < len(row):
+                row[ndx] = conv(row[ndx]) if row[ndx] not in ('', None) else None
+
+
+class OutputParser(object):
+    """
+    Incremental parser of srvrmgr output. Rows of "^$^" delimited lists are turned into records
+    while output is being read, the last line ("N rows returned.") is never emitted.
+    Rows can be filtered by where ({column: [values]}) and projected to columns.
+    With result_format 'columnar' tables are returned as {columns: [...], rows: [[...], ...]},
+    coerce converts numeric columns to numbers.
+    With limit only rows (lines) of the first limit bytes are kept, truncated is set if others are dropped.
+    """
+
+    def __init__(self, columns=None, where=None, result_format=None, coerce=False, limit=0):
+        self.result_format = result_format or 'records'
+        self.coerce = coerce
+        self.limit = limit or 0
+        self.kept = 0
+        self.truncated = False
+        self.rows = []
+        self.columns = columns
+        self.where = dict((k, set(to_native(v) for v in (vals if isinstance(vals, list) else [vals])))
+                          for k, vals in (where or {}).items())
+        self.columns_ndx = None
+        self.where_ndx = []
+        self.parsed = []
+        self.size = 0
+        self.mode = None
+        self.fields = None
+        self.lines = []
+        self.row_ndx = 0
+        self.pending = None
+        self.rest = ''
+
+    def feed(self, data):
+        self.size += len(to_bytes(data, errors='surrogate_or_strict'))
+        lines = (self.rest + data).split('\n')
+        self.rest = lines.pop()
+        for line in lines:
+            self.feed_line(line)
+
+    def feed_line(self, line):
+        s_line = line.strip()
+        if not s_line:
+            if line and self.mode == 'lines':
+                self.lines.append(line)
+            return
+        if self.mode is None:
+            if s_line.split()[0] == 'Password:':
+                self.mode = 'login'
+            elif '^$^' in s_line:
+                self.mode = 'table'
+            else:
+                self.mode = 'lines'
+
+        if self.mode == 'table':
+            if self.row_ndx == 0:
+                self.set_fields(tuple(f for f in (f.strip() for f in s_line.split('^$^')) if f))
+            elif self.row_ndx > 1:
+                if self.pending is not None:
+                    self.add_row(self.pending)
+                self.pending = s_line
+            self.row_ndx += 1
+        elif self.mode == 'login':
+            self.pending = line
+        elif self.keep(line):
+            self.lines.append(line)
+
+    def keep(self, line):
+        if self.limit:
+            size = len(to_bytes(line, errors='surrogate_or_strict'))
+            if self.kept + size > self.limit:
+                self.truncated = True
+                return False
+            self.kept += size
+        return True
+
+    def set_fields(self, fields):
+        self.fields = fields
+        if self.columns:
+            self.columns_ndx = [(c, fields.index(c)) for c in self.columns if c in fields]
+        self.where_ndx = [(fields.index(c) if c in fields else None, vals) for c, vals in self.where.items()]
+
+    def add_row(self, line):
+        values = [v.strip() for v in line.split('^$^')]
+        for ndx, vals in self.where_ndx:
+            if ndx is None or ndx >= len(values) or values[ndx] not in vals:
+                return
+        if not self.keep(line):
+            return
+        if self.columns_ndx is None:
+            self.rows.append(values[:len(self.fields)])
         else:
-            result = tuple(filter(len, data.split('\n')))
-    return result
+            self.rows.append([values[ndx] if ndx < len(values) else None for c, ndx in self.columns_ndx])
+
+    def table(self):
+        """Parsed table in the requested format."""
+        fields = list(self.fields) if self.columns_ndx is None else [c for c, ndx in self.columns_ndx]
+        if self.coerce:
+            coerce_rows(self.rows, len(fields))
+        if self.result_format == 'columnar':
+            width = len(fields)
+            return dict(columns=fields, rows=[row + [None] * (width - len(row)) for row in self.rows])
+        return [dict((c, v) for c, v in zip(fields, row) if v is not None or self.coerce) for row in self.rows]
+
+    def finish(self):
+        if PROMPT_LINE_RE.match(self.rest):
+            # prompt and line break before it are not a part of command output
+            self.size = max(self.size - len(to_bytes(self.rest, errors='surrogate_or_strict')) - 1, 0)
+        elif self.rest:
+            self.feed_line(self.rest)
+        self.rest = ''
+        if self.mode == 'login':
+            ud = LOGIN_RE.match(self.pending or '')
+            if ud:
+                self.parsed.append(ud.groupdict())
+        elif self.mode == 'lines':
+            if any('^$^' in line for line in self.lines):
+                # header is not the first line, the list is parsed as a whole like before
+                lines, self.lines, self.mode, self.kept = self.lines, [], 'table', 0
+                for line in lines:
+                    self.feed_line(line)
+            else:
+                self.parsed = self.lines
+        if self.mode == 'table' and self.fields is not None:
+            self.parsed = self.table()
+        return self.parsed
+
+
+def parse_data(data):
+    parser = OutputParser()
+    parser.feed(data)
+    return parser.finish()
+
+
+def utf8_head(data):
+    """Cuts an incomplete UTF-8 sequence at the end of data."""
+    for ndx in range(len(data) - 1, max(len(data) - 4, -1), -1):
+        byte = ord(data[ndx:ndx + 1])
+        if byte < 0x80:
+            return data
+        if byte >= 0xC0:
+            return data if len(data) - ndx >= (2 if byte < 0xE0 else 3 if byte < 0xF0 else 4) else data[:ndx]
+    return data
+
+
+def utf8_tail(data):
+    """Cuts continuation bytes of a UTF-8 sequence started before data."""
+    ndx = 0
+    while ndx < min(len(data), 3) and 0x80 <= ord(data[ndx:ndx + 1]) < 0xC0:
+        ndx += 1
+    return data[ndx:]
+
+
+class OutputBuffer(object):
+    """
+    Buffer of command output. Without limit the whole output is kept in memory.
+    With limit only the first and the last limit / 2 bytes are kept, the whole output is written
+    to a spool file in spool_dir (if it is given) as soon as it exceeds the limit.
+    """
+
+    def __init__(self, limit=0, spool_dir=None):
+        self.limit = limit or 0
+        self.spool_dir = spool_dir
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.size = 0
+        self.spool = None
+        self.spool_path = None
+
+    @property
+    def truncated(self):
+        return bool(self.limit) and self.size > self.limit
+
+    def write(self, data):
+        if not data:
+            return
+        if not self.limit:
+            self.size += len(data)
+            self.head.append(data)
+            return
+        data = to_bytes(data, errors='surrogate_or_strict')
+        self.size += len(data)
+        if self.spool is None and self.spool_dir and self.truncated:
+            self.open_spool()
+        if self.spool is not None:
+            self.spool.write(data)
+        free = self.limit // 2 - self.head_size
+        if free > 0:
+            self.head.append(data[:free])
+            self.head_size += len(data[:free])
+            data = data[free:]
+        if data:
+            self.tail.append(data)
+            self.tail_size += len(data)
+            tail_limit = self.limit - self.limit // 2
+            while self.tail_size > tail_limit:
+                first = self.tail.popleft()
+                cut = min(len(first), self.tail_size - tail_limit)
+                self.tail_size -= cut
+                if cut < len(first):
+                    self.tail.appendleft(first[cut:])
+
+    def open_spool(self):
+        """Spool file gets output buffered so far, nothing is dropped before the limit is exceeded."""
+        try:
+            makedirs(self.spool_dir, 0o700)
+        except OSError:
+            if not path.isdir(self.spool_dir):
+                raise
+        spool_fd, self.spool_path = mkstemp(prefix='srvrmgr_', suffix='.out', dir=self.spool_dir)
+        self.spool = fdopen(spool_fd, 'wb')
+        for chunk in list(self.head) + list(self.tail):
+            self.spool.write(chunk)
+
+    def value(self):
+        if not self.limit:
+            return ''.join(self.head)
+        head, tail = b''.join(self.head), b''.join(self.tail)
+        if not self.truncated:
+            return to_native(head + tail, errors='surrogate_or_strict')
+        head, tail = utf8_head(head), utf8_tail(tail)
+        return '{0}\n... {1} bytes truncated ...\n{2}'.format(to_native(head, errors='surrogate_or_strict'),
+                                                               self.size - len(head) - len(tail),
+                                                               to_native(tail, errors='surrogate_or_strict'))
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
+
+ENV_EXCLUDED = frozenset(['_', 'EDITOR', 'ENV', 'FCEDIT', 'HISTCMD', 'HOME', 'IFS', 'JOBMAX', 'KSH_VERSION',
+                          'LINENO', 'LOGNAME', 'MAIL', 'MAILCHECK', 'OLDPWD', 'OPTIND', 'PPID', 'PWD', 'RANDOM',
+                          'SECONDS', 'SHELL', 'SHLVL', 'TERM', 'TMOUT', 'TZ', 'USER'])
+ENV_CACHE_DIR = path.join(environ.get('XDG_CACHE_HOME', '~/.cache'), 'ansible-srvrmgr')
+PARAM_RE = re_compile(r'\$(?:\{(\w+)\}|(\w+))')
+SOURCE_RE = re_compile(r'^\s*(?:\.|source)\s+["\']?([^\s;"\']+)', MULTILINE)
+PS_RE = re_compile(r'PS\d')
+
+
+def source_siebenv(siebenv_path):
+    siebenv_sh = to_native(check_output('. ' + siebenv_path + '; set', bufsize=-1, shell=True),
+                           errors='surrogate_or_strict')
+    sieb_env = {}
+    for env_var in siebenv_sh.split('\n'):
+        if '=' in env_var:
+            var_name, var_value = env_var.split('=', 1)
+            if var_name not in ENV_EXCLUDED and var_name[:4] != 'SSH_' and not PS_RE.search(var_name):
+                if len(var_value) > 1 and var_value[0] == var_value[-1] == "'":
+                    var_value = var_value[1:-1].replace("'\\''", "'")
+                sieb_env[var_name] = var_value
+    return sieb_env
+
+
+def env_deps(siebenv_path, sieb_env):
+    """Returns [path, mtime, size] of siebenv.sh and the scripts sourced by it (paths expanded with its result)."""
+    deps, pending = [], [siebenv_path]
+    while pending:
+        dep = path.abspath(pending.pop(0))
+        if dep in [d[0] for d in deps] or not path.isfile(dep):
+            continue
+        st = stat(dep)
+        deps.append([dep, st.st_mtime, st.st_size])
+        try:
+            with open(dep) as dep_f:
+                sourced = SOURCE_RE.findall(dep_f.read())
+        except IOError:
+            continue
+        for src in sourced:
+            src = PARAM_RE.sub(lambda m: sieb_env.get(m.group(1) or m.group(2), m.group(0)), src)
+            if '$' not in src:
+                pending.append(path.join(path.dirname(dep), src))
+    return deps
+
+
+def deps_changed(deps):
+    for dep, mtime, size in deps:
+        try:
+            st = stat(dep)
+        except OSError:
+            return True
+        if st.st_mtime != mtime or st.st_size != size:
+            return True
+    return False
+
+
+def load_siebenv(sieb_path, refresh=False):
+    """Returns environment of siebenv.sh, cached until siebenv.sh or anything sourced by it is changed."""
+    siebenv_path = path.abspath(path.join(sieb_path, 'siebenv.sh'))
+    cache_dir = path.expanduser(ENV_CACHE_DIR)
+    cache_path = path.join(cache_dir, 'env_{0}.json'.format(sha1(to_bytes(siebenv_path)).hexdigest()[:20]))
+
+    if not refresh and path.isfile(cache_path):
+        try:
+            with open(cache_path) as cache_f:
+                cached = json.load(cache_f)
+            if cached['siebenv'] == siebenv_path and not deps_changed(cached['deps']):
+                return cached['env']
+        except (IOError, ValueError, KeyError):
+            pass
 
+    sieb_env = source_siebenv(siebenv_path)
+    try:
+        if not path.isdir(cache_dir):
+            makedirs(cache_dir, 0o700)
+        tmp_path = '{0}.{1}'.format(cache_path, getpid())
+        with fdopen(open_fd(tmp_path, O_WRONLY | O_CREAT | O_TRUNC, 0o600), 'w') as cache_f:
+            json.dump(dict(siebenv=siebenv_path, deps=env_deps(siebenv_path, sieb_env), env=sieb_env), cache_f)
+        rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        pass
+    return sieb_env
 
-def prepare_env(sieb_path, add_env=None):
+
+def prepare_env(sieb_path, add_env=None, refresh=False):
     res_env = environ.copy()
     res_env['NLS_LANG'] = "AMERICAN_AMERICA.AL32UTF8"
     res_env['SIEBEL_DEBUG_FLAGS'] = "16"
-    siebenv_sh = check_output('. ' + path.join(sieb_path, 'siebenv.sh') + '; set',
-                              bufsize=-1, shell=True)
-    for env_var in siebenv_sh.split('\n'):
-        if '=' in env_var:
-            var_name, var_value = env_var.split('=')
-            if var_name not in ['_', 'EDITOR', 'ENV', 'FCEDIT', 'HISTCMD', 'HOME', 'IFS', 'JOBMAX', 'KSH_VERSION',
-                                'LINENO', 'LOGNAME', 'MAIL', 'MAILCHECK', 'OLDPWD', 'OPTIND', 'PPID', 'PWD', 'RANDOM',
-                                'SECONDS', 'SHELL', 'SHLVL', 'TERM', 'TMOUT', 'TZ', 'USER'] \
-                    and var_name[:4] != 'SSH_' \
-                    and len(findall(r'PS\d', var_name)) == 0:
-                res_env[var_name] = var_value
+    res_env.update(load_siebenv(sieb_path, refresh))
 
     if add_env:
-        res_env.update({k: unicode(v) for k, v in add_env.items()})
+        res_env.update({k: to_text(v) for k, v in add_env.items()})
 
     return res_env
 
 
-def exec_cmd(srvrmgr_pipe, stdin_cmd, skip_errors_lst, sadmin_pwd):
-    def get_proc_data(trg):
-        res_data = ""
-        trg_size = fstat(trg.fileno()).st_size
-        while trg_size > 0:
-            res_data += trg.read(trg_size)
-            sleep(1)
-            trg_size = fstat(trg.fileno()).st_size
-        trg.flush()
-        return res_data
+PROMPT_RE = re_compile(r'\nsrvrmgr(?::[^>\n]*)?> $')
+# prompt followed by output of the next command written ahead
+PROMPT_NEXT_RE = re_compile(r'\nsrvrmgr(?::[^>\n]*)?> (?=\n|$)')
+# command echoed after the prompt, output of commands written ahead can not be split by prompts then
+PROMPT_ECHO_RE = re_compile(r'\nsrvrmgr(?::[^>\n]*)?> [^\n]')
+PIPELINE_CMDS = ('list', 'help')
+# returned by run_one for a result with stderr read while commands are written ahead
+STDERR_AHEAD = (None, 'stderr read with commands written ahead')
+CHANGE_PARAM_RE = re_compile(r'^\s*change\s+param\s+(?P<assigns>.+?)\s+for\s+(?P<scope>.+?)\s*$', IGNORECASE)
+ASSIGN_RE = re_compile(r'\s*(?P<name>[\w.]+)\s*=\s*(?P<value>"[^"]*"|\'[^\']*\'|[^,]*?)\s*(?:,|$)')
+PARAM_QUERY = 'list params for {0} show PA_ALIAS, PA_VALUE'
+# commands after which current parameters of a scope can not be known in advance
+DIFF_BARRIER_CMDS = ('set', 'unset', 'read')
+READ_SIZE = 65536
+SESSION_DIR = '~/.ansible/srvrmgr'
+SPOOL_SUBDIR = 'spool'
+# spool files not fetched by the action plugin are removed after this time (seconds)
+SPOOL_TTL = 86400
+# parameters of the task used by commands execution in persistent session
+REQUEST_PARAMS = ['creds', 'skip_errors', 'cmd_timeout', 'parsed_only', 'columns', 'where', 'profile', 'pipeline',
+                  'progress_file', 'checkpoint_file', 'target', 'result_format', 'coerce_types',
+                  'max_output_bytes', 'spool_output', 'session_dir']
+MASKERS = {}
+PROGRESS_LOCK = Lock()
+
+
+def read_output(srvrmgr_pipe, timeout=0, out_sinks=(), masker=None, stats=None, carry=None, err_buf=None):
+    """
+    Reads srvrmgr output up to the next prompt, draining stderr at the same time.
+    Output is masked before it is buffered, masked stdout is passed to out_sinks as it arrives,
+    masked stderr is kept in err_buf (OutputBuffer, unbounded by default) and returned.
+    Time of the first byte and number of bytes read are stored in stats dict if it is given.
+    carry is a list with stdout already read past the previous prompt when commands are written ahead,
+    output after the prompt is stored back to it.
+    """
+    stats = {} if stats is None else stats
+    stats['bytes'] = 0
+    out_fd, err_fd = srvrmgr_pipe.stdout.fileno(), srvrmgr_pipe.stderr.fileno()
+    masker = masker or SecretMasker({})
+    streams = {out_fd: masker.stream(), err_fd: masker.stream()}
+    err_buf = OutputBuffer() if err_buf is None else err_buf
+    opened = [out_fd, err_fd]
+    deadline = time() + timeout if timeout else None
+    out_tail = ''
+    prompt_found = False
+    queued = carry.pop() if carry else ''
+
+    while out_fd in opened and not prompt_found:
+        if queued:
+            ready = [out_fd]
+        else:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time()
+                if wait <= 0:
+                    raise RuntimeError('Timeout: no srvrmgr prompt after {0} seconds'.format(timeout))
+            ready = select(opened, [], [], wait)[0]
+        for fd in ready:
+            if fd == out_fd and queued:
+                data, queued = queued, ''
+            else:
+                data = to_native(os_read(fd, READ_SIZE), errors='surrogate_or_strict')
+            if not data:
+                opened.remove(fd)
+                continue
+            stats.setdefault('first_byte', time())
+            if fd == out_fd and carry is not None:
+                # output of a command starts with a line break after the prompt of the previous one
+                if (not out_tail and not data.startswith('\n')) or PROMPT_ECHO_RE.search(out_tail + data):
+                    raise RuntimeError('srvrmgr echoes commands after the prompt, set pipeline to 1')
+                found = PROMPT_NEXT_RE.search(out_tail + data)
+                if found:
+                    cut = found.end() - len(out_tail)
+                    data, queued = data[:cut], data[cut:]
+            stats['bytes'] += len(data)
+            masked = streams[fd].feed(data)
+            if fd == out_fd:
+                out_tail = (out_tail + data)[-256:]
+                prompt_found = PROMPT_RE.search(out_tail) is not None
+                if prompt_found:
+                    masked += streams[fd].flush()
+                for sink in out_sinks:
+                    sink(masked)
+            else:
+                err_buf.write(masked)
+
+    # stderr is unbuffered, so everything written before the prompt is already in the pipe
+    while err_fd in opened and select([err_fd], [], [], 0)[0]:
+        data = to_native(os_read(err_fd, READ_SIZE), errors='surrogate_or_strict')
+        if not data:
+            break
+        stats['bytes'] += len(data)
+        err_buf.write(streams[err_fd].feed(data))
 
+    for sink in out_sinks:
+        sink(streams[out_fd].flush())
+    err_buf.write(streams[err_fd].flush())
+    if carry is not None:
+        carry.append(queued)
+    return err_buf.value()
+
+
+def exec_cmd(srvrmgr_pipe, stdin_cmd, skip_errors_lst, masker, timeout=0, keep_raw=True, parser=None, stats=None,
+             carry=None, sent_at=None, max_bytes=0, spool_dir=None):
+    """
+    Executes one command. Output is masked and parsed while it is read, raw output is kept only if keep_raw is set.
+    If sent_at is given, the command is already written ahead at that time and only its output is read.
+    With max_bytes only head and tail of raw output and of stderr are kept, the whole output is spooled to spool_dir
+    if it is given.
+    Returns dict with raw 'out', 'err', 'warn', parsed output 'out_parsed', its size 'out_size',
+    'out_truncated' and 'out_spool' (path of spool file or None).
+    """
     result = {'out': '', 'err': '', 'warn': ''}
-    srvrmgr_pipe.stdin.write(b'{0}\n'.format(stdin_cmd))
-    srvrmgr_pipe.stdin.flush()
-    output_size = 0
-    while output_size == 0:
-        print("Waiting for output...")
-        sleep(1)
-        output_size = fstat(srvrmgr_pipe.stdout.fileno()).st_size
+    out_buf = OutputBuffer(max_bytes, spool_dir)
+    parser = parser or OutputParser()
+    stats = {} if stats is None else stats
+    if sent_at is None:
+        stats['start'] = time()
+        os_write(srvrmgr_pipe.stdin.fileno(), to_bytes('{0}\n'.format(stdin_cmd)))
+    else:
+        stats['start'] = sent_at
+    try:
+        err = read_output(srvrmgr_pipe, timeout, (parser.feed, out_buf.write) if keep_raw or spool_dir
+                          else (parser.feed,), masker, stats, carry, OutputBuffer(max_bytes))
+    finally:
+        out_buf.close()
 
-    result['out'] = get_proc_data(srvrmgr_pipe.stdout).replace('\nsrvrmgr> ', '').replace(sadmin_pwd, "*" * 6)
-    result['err'] = get_proc_data(srvrmgr_pipe.stderr).replace(sadmin_pwd, "*" * 6)
+    result['out_parsed'] = parser.finish()
+    result['out_size'] = parser.size
+    result['out_truncated'] = bool(max_bytes) and parser.size > max_bytes
+    result['out_spool'] = out_buf.spool_path
+    result['out'] = PROMPT_RE.sub('', out_buf.value()) if keep_raw else ''
+    result['err'] = err
+    stats['end'] = time()
 
     if any(map(lambda x: x in result['err'], skip_errors_lst)):
         result['err'], result['warn'] = result['warn'], result['err']
     return result
 
 
-def sec_clean(data, sec_data):
-    def clean_data(sc_data, sec_str, mask='******'):
-        if type(sc_data) is unicode or type(sc_data) is str:
-            return sc_data.replace(sec_str, mask)
-        elif type(sc_data) is list:
-            return [clean_data(l, sec_str, mask) for l in sc_data]
-        elif type(sc_data) is dict:
-            for i in sc_data:
-                sc_data[i] = clean_data(sc_data[i], sec_str, mask)
-            return sc_data
+def masker_for(creds, pw_mask=MASK):
+    """Returns compiled SecretMasker for the credentials, maskers are shared by commands and sessions."""
+    key = (json.dumps(creds, sort_keys=True), pw_mask)
+    if key not in MASKERS:
+        MASKERS[key] = SecretMasker(creds, pw_mask)
+    return MASKERS[key]
+
+
+def unpack_scripts(archive, dest=None):
+    """Extracts scripts transferred by the action plugin in one archive to dest (next to the archive by default)."""
+    dest = dest or path.dirname(archive)
+    if not path.isdir(dest):
+        makedirs(dest, 0o700)
+    arc = tar_open(archive)
+    try:
+        members = arc.getmembers()
+        for member in members:
+            if not member.isfile() or path.isabs(member.name) or '..' in member.name.split('/'):
+                raise RuntimeError('Unexpected member of scripts archive: {0}'.format(member.name))
+        arc.extractall(dest, members)
+    finally:
+        arc.close()
+    unlink(archive)
+
+
+def spawn_srvrmgr(params, env):
+    return Popen(args=['srvrmgr', '-g', params['sieb_gateway'], '-e', params['sieb_enterprise'],
+                       '-u', params['sieb_user'] or 'sadmin', '-k', '^$^'],
+                 stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=-1, shell=False, close_fds=True, env=env)
+
+
+def parsed_rows(parsed):
+    return len(parsed['rows']) if isinstance(parsed, dict) and 'rows' in parsed else len(parsed)
+
+
+def cmd_timing(stats, queued_at, rows):
+    return dict(queue=round(stats['start'] - queued_at, 3),
+                first_byte=round(stats['first_byte'] - stats['start'], 3) if 'first_byte' in stats else None,
+                total=round(stats['end'] - stats['start'], 3),
+                bytes=stats['bytes'],
+                rows=rows)
+
+
+def result_cmd(cmd, params):
+    """Command as it is shown in results: name of a script or masked command."""
+    if cmd.split()[0] == 'read':
+        return path.basename(cmd.split()[1])
+    return masker_for(params['creds'], 'Authorization').mask_str(cmd)
+
+
+def spool_path(params):
+    return path.join(path.expanduser(params.get('session_dir') or SESSION_DIR), SPOOL_SUBDIR)
+
+
+def clean_spool(spool_dir, ttl=SPOOL_TTL):
+    """Removes spool files older than ttl seconds."""
+    if not path.isdir(spool_dir):
+        return
+    expired = time() - ttl
+    for name in listdir(spool_dir):
+        f_path = path.join(spool_dir, name)
+        try:
+            if name.startswith('srvrmgr_') and stat(f_path).st_mtime < expired:
+                unlink(f_path)
+        except OSError:
+            # removed by another task
+            pass
+
+
+def run_cmd(srvrmgr_pipe, cmd, params, queued_at=None, carry=None, sent_at=None):
+    stats = {}
+    parser = OutputParser(params['columns'], params['where'], params.get('result_format'), params.get('coerce_types'),
+                          params.get('max_output_bytes'))
+    spool_dir = None
+    if params.get('max_output_bytes') and params.get('spool_output'):
+        spool_dir = spool_path(params)
+    res_out = exec_cmd(srvrmgr_pipe, cmd, params['skip_errors'] or [], masker_for(params['creds']),
+                       params['cmd_timeout'], not params['parsed_only'], parser, stats, carry, sent_at,
+                       params.get('max_output_bytes'), spool_dir)
+
+    res_data = {'cmd': result_cmd(cmd, params)}
+
+    if res_out['out_size'] > 0:
+        if params['parsed_only']:
+            res_data['out'] = dict(parsed=res_out['out_parsed'])
         else:
-            return sc_data
+            res_data['out'] = dict(raw=res_out['out'], lines=res_out['out'].split('\n'), parsed=res_out['out_parsed'])
+        if res_out['out_truncated']:
+            res_data['out'].update(truncated=True, size=res_out['out_size'])
+            if parser.truncated:
+                res_data['out']['parsed_truncated'] = True
+            if res_out['out_spool']:
+                res_data['out']['spool'] = res_out['out_spool']
+    for rd in ['err', 'warn']:
+        if len(res_out[rd]) > 0:
+            res_data[rd] = dict(raw=res_out[rd], lines=res_out[rd].split('\n'), parsed=parse_data(res_out[rd]))
+    if params.get('profile'):
+        res_data['timing'] = cmd_timing(stats, stats['start'] if queued_at is None else queued_at,
+                                        parsed_rows(res_out['out_parsed']))
 
-    data = clean_data(data, sec_data['sadmin_pw'], "Authorization")
-    if "other" in sec_data.keys():
-        for sd in sec_data['other']:
-            data = clean_data(data, sd)
-    return data
+    return res_data
+
+
+def run_stack(srvrmgr_pipe, cmd_stack, params, results, queued_at=None):
+    """
+    Executes (index, command) pairs one by one, appending results until the first error.
+    Queue wait of the commands is counted from queued_at (start of the stack by default).
+    Returns None on success or tuple (failed command, error message).
+    """
+    if (params.get('pipeline') or 1) > 1 and len(cmd_stack) > 1:
+        return run_pipelined(srvrmgr_pipe, cmd_stack, params, results, queued_at)
+    queued_at = queued_at or time()
+    for cmd_ndx, cmd in cmd_stack:
+        error = run_one(srvrmgr_pipe, cmd, params, results, queued_at, cmd_ndx=cmd_ndx)
+        if error:
+            return error
+    return None
+
+
+def report_progress(params, res_data):
+    """Appends short result of a finished command (without output) to progress_file as one JSON line."""
+    if not params.get('progress_file'):
+        return
+    row = dict((k, res_data[k]) for k in ('cmd', 'timing') if k in res_data)
+    if params.get('target'):
+        row['target'] = params['target']
+    for rd in ['err', 'warn']:
+        if rd in res_data:
+            row[rd] = dict(parsed=res_data[rd]['parsed'])
+    with PROGRESS_LOCK:
+        with open(params['progress_file'], 'a') as progress_f:
+            progress_f.write(json.dumps(row) + '\n')
+
+
+def record_checkpoint(params, cmd_ndx, cmd):
+    """Appends index of a completed task to checkpoint_file, set and unset are not recorded."""
+    if not params.get('checkpoint_file') or cmd_ndx is None or is_session_cmd(cmd):
+        return
+    with PROGRESS_LOCK:
+        with open(params['checkpoint_file'], 'a') as checkpoint_f:
+            checkpoint_f.write('{0!r}\n'.format(float(cmd_ndx)))
+
+
+def run_one(srvrmgr_pipe, cmd, params, results, queued_at, carry=None, sent_at=None, cmd_ndx=None, ahead=False):
+    """
+    Executes one command of a stack. Returns None on success or tuple (failed command, error message).
+    If output of the command is not read to the prompt (timeout, exit of srvrmgr), srvrmgr is killed:
+    the rest of the output (and output of commands written ahead) would be read by the next commands.
+    If commands are written ahead (ahead is set), stderr can belong to any of them: a result with stderr
+    is not kept then and STDERR_AHEAD is returned.
+    """
+    try:
+        try:
+            res_data = run_cmd(srvrmgr_pipe, cmd, params, queued_at, carry, sent_at)
+        except Exception:
+            kill_srvrmgr(srvrmgr_pipe)
+            raise
+        if ahead and ('err' in res_data or 'warn' in res_data):
+            return STDERR_AHEAD
+        results.append(res_data)
+        report_progress(params, res_data)
+        if 'err' in res_data.keys():
+            raise RuntimeError(res_data['err']['raw'])
+        record_checkpoint(params, cmd_ndx, cmd)
+    except Exception as e:
+        return masker_for(params['creds'], 'Authorization').mask_str(cmd), masker_for(params['creds']).mask_str(
+            '{0}'.format(e))
+    return None
+
+
+def can_pipeline(cmd):
+    """Read-only commands, they can be written ahead, executed in check mode and run again."""
+    verb = cmd.split()[0].lower() if cmd.strip() else ''
+    return verb in PIPELINE_CMDS
+
+
+def run_pipelined(srvrmgr_pipe, cmd_stack, params, results, queued_at=None):
+    """
+    Writes up to params['pipeline'] read-only commands ahead and splits output back by prompts.
+    Other commands are written only to an idle session and nothing is written ahead of them.
+    If stderr is read while commands are written ahead, outputs of the written commands are dropped and they are
+    run again one by one, so every error is returned by its own command.
+    Returns None on success or tuple (failed command, error message).
+    """
+    queued_at = queued_at or time()
+    carry = ['']
+    pending = deque(cmd_stack)
+    sent = deque()
+    alone = 0
+    error = None
+    while sent or (pending and not error):
+        while pending and not error and len(sent) < (1 if alone else params['pipeline']):
+            if sent and not (can_pipeline(pending[0][1]) and can_pipeline(sent[-1][1])):
+                break
+            cmd_ndx, cmd = pending.popleft()
+            os_write(srvrmgr_pipe.stdin.fileno(), to_bytes('{0}\n'.format(cmd)))
+            sent.append((cmd_ndx, cmd, time()))
+            alone = max(alone - 1, 0)
+        cmd_ndx, cmd, sent_at = sent.popleft()
+        res_count = len(results)
+        cmd_error = run_one(srvrmgr_pipe, cmd, params, results, queued_at, carry, sent_at, cmd_ndx, bool(sent))
+        if cmd_error is STDERR_AHEAD:
+            try:
+                for _ in sent:
+                    read_output(srvrmgr_pipe, params['cmd_timeout'], (), masker_for(params['creds']), None, carry)
+            except Exception as e:
+                kill_srvrmgr(srvrmgr_pipe)
+                return cmd, masker_for(params['creds']).mask_str('{0}'.format(e))
+            pending.extendleft(reversed([(cmd_ndx, cmd)] + [(ndx, ahead_cmd) for ndx, ahead_cmd, t in sent]))
+            alone = len(sent) + 1
+            sent.clear()
+            continue
+        if cmd_error and len(results) == res_count:
+            # reading failed (timeout or exit of srvrmgr), srvrmgr is killed with outputs of commands written ahead
+            return error or cmd_error
+        error = error or cmd_error
+    return error
+
+
+def kill_srvrmgr(srvrmgr_pipe):
+    if srvrmgr_pipe.poll() is None:
+        srvrmgr_pipe.kill()
+
+
+def stop_srvrmgr(srvrmgr_pipe):
+    srvrmgr_pipe.stdin.close()
+    srvrmgr_pipe.wait()
+
+
+def run_threads(func, args):
+    args = list(args)
+    if len(args) == 1:
+        func(args[0])
+        return
+    threads = [Thread(target=func, args=(a,)) for a in args]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def open_sessions(params, env, count):
+    """
+    Spawns srvrmgr sessions and logs them in concurrently.
+    Returns list of sessions, login result of the first session and error (or None).
+    """
+    sessions = [spawn_srvrmgr(params, env) for _ in range(count)]
+    logins = [[] for _ in range(count)]
+    errors = [None] * count
+
+    def login(ndx):
+        errors[ndx] = run_stack(sessions[ndx], [(0.0, params['creds']['sadmin_pw'])],
+                                dict(params, checkpoint_file=None), logins[ndx])
+
+    run_threads(login, range(count))
+    error = next((e for e in errors if e), None)
+    if error:
+        kill_sessions(sessions)
+    return sessions, logins[0], error
+
+
+def close_sessions(sessions, params, results):
+    for ndx, srvrmgr_pipe in enumerate(sessions):
+        run_stack(srvrmgr_pipe, [(0.0, 'quit')], dict(params, checkpoint_file=None), results if ndx == 0 else [])
+        stop_srvrmgr(srvrmgr_pipe)
+
+
+def kill_sessions(sessions):
+    for srvrmgr_pipe in sessions:
+        kill_srvrmgr(srvrmgr_pipe)
+        stop_srvrmgr(srvrmgr_pipe)
+
+
+def stack_groups(cmd_stack):
+    """Splits sorted stack by barriers: scripts of one directory (N.x) form a group, other steps run alone."""
+    return [list(g) for k, g in groupby(cmd_stack, key=lambda c: ('dir', int(c[0])) if c[0] != int(c[0])
+                                        else ('step', c[0]))]
+
+
+def run_parallel(sessions, group, params, results):
+    """
+    Runs independent commands of a group over the sessions, results are merged in the original order.
+    No new commands are started after the first error. Returns the first error in order or None.
+    """
+    group_results = [[] for _ in group]
+    errors = [None] * len(group)
+    pending = deque(range(len(group)))
+    queued_at = time()
+
+    def worker(srvrmgr_pipe):
+        while True:
+            try:
+                ndx = pending.popleft()
+            except IndexError:
+                return
+            errors[ndx] = run_stack(srvrmgr_pipe, [group[ndx]], params, group_results[ndx], queued_at)
+            if errors[ndx]:
+                pending.clear()
+
+    run_threads(worker, sessions[:len(group)])
+    for res in group_results:
+        results.extend(res)
+    return next((e for e in errors if e), None)
+
+
+def sync_sessions(sessions, state, params):
+    """
+    Replays set and unset commands executed on the first session on the other sessions, so commands of a parallel
+    group run in the same session state. Returns None on success or tuple (failed command, error message).
+    """
+    replay_params = dict(params, checkpoint_file=None, progress_file=None)
+    for ndx, srvrmgr_pipe in enumerate(sessions, 1):
+        synced = state['synced'].get(ndx, 0)
+        if synced < len(state['cmds']):
+            error = run_stack(srvrmgr_pipe, [(0.0, cmd) for cmd in state['cmds'][synced:]], replay_params, [])
+            if error:
+                return error
+            state['synced'][ndx] = len(state['cmds'])
+    return None
+
+
+def run_groups(sessions, cmd_stack, params, results, state=None):
+    """
+    Executes command stack over the sessions, sequential steps between parallel groups are executed as one stack.
+    state keeps set and unset commands executed on the first session and the number of them replayed on every other
+    session, a persistent session daemon passes the same state to all requests.
+    Returns None on success or tuple (failed command, error message).
+    """
+    state = dict(cmds=[], synced={}) if state is None else state
+    stack = []
+    for group in stack_groups(cmd_stack) + [None]:
+        if group is not None and (len(sessions) == 1 or len(group) == 1):
+            stack.extend(group)
+            continue
+        error = None
+        if stack:
+            done = len(results)
+            error = run_stack(sessions[0], stack, params, results)
+            # a failed command does not change the session state
+            executed = stack[:len(results) - done - (1 if error else 0)]
+            state['cmds'].extend(cmd for cmd_ndx, cmd in executed if is_session_cmd(cmd))
+        stack = []
+        if not error and group is not None:
+            error = sync_sessions(sessions[1:len(group)], state, params)
+        if not error and group is not None:
+            error = run_parallel(sessions, group, params, results)
+        if error:
+            return error
+    return None
+
+
+def timed(phases, phase, func, *args):
+    """Calls func, duration of the call is added to phases dict."""
+    start = time()
+    try:
+        return func(*args)
+    finally:
+        phases[phase] = round(phases.get(phase, 0) + time() - start, 3)
+
+
+def parse_assigns(assigns):
+    """List of (name, value) of "Name1=Value1,Name2=Value2" or None if the string can not be split safely."""
+    found = []
+    pos = 0
+    while pos < len(assigns):
+        m = ASSIGN_RE.match(assigns, pos)
+        if not m or m.end() == pos:
+            return None
+        found.append((m.group('name'), m.group('value')))
+        pos = m.end()
+    return found or None
+
+
+def param_value(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def scope_key(scope):
+    return ' '.join(scope.split()).lower()
+
+
+def param_changes(cmd_stack):
+    """
+    Returns {task index: (scope, [(name, value)])} of "change param ... for <scope>" commands of the stack.
+    Commands after the first "set", "unset" or script are not diffed, they may depend on the session state.
+    """
+    changes = {}
+    for cmd_ndx, cmd in cmd_stack:
+        if cmd.split()[:1] and cmd.split()[0].lower() in DIFF_BARRIER_CMDS:
+            break
+        m = CHANGE_PARAM_RE.match(cmd)
+        assigns = parse_assigns(m.group('assigns')) if m else None
+        if assigns:
+            changes[cmd_ndx] = (m.group('scope'), assigns)
+    return changes
+
+
+def query_params(run, scopes, params):
+    """
+    Lists parameters of every scope by run(stack, params, results).
+    Returns {scope key: {alias: value}}, None for scopes which can not be listed (e.g. created by the stack).
+    """
+    q_params = dict(params, parsed_only=True, columns=None, where=None, result_format='records',
+                    coerce_types=False, checkpoint_file=None)
+    current = {}
+    for scope in scopes:
+        results = []
+        error = run([(0.0, PARAM_QUERY.format(scope))], q_params, results)
+        parsed = results[-1].get('out', {}).get('parsed') if results and not error else None
+        if isinstance(parsed, list):
+            current[scope_key(scope)] = dict((r['PA_ALIAS'].lower(), r.get('PA_VALUE', '')) for r in parsed
+                                             if isinstance(r, dict) and r.get('PA_ALIAS'))
+        else:
+            current[scope_key(scope)] = None
+    return current
+
+
+def diff_stack(cmd_stack, changes, current, params):
+    """
+    Removes assignments equal to current values from change param commands, commands without changes are dropped.
+    Values set by the stack are taken into account for next commands. Returns (new stack, param_diff).
+    """
+    masker = masker_for(params['creds'])
+    stack = []
+    param_diff = []
+    for cmd_ndx, cmd in cmd_stack:
+        values = current.get(scope_key(changes[cmd_ndx][0])) if cmd_ndx in changes else None
+        if values is None:
+            stack.append((cmd_ndx, cmd))
+            continue
+        scope, assigns = changes[cmd_ndx]
+        changed = []
+        for name, value in assigns:
+            before = values.get(name.lower())
+            if before != param_value(value):
+                changed.append('{0}={1}'.format(name, value))
+                param_diff.append(dict(scope=scope, param=name, after=masker.mask_str(param_value(value)),
+                                       before=None if before is None else masker.mask_str(before)))
+                values[name.lower()] = param_value(value)
+        if changed:
+            stack.append((cmd_ndx, 'change param {0} for {1}'.format(','.join(changed), scope)))
+    return stack, param_diff
+
+
+def diff_text(param_diff, prefix=''):
+    """Before and after text of changed parameters for diff mode of ansible."""
+    before = ''.join('{0}{1}: {2}={3}\n'.format(prefix, d['scope'], d['param'], d['before']) for d in param_diff)
+    after = ''.join('{0}{1}: {2}={3}\n'.format(prefix, d['scope'], d['param'], d['after']) for d in param_diff)
+    return before, after
+
+
+def checkpoint_path(params, cmd_stack):
+    """Checkpoint file of the stack, scripts are identified by content."""
+    key = params['checkpoint_key']
+    if not key:
+        steps = []
+        for cmd_ndx, cmd in cmd_stack:
+            if cmd.split()[:1] == ['read'] and path.isfile(cmd.split(None, 1)[1]):
+                steps.append((cmd_ndx, file_digest(cmd.split(None, 1)[1])))
+            else:
+                steps.append((cmd_ndx, cmd))
+        key = stack_key(params['sieb_gateway'], params['sieb_enterprise'], steps)
+    checkpoint_dir = path.join(path.expanduser(params['session_dir'] or SESSION_DIR), CHECKPOINT_SUBDIR)
+    if not path.isdir(checkpoint_dir):
+        makedirs(checkpoint_dir, 0o700)
+    return path.join(checkpoint_dir, key)
+
+
+def session_paths(params):
+    key_data = json.dumps([params['sieb_path'], params['sieb_gateway'], params['sieb_enterprise'],
+                           params['sieb_user'] or 'sadmin', params['add_env']], sort_keys=True)
+    session_dir = path.expanduser(params['session_dir'] or SESSION_DIR)
+    if not path.isdir(session_dir):
+        makedirs(session_dir, 0o700)
+    name = path.join(session_dir, sha1(to_bytes(key_data)).hexdigest()[:20])
+    return name + '.sock', name + '.lock'
+
+
+def pw_digest(params):
+    return sha1(to_bytes(params['creds']['sadmin_pw'])).hexdigest()
+
+
+def send_msg(conn, data):
+    conn.sendall(to_bytes(json.dumps(data)) + b'\n')
+
+
+def recv_msg(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(READ_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return json.loads(to_native(b''.join(chunks), errors='surrogate_or_strict')) if chunks else None
+
+
+def serve_session(sessions, env, params, listener, sock_path):
+    """
+    Daemon loop: executes received command stacks until idle TTL expires or one of srvrmgr sessions exits.
+    A session is killed when its output can not be read to the prompt, the error is sent back and the daemon exits,
+    so the next task starts a new daemon instead of reading output of previous commands.
+    """
+    listening = [True]
+
+    def shutdown():
+        # socket file is removed before closing, so a new daemon can never be started while it exists
+        if listening:
+            unlink(sock_path)
+            listener.close()
+            del listening[:]
+
+    auth = pw_digest(params)
+    # set and unset commands of all requests, replayed on sessions opened later
+    state = dict(cmds=[], synced={})
+    listener.settimeout(params['session_ttl'])
+    try:
+        while all(s.poll() is None for s in sessions):
+            try:
+                conn = listener.accept()[0]
+            except socket.timeout:
+                break
+            try:
+                conn.settimeout(None)
+                request = recv_msg(conn)
+                if not request:
+                    continue
+                if request.get('auth') != auth:
+                    shutdown()
+                    send_msg(conn, dict(restart=True, error='Session credentials changed'))
+                    break
+                results = []
+                error = None
+                if len(sessions) < request['parallel']:
+                    extra, _, error = open_sessions(params, env, request['parallel'] - len(sessions))
+                    if not error:
+                        sessions.extend(extra)
+                if not error:
+                    error = run_groups(sessions, request['cmd_stack'], request['params'], results, state)
+                if not all(s.poll() is None for s in sessions):
+                    # no new requests are accepted by the daemon with a broken session
+                    shutdown()
+                send_msg(conn, dict(results=results, error=error))
+            except Exception:
+                break
+            finally:
+                conn.close()
+    finally:
+        shutdown()
+
+
+def start_session_daemon(params, sock_path):
+    """
+    Forks a daemon holding logged in srvrmgr sessions behind the unix socket.
+    Returns login result of the new session, or tuple (failed command, error message) as error.
+    """
+    return wait_session_daemon(*fork_session_daemon(params, sock_path))
+
+
+def wait_session_daemon(pid, ready_r):
+    status = recv_pipe_msg(ready_r)
+    waitpid(pid, 0)
+    return status['login'], status['error']
+
+
+def fork_session_daemon(params, sock_path):
+    """
+    Forks the session daemon without waiting for its login, returns pid and pipe to read the login status from.
+    Must not be called while other threads run, the child could inherit a lock held by one of them.
+    """
+    ready_r, ready_w = pipe()
+    pid = fork()
+    if pid > 0:
+        close(ready_w)
+        return pid, ready_r
+
+    # first child: detach from the module process and its open descriptors (including the session lock)
+    setsid()
+    if fork() > 0:
+        _exit(0)
+    closerange(3, ready_w)
+    closerange(ready_w + 1, sysconf('SC_OPEN_MAX'))
+    null_fd = open_fd(devnull_path, O_RDWR)
+    for fd in (0, 1, 2):
+        dup2(null_fd, fd)
+    close(null_fd)
+
+    try:
+        env = prepare_env(params['sieb_path'], params['add_env'], params['refresh_env'])
+        sessions, login, error = open_sessions(params, env, params['parallel'])
+        if error:
+            write_pipe_msg(ready_w, dict(login=login, error=error))
+            _exit(1)
+
+        if path.exists(sock_path):
+            unlink(sock_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(sock_path)
+        chmod(sock_path, 0o600)
+        listener.listen(5)
+        write_pipe_msg(ready_w, dict(login=login, error=None))
+    except Exception as e:
+        write_pipe_msg(ready_w, dict(login=[], error=('srvrmgr session', '{0}'.format(e))))
+        _exit(1)
+
+    try:
+        serve_session(sessions, env, params, listener, sock_path)
+    finally:
+        if all(s.poll() is None for s in sessions):
+            close_sessions(sessions, params, [])
+        else:
+            kill_sessions(sessions)
+    _exit(0)
+
+
+def write_pipe_msg(fd, data):
+    os_write(fd, to_bytes(json.dumps(data)))
+    close(fd)
+
+
+def recv_pipe_msg(fd):
+    chunks = []
+    data = os_read(fd, READ_SIZE)
+    while data:
+        chunks.append(data)
+        data = os_read(fd, READ_SIZE)
+    close(fd)
+    if not chunks:
+        return dict(login=[], error=('srvrmgr session', 'Session daemon exited without status'))
+    return json.loads(to_native(b''.join(chunks), errors='surrogate_or_strict'))
+
+
+def session_request(params, cmd_stack):
+    return dict(auth=pw_digest(params), cmd_stack=cmd_stack, parallel=params['parallel'],
+                params=dict((k, params.get(k)) for k in REQUEST_PARAMS))
+
+
+def send_request(sock_path, request):
+    """Response of the running session daemon, None if there is no daemon or it exits (TTL, changed credentials)."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(sock_path)
+        send_msg(conn, request)
+        response = recv_msg(conn)
+    except socket.error:
+        # session reached its TTL while we were connecting
+        response = None
+    finally:
+        conn.close()
+    return None if response is None or response.get('restart') else response
+
+
+def run_in_session(params, cmd_stack, results):
+    """
+    Sends command stack to the persistent session, starting the session daemon if needed
+    (unless start_session is False in params, the daemon is started before threads of targets then).
+    Returns None on success or tuple (failed command, error message).
+    """
+    sock_path, lock_path = session_paths(params)
+    request = session_request(params, cmd_stack)
+
+    with open(lock_path, 'a') as lock_f:
+        flock(lock_f.fileno(), LOCK_EX)
+        for attempt in range(2):
+            response = send_request(sock_path, request)
+            if response is not None:
+                results.extend(response['results'])
+                return tuple(response['error']) if response['error'] else None
+            if attempt or not params.get('start_session', True):
+                break
+            login, error = start_session_daemon(params, sock_path)
+            results.extend(login)
+            if error:
+                return tuple(error)
+    return 'srvrmgr session', 'Unable to start session'
+
+
+def start_sessions(targets):
+    """
+    Starts session daemons of targets {name: params} which are not running, before threads of targets are started:
+    forking while other threads run can deadlock the child on a lock held by one of them.
+    The daemons log in concurrently. Returns {name: (login results, error)} of the started daemons.
+    """
+    forked = []
+    try:
+        # session locks are always taken in the same order, so concurrent tasks can not deadlock
+        for name, t_params in sorted(targets.items(), key=lambda t: session_paths(t[1])):
+            sock_path, lock_path = session_paths(t_params)
+            lock_f = open(lock_path, 'a')
+            try:
+                flock(lock_f.fileno(), LOCK_EX)
+                # an empty stack checks the credentials of the running daemon and opens its parallel sessions
+                if send_request(sock_path, session_request(t_params, [])) is not None:
+                    lock_f.close()
+                    continue
+                forked.append((name, lock_f, fork_session_daemon(t_params, sock_path)))
+            except Exception:
+                lock_f.close()
+                raise
+    finally:
+        started = {}
+
+        def wait(item):
+            name, lock_f, daemon = item
+            try:
+                started[name] = wait_session_daemon(*daemon)
+            except Exception as e:
+                started[name] = [], ('srvrmgr session', '{0}'.format(e))
+            finally:
+                lock_f.close()
+
+        run_threads(wait, forked)
+    return started
+
+
+def run_target(params, cmd_stack, env, phases):
+    """
+    Executes command stack against gateway and enterprise of params.
+    Returns dict with 'results', 'skipped_steps' if the stack is resumed and 'error' (tuple or None).
+    With diff_params or in check mode 'changed' is set by commands which are (or would be) executed,
+    'param_diff' and 'check_skipped' are added.
+    """
+    outcome = dict(results=[])
+    params['checkpoint_file'] = None
+    if params['resume']:
+        params['checkpoint_file'] = checkpoint_path(params, cmd_stack)
+        if path.isfile(params['checkpoint_file']):
+            with open(params['checkpoint_file']) as checkpoint_f:
+                done = parse_checkpoint(checkpoint_f.read())
+            # set and unset are replayed, commands after them run in the same session state
+            done = set(cmd_ndx for cmd_ndx, cmd in cmd_stack if cmd_ndx in done and not is_session_cmd(cmd))
+            outcome['skipped_steps'] = sorted(done)
+            cmd_stack = [(cmd_ndx, cmd) for cmd_ndx, cmd in cmd_stack if cmd_ndx not in done]
+        if params['check_mode']:
+            # checkpoint is only read in check mode
+            params['checkpoint_file'] = None
+        elif all(is_session_cmd(cmd) for cmd_ndx, cmd in cmd_stack):
+            if path.isfile(params['checkpoint_file']):
+                unlink(params['checkpoint_file'])
+            return outcome
+
+    changes = param_changes(cmd_stack) if params['diff_params'] else {}
+
+    def execute(run):
+        stack = cmd_stack
+        if changes:
+            scopes = []
+            for scope, assigns in (changes[cmd_ndx] for cmd_ndx in sorted(changes)):
+                if scope_key(scope) not in [scope_key(s) for s in scopes]:
+                    scopes.append(scope)
+            stack, outcome['param_diff'] = diff_stack(stack, changes, query_params(run, scopes, params), params)
+        if params['check_mode']:
+            # only read-only and session commands are executed, the others are returned as they would be run
+            outcome['check_skipped'] = [result_cmd(cmd, params) for cmd_ndx, cmd in stack
+                                        if not (can_pipeline(cmd) or is_session_cmd(cmd))]
+            stack = [(cmd_ndx, cmd) for cmd_ndx, cmd in stack if can_pipeline(cmd) or is_session_cmd(cmd)]
+        if changes or params['check_mode']:
+            outcome['changed'] = bool(outcome.get('check_skipped')) or any(
+                not (can_pipeline(cmd) or is_session_cmd(cmd)) for cmd_ndx, cmd in stack)
+        return run(stack, params, outcome['results']) if stack else None
+
+    if params['check_mode'] and not changes and not any(can_pipeline(cmd) for c, cmd in cmd_stack):
+        # nothing to execute in check mode, no login is needed
+        error = execute(None)
+    elif params['persistent']:
+        error = timed(phases, 'session', execute,
+                      lambda stack, r_params, results: run_in_session(r_params, stack, results))
+    else:
+        sessions, login, error = timed(phases, 'login', open_sessions, params, env, params['parallel'])
+        outcome['results'].extend(login)
+        if not error:
+            error = timed(phases, 'commands', execute,
+                          lambda stack, r_params, results: run_groups(sessions, stack, r_params, results))
+            if error:
+                timed(phases, 'teardown', kill_sessions, sessions)
+            else:
+                timed(phases, 'teardown', close_sessions, sessions, params, outcome['results'])
+
+    if error:
+        outcome['error'] = error
+    elif params['checkpoint_file'] and path.isfile(params['checkpoint_file']):
+        unlink(params['checkpoint_file'])
+    return outcome
+
+
+def target_name(target):
+    return '/'.join(target[k] for k in ('gateway', 'enterprise', 'user') if target.get(k))
+
+
+def run_targets(params, cmd_stack, env):
+    """
+    Executes command stack against every target (gateway, enterprise and optional user) on a pool of
+    target_workers threads. A failed target does not stop the others. Returns outcomes by target_name.
+    """
+    targets = OrderedDict()
+    for target in params['targets']:
+        name = target_name(target)
+        # checkpoint key of the action plugin is computed for sieb_gateway and sieb_enterprise only
+        targets[name] = dict(params, sieb_gateway=target['gateway'], sieb_enterprise=target['enterprise'],
+                             sieb_user=target.get('user') or params['sieb_user'], checkpoint_key=None, target=name)
+    workers = min(max(params['target_workers'] or 1, 1), len(targets))
+    started = {}
+    # nothing is executed in check mode without read-only commands or diff_params, no session is needed
+    needs_session = not params['check_mode'] or params['diff_params'] or any(
+        can_pipeline(cmd) for c, cmd in cmd_stack)
+    if params['persistent'] and workers > 1 and needs_session:
+        started = start_sessions(targets)
+        for t_params in targets.values():
+            t_params['start_session'] = False
+    pending = deque(targets)
+    outcomes = {}
+
+    def worker(_):
+        while True:
+            try:
+                name = pending.popleft()
+            except IndexError:
+                return
+            login, error = started.get(name, ([], None))
+            t_phases = {}
+            if error:
+                outcomes[name] = dict(results=[], error=tuple(error))
+            else:
+                try:
+                    outcomes[name] = run_target(targets[name], cmd_stack, env, t_phases)
+                except Exception as e:
+                    outcomes[name] = dict(results=[], error=(name, masker_for(params['creds']).mask_str(
+                        '{0}'.format(e))))
+            outcomes[name]['results'][:0] = login
+            if params['profile']:
+                outcomes[name]['profile'] = t_phases
+
+    run_threads(worker, range(workers))
+    return outcomes
 
 
 def main():
@@ -220,52 +1720,108 @@ def main():
             skip_errors=dict(type='list', default=[], required=False),
             creds=dict(type='dict', default=None, required=True),
             sieb_path=dict(type='str', default=None, required=True),
-            sieb_gateway=dict(type='str', default=None, required=True),
-            sieb_enterprise=dict(type='str', default=None, required=True),
+            sieb_gateway=dict(type='str', default=None, required=False),
+            sieb_enterprise=dict(type='str', default=None, required=False),
+            targets=dict(type='list', default=None, required=False),
+            target_workers=dict(type='int', default=4, required=False),
+            sieb_user=dict(type='str', default='sadmin', required=False),
+            cmd_timeout=dict(type='int', default=0, required=False),
+            persistent=dict(type='bool', default=False, required=False),
+            session_ttl=dict(type='int', default=600, required=False),
+            session_dir=dict(type='str', default=None, required=False),
+            parallel=dict(type='int', default=1, required=False),
+            refresh_env=dict(type='bool', default=False, required=False),
+            parsed_only=dict(type='bool', default=False, required=False),
+            columns=dict(type='list', default=None, required=False),
+            where=dict(type='dict', default=None, required=False),
+            result_format=dict(type='str', default='records', choices=['records', 'columnar'], required=False),
+            coerce_types=dict(type='bool', default=False, required=False),
+            pipeline=dict(type='int', default=1, required=False),
+            profile=dict(type='bool', default=False, required=False),
+            progress_file=dict(type='path', default=None, required=False),
+            resume=dict(type='bool', default=False, required=False),
+            diff_params=dict(type='bool', default=False, required=False),
+            max_output_bytes=dict(type='int', default=0, required=False),
+            spool_output=dict(type='bool', default=False, required=False),
+            checkpoint_key=dict(type='str', default=None, required=False, no_log=False),
+            scripts_archive=dict(type='path', default=None, required=False),
+            scripts_dir=dict(type='path', default=None, required=False),
         ),
         supports_check_mode=True
     )
 
-    module.params['cmd_stack'][0.0] = module.params['creds']['sadmin_pw']
-    module.params['cmd_stack'][float(max(module.params['cmd_stack'].keys())) + 1] = "quit"
-
-    srvrmgr = Popen(args=['srvrmgr', '-g', module.params['sieb_gateway'], '-e', module.params['sieb_enterprise'], '-u',
-                          'sadmin', '-k', '^$^'], stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=-1, shell=False,
-                    env=prepare_env(module.params['sieb_path'], module.params['add_env']))
-    for cmd_ndx in sorted(module.params['cmd_stack'], key=float):
+    if module.params['targets']:
+        if not all(isinstance(t, dict) and t.get('gateway') and t.get('enterprise') for t in module.params['targets']):
+            module.fail_json(msg='Every item of targets must be a dictionary with gateway and enterprise', **result)
+        names = [target_name(t) for t in module.params['targets']]
+        if len(set(names)) < len(names):
+            module.fail_json(msg='Duplicate targets: {0}'.format(', '.join(sorted(set(
+                n for n in names if names.count(n) > 1)))), **result)
+    elif not (module.params['sieb_gateway'] and module.params['sieb_enterprise']):
+        module.fail_json(msg='sieb_gateway and sieb_enterprise are required without targets', **result)
+    cmd_stack = sorted((float(k), v) for k, v in module.params['cmd_stack'].items())
+    if module.params['scripts_archive']:
         try:
-            res_out = exec_cmd(srvrmgr, module.params['cmd_stack'][cmd_ndx],
-                               module.params['skip_errors'],
-                               module.params['creds']['sadmin_pw'])
-
-            res_out = sec_clean(res_out, module.params['creds'])
-
-            res_data = {'cmd': module.params['cmd_stack'][cmd_ndx]}
-
-            if module.params['cmd_stack'][cmd_ndx].split()[0] == 'read':
-                res_data['cmd'] = path.basename(module.params['cmd_stack'][cmd_ndx].split()[1])
-            else:
-                res_data['cmd'] = module.params['cmd_stack'][cmd_ndx]
+            unpack_scripts(module.params['scripts_archive'], module.params['scripts_dir'])
+        except Exception as e:
+            module.fail_json(msg='Error on unpacking scripts: {0}'.format(e), **result)
+    module.params['parallel'] = max(module.params['parallel'] or 1, 1)
+    module.params['check_mode'] = module.check_mode
+    module.params['max_output_bytes'] = max(module.params['max_output_bytes'] or 0, 0)
+    if module.params['max_output_bytes'] and module.params['spool_output']:
+        clean_spool(spool_path(module.params))
+    if module.params['progress_file']:
+        try:
+            if not path.isdir(path.dirname(module.params['progress_file'])):
+                makedirs(path.dirname(module.params['progress_file']))
+            open(module.params['progress_file'], 'w').close()
+        except (IOError, OSError) as e:
+            module.fail_json(msg='Error on creating progress file: {0}'.format(e), **result)
+    phases = {}
+    env = None
+    if not module.params['persistent']:
+        env = timed(phases, 'env', prepare_env, module.params['sieb_path'], module.params['add_env'],
+                    module.params['refresh_env'])
+    module.params['session_ttl'] = module.params['session_ttl'] or 600
 
-            for rd in ['out', 'err', 'warn']:
-                if len(res_out[rd]) > 0:
-                    res_data[rd] = dict(raw=res_out[rd], lines=res_out[rd].split('\n'), parsed=parse_data(res_out[rd]))
+    if module.params['targets']:
+        outcomes = run_targets(module.params, cmd_stack, env)
+        result['targets'] = {}
+        errors = []
+        for name, outcome in sorted(outcomes.items()):
+            error = outcome.pop('error', None)
+            if error:
+                outcome.update(failed=True, msg='Error on execute: {0}'.format(error[0]), stderr=error[1],
+                               stderr_lines=error[1].split('\n'))
+                errors.append('{0}: {1}'.format(name, error[0]))
+            result['targets'][name] = outcome
+        if module.params['profile']:
+            result['profile'] = phases
+        result['changed'] = any(o.pop('changed', len(o['results']) > 0) for o in list(outcomes.values()))
+        if module._diff and any(o.get('param_diff') for o in outcomes.values()):
+            texts = [diff_text(o.get('param_diff', []), '{0} '.format(n)) for n, o in sorted(outcomes.items())]
+            result['diff'] = dict(before=''.join(t[0] for t in texts), after=''.join(t[1] for t in texts))
+        if errors:
+            result['failed_targets'] = sorted(n for n, o in result['targets'].items() if o.get('failed'))
+            module.fail_json(msg='Error on execute: {0}'.format('; '.join(errors)), **result)
+        module.exit_json(**result)
 
-            res_data = sec_clean(res_data, module.params['creds'])
-            result['results'].append(res_data)
-            result['changed'] = True
+    outcome = run_target(module.params, cmd_stack, env, phases)
+    error = outcome.pop('error', None)
+    changed = outcome.pop('changed', None)
+    result.update(outcome)
+    if module.params['profile']:
+        result['profile'] = phases
 
-            if 'err' in res_data.keys():
-                raise RuntimeError(res_data['err']['raw'])
-        except Exception as e:
-            module.params['cmd_stack'][cmd_ndx] = sec_clean(module.params['cmd_stack'][cmd_ndx], module.params['creds'])
-            result['changed'] = False
-            result['stderr'] = '{0}'.format(e)
-            result['stderr_lines'] = e.message.split('\n')
-            module.fail_json(msg='Error on execute: {0}'.format(module.params['cmd_stack'][cmd_ndx]), **result)
-    srvrmgr.stdin.close()
-    srvrmgr.wait()
+    if error:
+        result['stderr'] = error[1]
+        result['stderr_lines'] = error[1].split('\n')
+        module.fail_json(msg='Error on execute: {0}'.format(error[0]), **result)
 
+    result['changed'] = len(result['results']) > 0 if changed is None else changed
+    if module._diff and result.get('param_diff'):
+        before, after = diff_text(result['param_diff'])
+        result['diff'] = dict(before=before, after=after)
     module.exit_json(**result)
 
 
@@ -22,7 +22,16 @@ DOCUMENTATION = """
           map_dict:
             description: dictionary describing the mapping
             required: True
-          
+          stream:
+            description: read the file line by line and return mapped paths in the order of the file
+            default: False
+          dedup:
+            description: de-duplication of mapped paths in stream mode, 'all' (or true), 'none' (or false) or number of
+              last paths to check
+            default: all
+          dest:
+            description: write mapped paths (one per line) to this file instead of returning them, enables stream mode
+            default: None
 """
 
 EXAMPLES = """
@@ -44,6 +53,11 @@ DIR_MAP: { '/home/usr1/fs1' : ['/usr/local/home/usr1/fs1_0',
 - name: msg="Mapped items in loop"
   debug: msg="Mapped item: {{ item }}"
   with_map_from_file: 'file=file_with_data.txt map_dict={{ DIR_MAP }}'
+
+- name: "Mapped list written to a file for bulk copy"
+  set_fact:
+    mapped_list: "{{ lookup('map_from_file', 'file=file_with_data.txt map_dict={{ DIR_MAP }}', dest='/tmp/mapped.txt',
+                             dedup=100000) }}"
 """
 
 RETURN = """
@@ -54,8 +68,15 @@ RETURN = """
 """
 
 from ansible.errors import AnsibleError, AnsibleParserError, AnsibleFilterError
+from ansible.parsing.vault import is_encrypted_file
 from ansible.plugins.lookup import LookupBase
-from ansible.module_utils._text import to_text
+from ansible.module_utils._text import to_bytes, to_native, to_text
+from ansible.module_utils.six import string_types
+from collections import OrderedDict
+from hashlib import md5
+from os import chmod, fdopen, rename, stat, unlink
+from os.path import basename, dirname, exists, expanduser
+from tempfile import mkstemp
 from re import match as re_match
 from ast import literal_eval as l_eval
 
@@ -66,22 +87,155 @@ except ImportError:
     display = Display()
 
 
+def split_path(s_path):
+    parts = [p for p in s_path.split('/') if p]
+    return ['/'] + parts if s_path.startswith('/') else parts
+
+
+class PathTrie(object):
+    """
+    Path-component prefix trie compiled from mapping data. Lookup of the longest mapped prefix
+    takes O(path depth), prefixes are matched at the start of the path on whole components only.
+    """
+
+    def __init__(self, m_data):
+        self.root = {}
+        for m_key, m_value in m_data.items():
+            if isinstance(m_value, string_types):
+                m_value = [m_value]
+            elif not isinstance(m_value, list):
+                raise AnsibleFilterError(u"Invalid type of value in mapping data: {0}, must be list or "
+                                         u"str".format(m_value.__class__))
+            node = self.root
+            for part in split_path(m_key):
+                node = node.setdefault(part, {})
+            node[None] = m_value
+
+    def map_path(self, s_path):
+        """Returns list of mapped paths or None if path has no mapping."""
+        parts = split_path(s_path)
+        node, found, depth = self.root, None, 0
+        for ndx, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                found, depth = node[None], ndx + 1
+        if found is None:
+            return None
+        rest = '/'.join(parts[depth:])
+        return [m_value.rstrip('/') + '/' + rest if rest else m_value for m_value in found]
+
+
+class SeenPaths(object):
+    """
+    De-duplication of streamed paths: 'all' keeps digests of all seen paths, integer N keeps only
+    the last N paths, 'none' switches de-duplication off.
+    """
+
+    def __init__(self, dedup='all'):
+        # bool is an int, map it before it is taken as a window size
+        if isinstance(dedup, bool):
+            dedup = 'all' if dedup else 'none'
+        elif isinstance(dedup, string_types) and dedup.isdigit():
+            dedup = int(dedup)
+        self.dedup = dedup
+        self.seen = OrderedDict() if isinstance(dedup, int) else set()
+
+    def add(self, m_path):
+        """Returns True if the path is seen for the first time."""
+        if self.dedup in (None, 'none', False):
+            return True
+        key = md5(to_bytes(m_path, errors='surrogate_or_strict')).digest()
+        if key in self.seen:
+            if isinstance(self.dedup, int):
+                self.seen.pop(key)
+                self.seen[key] = True
+            return False
+        if isinstance(self.dedup, int):
+            self.seen[key] = True
+            if len(self.seen) > self.dedup:
+                self.seen.popitem(last=False)
+        else:
+            self.seen.add(key)
+        return True
+
+
+class LRUCache(object):
+    """
+    Small process-level LRU cache with hit/miss counters.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return u"{0} cache: {1} hits, {2} misses, {3} evictions, {4}/{5} entries".format(
+            self.name, self.hits, self.misses, self.evictions, len(self.data), self.size)
+
+
+MAPPING_CACHE = LRUCache('mapping', 64)
+FILE_CACHE = LRUCache('file', 16)
+
+
 class LookupModule(LookupBase):
 
     def parse_data(self, term):
         parse_res = re_match(r'(?P<F>file)=(?P<FV>.*) (?P<MP>map_dict)=(?P<MDV>.*)', term)
         setattr(self, 'f_name', parse_res.group('FV').strip())
-        setattr(self, 'm_data', l_eval(parse_res.group('MDV').replace('u\'', '\'')))
+        m_str = parse_res.group('MDV')
+        m_key = md5(to_bytes(m_str, errors='surrogate_or_strict')).hexdigest()
+        compiled = MAPPING_CACHE.get(m_key)
+        if compiled is None:
+            m_data = l_eval(m_str.replace('u\'', '\''))
+            compiled = (m_data, PathTrie(m_data))
+            MAPPING_CACHE.put(m_key, compiled)
+        setattr(self, 'm_data', compiled[0])
+        setattr(self, 'trie', compiled[1])
 
-    def read_file(self, variables):
+    def find_file(self, variables):
         lookupfile = self.find_file_in_search_path(variables, 'files', self.f_name)
         display.vvv(u"File lookup using {0} as file".format(lookupfile))
+        if not lookupfile:
+            raise AnsibleError(u"could not locate file: {0}".format(self.f_name))
+        return lookupfile
+
+    def read_file(self, variables):
+        lookupfile = self.find_file(variables)
+        f_stat = stat(lookupfile)
+        f_key = (lookupfile, f_stat.st_mtime, f_stat.st_size)
+        f_data = FILE_CACHE.get(f_key)
+        if f_data is not None:
+            setattr(self, "f_data", f_data)
+            return
         try:
             if lookupfile:
                 b_contents, show_data = self._loader._get_file_contents(lookupfile)
                 contents = to_text(b_contents, errors='surrogate_or_strict')
-                setattr(self, "f_data", contents.rstrip().split())
-                display.vvv(u"Received data from file: {0}".format(self.f_data))
+                setattr(self, "f_data", tuple(contents.rstrip().split()))
+                FILE_CACHE.put(f_key, self.f_data)
+                if display.verbosity >= 3:
+                    display.vvv(u"Received data from file: {0}".format(self.f_data))
             else:
                 raise AnsibleParserError()
         except AnsibleParserError:
@@ -89,38 +243,83 @@ class LookupModule(LookupBase):
 
     def map_dirs(self):
         map_res = set()
-        w_ml = [(len(k.split('/')), k) for k in self.m_data.keys()]
         for s_path in self.f_data:
-            map_found = False
-            for t in sorted(w_ml, reverse=True):
-                if t[1] in s_path:
-                    if isinstance(self.m_data[t[1]], list):
-                        for sub_v in self.m_data[t[1]]:
-                            map_res.add(s_path.replace(t[1], sub_v))
-                            display.vvv(u"Mapping result: {0} mapped to {1}".format(s_path, s_path.replace(t[1],
-                                                                                                           sub_v)))
-                    elif isinstance(self.m_data[t[1]], str):
-                        map_res.add(s_path.replace(t[1], self.m_data[t[1]]))
-                        display.vvv(u"Mapping result: {0} mapped to {1}".format(s_path,
-                                                                                s_path.replace(t[1],
-                                                                                               self.m_data[t[1]])))
-                    else:
-                        raise AnsibleFilterError(u"Invalid type of value in mapping data: {0}, must be list or "
-                                                 u"str".format(self.m_data[t[1]].__class__))
-                    map_found = True
-                    break
-            if not map_found:
+            mapped = self.trie.map_path(s_path)
+            if mapped is None:
                 raise AnsibleError(u"Mapping not found for ""{0}"" file".format(s_path))
+            map_res.update(mapped)
+            if display.verbosity >= 3:
+                for m_path in mapped:
+                    display.vvv(u"Mapping result: {0} mapped to {1}".format(s_path, m_path))
         return list(map_res)
 
+    def iter_lines(self, lookupfile):
+        """Lines of the file, a vault encrypted file is decrypted by the loader as a whole."""
+        with open(lookupfile, 'rb') as in_f:
+            encrypted = is_encrypted_file(in_f)
+            if not encrypted:
+                for line in in_f:
+                    yield to_text(line, errors='surrogate_or_strict')
+        if encrypted:
+            b_contents, show_data = self._loader._get_file_contents(lookupfile)
+            for line in to_text(b_contents, errors='surrogate_or_strict').splitlines():
+                yield line
+
+    def stream_dirs(self, variables, dedup='all', dest=None):
+        """
+        Reads the file line by line and maps every path as it goes, results keep the order of the file.
+        Returns mapped paths, or [dest] if they are written to the dest file.
+        The dest file is written to a temporary file next to it, which replaces dest when all paths are mapped.
+        """
+        trie = self.trie
+        seen = SeenPaths(dedup)
+        results = []
+        found = False
+        out_f = None
+        if dest:
+            dest_path = expanduser(dest)
+            tmp_fd, tmp_path = mkstemp(dir=dirname(dest_path) or '.', prefix='.{0}.'.format(basename(dest_path)))
+            out_f = fdopen(tmp_fd, 'w')
+        try:
+            for line in self.iter_lines(self.find_file(variables)):
+                for s_path in line.split():
+                    found = True
+                    mapped = trie.map_path(s_path)
+                    if mapped is None:
+                        raise AnsibleError(u"Mapping not found for ""{0}"" file".format(s_path))
+                    for m_path in mapped:
+                        if seen.add(m_path):
+                            if out_f:
+                                out_f.write(to_native(m_path + u'\n'))
+                            else:
+                                results.append(m_path)
+            if not found:
+                raise AnsibleError("there is no data in the file: {0}".format(self.f_name))
+            if out_f:
+                out_f.close()
+                chmod(tmp_path, stat(dest_path).st_mode & 0o7777 if exists(dest_path) else 0o644)
+                rename(tmp_path, dest_path)
+                out_f = None
+        finally:
+            if out_f:
+                out_f.close()
+                unlink(tmp_path)
+        return [dest] if dest else results
+
     def run(self, terms, variables=None, **kwargs):
         results = []
         for term in terms:
             self.parse_data(term)
+            if kwargs.get('stream') or kwargs.get('dest'):
+                results += self.stream_dirs(variables, kwargs.get('dedup', 'all'), kwargs.get('dest'))
+                continue
             self.read_file(variables)
             if len(self.f_data) > 0:
                 results += self.map_dirs()
             else:
                 raise AnsibleError("there is no data in the file: {0}".format(self.f_name))
 
+        if display.verbosity >= 3:
+            display.vvv(MAPPING_CACHE.stats())
+            display.vvv(FILE_CACHE.stats())
         return results
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+import json
+from hashlib import sha1
+
+from ansible.module_utils._text import to_bytes
+
+CHECKPOINT_SUBDIR = 'checkpoints'
+# commands changing state of the srvrmgr session are never checkpointed, they are replayed on resume
+SESSION_CMDS = ('set', 'unset')
+
+
+def file_digest(f_path):
+    """Content digest of a script, checkpoints of scripts do not depend on the path they are uploaded to."""
+    digest = sha1()
+    with open(f_path, 'rb') as scr_f:
+        for chunk in iter(lambda: scr_f.read(65536), b''):
+            digest.update(chunk)
+    return 'sha1:{0}'.format(digest.hexdigest())
+
+
+def stack_key(gateway, enterprise, steps):
+    """
+    Key of a command stack for checkpoints. steps is list of (task index, command or script digest).
+    The same key is computed by the action plugin on the controller and by the module on the target.
+    """
+    data = json.dumps([gateway, enterprise, sorted([float(ndx), step] for ndx, step in steps)])
+    return sha1(to_bytes(data)).hexdigest()
+
+
+def is_session_cmd(cmd):
+    words = cmd.split()
+    return bool(words) and words[0].lower() in SESSION_CMDS
+
+
+def parse_checkpoint(data):
+    """Returns set of completed task indices from checkpoint data, a broken last line is ignored."""
+    done = set()
+    for line in data.splitlines():
+        try:
+            done.add(float(line))
+        except ValueError:
+            continue
+    return done
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+from re import compile as re_compile, escape as re_escape
+
+from ansible.module_utils._text import to_native
+
+try:
+    text_types = (str, unicode)
+except NameError:
+    text_types = (str,)
+
+MASK = '******'
+
+
+class SecretMasker(object):
+    """
+    Masks all secrets from creds ('sadmin_pw' and list 'other') in one pass over a string.
+    Secrets are compiled into a single alternation regex, longest first.
+    """
+
+    def __init__(self, sec_data, pw_mask=MASK):
+        self.masks = {}
+        for sd in (sec_data or {}).get('other') or []:
+            if sd:
+                self.masks[to_native(sd)] = MASK
+        if (sec_data or {}).get('sadmin_pw'):
+            self.masks[to_native(sec_data['sadmin_pw'])] = pw_mask
+        secrets = sorted(self.masks, key=len, reverse=True)
+        self.regex = re_compile('|'.join(re_escape(s) for s in secrets)) if secrets else None
+
+    def mask_str(self, data):
+        if self.regex is None:
+            return data
+        return self.regex.sub(lambda m: self.masks[m.group(0)], data)
+
+    def mask(self, data):
+        if isinstance(data, text_types):
+            return self.mask_str(data)
+        elif isinstance(data, (list, tuple)):
+            return [self.mask(d) for d in data]
+        elif isinstance(data, dict):
+            for k in data:
+                data[k] = self.mask(data[k])
+            return data
+        else:
+            return data
+
+    def stream(self):
+        return MaskedStream(self)
+
+
+class MaskedStream(object):
+    """
+    Masks streamed output before it is buffered. Secrets never contain line breaks,
+    so only complete lines are masked and released, the incomplete tail is held back.
+    """
+
+    def __init__(self, masker):
+        self.masker = masker
+        self.rest = ''
+
+    def feed(self, data):
+        data = self.rest + data
+        eol = data.rfind('\n') + 1
+        self.rest = data[eol:]
+        return self.masker.mask_str(data[:eol])
+
+    def flush(self):
+        data, self.rest = self.rest, ''
+        return self.masker.mask_str(data)
@@ -16,7 +16,241 @@ except ImportError:
 
     display = Display()
 
-from re import search as re_search
+import sys
+from collections import OrderedDict
+from json import dumps
+from re import compile as re_compile, escape as re_escape
+
+from ansible.module_utils._text import to_text
+
+# filter plugin fail_details loads this file as SHARED_MODULE, compiled conditions are shared by both copies
+SHARED_MODULE = 'check_for_fails_shared'
+_shared = sys.modules.get(SHARED_MODULE)
+PREDICATES = _shared.PREDICATES if _shared is not None else OrderedDict()
+PREDICATES_SIZE = 256
+TEXT_CONDS = {
+    '==': lambda target, data: target == data,
+    '!=': lambda target, data: target != data,
+    'not in': lambda target, data: data not in target,
+    'regex': lambda target, data: data.search(target) is not None,
+}
+RAW_CONDS = {
+    '>': lambda target, data: target > data,
+    '<': lambda target, data: target < data,
+    'not empty': lambda target, data: len(target) > 0,
+}
+
+
+def compile_conds(conds):
+    """
+    Compiles condition list into a predicate over the target data.
+    Literal 'in' conditions are merged into one regex, regexes are compiled once.
+    """
+    literals = []
+    checks = []
+    for c in conds:
+        if c['cond'] == 'in':
+            literals.append(re_escape(to_text(c['data'])))
+        elif c['cond'] == 'regex':
+            checks.append((c, TEXT_CONDS['regex'], re_compile(c['data']), True))
+        elif c['cond'] in TEXT_CONDS:
+            checks.append((c, TEXT_CONDS[c['cond']], to_text(c['data']), True))
+        elif c['cond'] in RAW_CONDS:
+            checks.append((c, RAW_CONDS[c['cond']], c.get('data'), False))
+        else:
+            display.warning("Unknown condition \"{0}\"".format(c['cond']))
+            return lambda target: True
+    in_re = re_compile('|'.join(literals)) if literals else None
+    as_text = in_re is not None or any(ch[3] for ch in checks)
+
+    def predicate(target):
+        t_text = to_text(target) if as_text else None
+        found = in_re.search(t_text) if in_re is not None else None
+        if found is not None:
+            if display.verbosity >= 3:
+                display.vvv(u"Condition type: \"in\" matched: \"{0}\"".format(found.group(0)))
+            return True
+        for c, check, data, text_cond in checks:
+            result = check(t_text if text_cond else target, data)
+            if display.verbosity >= 3:
+                display.vvv(u"Condition type: \"{0}\"{1} result: {2}".format(
+                    c['cond'], u" data: \"{0}\"".format(to_text(c['data'])) if 'data' in c else u"", result))
+            if result:
+                return True
+        return False
+
+    return predicate
+
+
+def get_predicate(conds):
+    key = dumps(conds, sort_keys=True, default=str)
+    predicate = PREDICATES.pop(key, None)
+    if predicate is None:
+        predicate = compile_conds(conds)
+        if len(PREDICATES) >= PREDICATES_SIZE:
+            PREDICATES.popitem(last=False)
+    PREDICATES[key] = predicate
+    return predicate
+
+
+# regex parts which can match a line break or depend on the start and the end of the whole text
+MULTILINE_REGEX_RE = re_compile(r'[\r\n^$]|\\[rnsWDAZ]|\(\?')
+
+
+def is_streamable(cond):
+    """Condition gives the same answer per line as over the whole text."""
+    data = to_text(cond.get('data', u''))
+    if cond['cond'] in ('in', 'not in'):
+        return data != u'' and u'\n' not in data and u'\r' not in data
+    if cond['cond'] == 'regex':
+        return MULTILINE_REGEX_RE.search(data) is None
+    return cond['cond'] == 'not empty'
+
+
+class LineChecker(object):
+    """
+    Checks all conditions of one stream in a single pass over its lines and stops on the first fail.
+    'in' and 'regex' are checked per line, 'not in' is tracked over the whole data.
+    Conditions are not streamable if one of them can match across lines ('==', '!=', data with line breaks,
+    empty data), the whole text is checked then.
+    """
+
+    def __init__(self, conds):
+        self.conds = conds
+        self.streamable = all(is_streamable(c) for c in conds)
+        # no named groups: they switch off the literal prefix search of re, the matched text gives the condition
+        self.in_conds = OrderedDict()
+        for c in conds:
+            if c['cond'] == 'in':
+                self.in_conds.setdefault(to_text(c['data']), c)
+        self.in_re = re_compile('|'.join(re_escape(lit) for lit in self.in_conds)) if self.in_conds else None
+        self.regexes = [(c, re_compile(c['data'])) for c in conds if c['cond'] == 'regex']
+        self.not_empty = [c for c in conds if c['cond'] == 'not empty']
+        self.not_in = [(c, to_text(c['data'])) for c in conds if c['cond'] == 'not in']
+
+    def scan(self, lines):
+        """Returns (condition, line number, line) of the first fail or None."""
+        not_in = list(self.not_in)
+        for line_no, line in enumerate(lines, 1):
+            if self.not_empty:
+                return self.not_empty[0], line_no, line
+            if self.in_re is not None:
+                found = self.in_re.search(line)
+                if found is not None:
+                    return self.in_conds[found.group(0)], line_no, line
+            for c, regex in self.regexes:
+                if regex.search(line) is not None:
+                    return c, line_no, line
+            if not_in:
+                not_in = [(c, data) for c, data in not_in if data not in line]
+        if not_in:
+            return not_in[0][0], None, None
+        return None
+
+    def search(self, text):
+        """
+        Same result as scan() over lines of the text, but every regex searches the whole text once.
+        The first line with a match wins, on one line 'in' goes before regexes in their order.
+        A match across a line break (e.g. of a negated character class) falls back to scan().
+        """
+        if not text:
+            return self.scan(())
+        if self.not_empty:
+            first, searches = (0, self.not_empty[0]), []
+        else:
+            first, searches = None, ([(None, self.in_re)] if self.in_re is not None else []) + self.regexes
+        for c, regex in searches:
+            found = regex.search(text)
+            if found is None:
+                continue
+            if u'\n' in found.group(0) or found.start() == len(text):
+                return self.scan(iter_text_lines(text))
+            line_start = text.rfind(u'\n', 0, found.start()) + 1
+            if first is None or line_start < first[0]:
+                first = line_start, self.in_conds[found.group(0)] if c is None else c
+        if first is None:
+            return next(((c, None, None) for c, data in self.not_in if data not in text), None)
+        line_start, c = first
+        line_end = text.find(u'\n', line_start)
+        return c, text.count(u'\n', 0, line_start) + 1, text[line_start:line_end if line_end >= 0 else len(text)]
+
+
+LINE_CHECKERS = _shared.LINE_CHECKERS if _shared is not None else OrderedDict()
+
+
+def get_line_checker(conds):
+    key = dumps(conds, sort_keys=True, default=str)
+    checker = LINE_CHECKERS.pop(key, None)
+    if checker is None:
+        checker = LineChecker(conds)
+        if len(LINE_CHECKERS) >= PREDICATES_SIZE:
+            LINE_CHECKERS.popitem(last=False)
+    LINE_CHECKERS[key] = checker
+    return checker
+
+
+def iter_text_lines(data):
+    start = 0
+    while start < len(data):
+        end = data.find(u'\n', start)
+        if end < 0:
+            end = len(data)
+        yield data[start:end]
+        start = end + 1
+
+
+def iter_file_lines(f_path):
+    with open(f_path, 'rb') as f_data:
+        for line in f_data:
+            yield to_text(line, errors='surrogate_or_strict').rstrip(u'\r\n')
+
+
+def stream_text(target, stream):
+    """Whole text of the stream taken from '<stream>_path' file, '<stream>' or '<stream>_lines' of the target."""
+    if target.get(stream + '_path'):
+        with open(target[stream + '_path'], 'rb') as f_data:
+            return to_text(f_data.read(), errors='surrogate_or_strict')
+    elif target.get(stream) is not None or target.get(stream + '_lines') is None:
+        return to_text(target.get(stream, u''))
+    return u'\n'.join(to_text(line) for line in target[stream + '_lines'])
+
+
+def stream_lines(target, stream):
+    """Lines of the stream taken from '<stream>_path' file, '<stream>_lines' or '<stream>' of the target."""
+    if target.get(stream + '_path'):
+        return iter_file_lines(target[stream + '_path'])
+    elif target.get(stream + '_lines') is not None:
+        return (to_text(line) for line in target[stream + '_lines'])
+    return iter_text_lines(to_text(target.get(stream, u'')))
+
+
+def find_fail(target, conds):
+    """
+    One pass over STDOUT and STDERR lines checking all their conditions, stops on the first fail.
+    Returns dict with the stream, the matched condition, line number and line or None.
+    """
+    for cl in ['STDOUT', 'STDERR']:
+        if not conds.get(cl):
+            continue
+        stream = cl.lower()
+        checker = get_line_checker(conds[cl])
+        if checker.streamable and (target.get(stream + '_path') or target.get(stream) is None):
+            fail = checker.scan(stream_lines(target, stream))
+        elif checker.streamable:
+            # text in memory is searched as a whole, one regex search is much faster than a loop over lines
+            fail = checker.search(to_text(target[stream]))
+        else:
+            data = stream_text(target, stream)
+            fail = next(((c, None, None) for c in conds[cl] if get_predicate([c])(data)), None)
+        if fail is not None:
+            if display.verbosity >= 3:
+                display.vvv(u"Fail in {0} at line {1}: {2}".format(cl, fail[1], fail[2]))
+            return {'stream': cl, 'cond': fail[0], 'line': fail[1], 'text': fail[2]}
+    return None
+
+
+def fails_in_lines(target, conds):
+    return find_fail(target, conds) is not None
 
 
 def fails_in_outs(target, conds):
@@ -26,7 +260,7 @@ def fails_in_outs(target, conds):
             result = has_fails(target[cl.lower()], conds[cl])
         elif cl not in conds:
             continue
-        else:
+        elif display.verbosity >= 3:
             display.vvv("Condition list: {0} length: {1}".format(cl, len(conds[cl])))
         if result:
             break
@@ -34,37 +268,13 @@ def fails_in_outs(target, conds):
 
 
 def has_fails(target, conds):
-    result = False
-    for c in conds:
-        display.vvv("=>" * 10)
-        display.vvv(u"Checking data:\n{1}\n{0}{1}\n".format(target, "-" * 6))
-        display.vvv(u"Condition type: \"{0}\"{1}".format(c['cond'], " data: \"{0}\"".
-                                                         format(c['data'].encode('utf-8')) if 'data' in c.keys() else ""))
+    if display.verbosity >= 3:
+        display.vvv(u"Checking data:\n{1}\n{0}{1}\n".format(to_text(target), "-" * 6))
+    return get_predicate(conds)(target)
 
-        if c['cond'] == 'in':
-            result = c['data'].encode('utf-8') in target
-        elif c['cond'] == 'not in':
-            result = c['data'].encode('utf-8') not in target
-        elif c['cond'] == '>':
-            result = target > c['data']
-        elif c['cond'] == '<':
-            result = target < c['data']
-        elif c['cond'] == '==':
-            result = target == c['data'].encode('utf-8')
-        elif c['cond'] == '!=':
-            result = target != c['data'].encode('utf-8')
-        elif c['cond'] == 'not empty':
-            result = len(target) > 0
-        elif c['cond'] == 'regex':
-            result = re_search(c['data'], target) is not None
-        else:
-            display.warning("Unknown condition \"{0}\"".format(c['cond']))
-            result = True
-        if result:
-            break
-        display.vvv("Checking result: {0}".format(result))
-        display.vvv("{0}".format("<=" * 10))
-    return result
+
+if __name__ in sys.modules:
+    sys.modules.setdefault(SHARED_MODULE, sys.modules[__name__])
 
 
 class TestModule:
@@ -72,4 +282,5 @@ class TestModule:
         return {
             'fails_in_outs': fails_in_outs,
             'has_fails': has_fails,
+            'fails_in_lines': fails_in_lines,
         }
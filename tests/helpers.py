@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers of the tests. Plugins of the repository are loaded by path by the helpers of the benchmarks, srvrmgr is
+emulated by benchmarks/fake_srvrmgr.py, so no Siebel installation is needed. Ansible must be importable.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'benchmarks'))
+
+from run_benchmarks import PASSWORD, fake_bin, load_module, load_plugin  # noqa: E402, F401
+
+
+def sieb_dir(work_dir, **settings):
+    """Siebel directory with siebenv.sh putting the fake srvrmgr on PATH, settings are FAKE_SRVRMGR_* variables."""
+    bin_dir = fake_bin(work_dir)
+    with open(path.join(work_dir, 'siebenv.sh'), 'w') as env_f:
+        env_f.write('export PATH={0}:$PATH\n'.format(bin_dir))
+        for name, value in sorted(settings.items()):
+            env_f.write('export FAKE_SRVRMGR_{0}={1}\n'.format(name.upper(), value))
+    return work_dir
+
+
+def module_params(sieb_path, **kwargs):
+    """Parameters of the module as main() passes them on, with defaults of its argument_spec."""
+    params = dict(add_env=None, skip_errors=[], creds=dict(sadmin_pw=PASSWORD), sieb_path=sieb_path,
+                  sieb_gateway='gw', sieb_enterprise='ent', targets=None, target_workers=4, sieb_user='sadmin',
+                  cmd_timeout=10, persistent=False, session_ttl=30, session_dir=None, parallel=1, refresh_env=False,
+                  parsed_only=False, columns=None, where=None, result_format='records', coerce_types=False,
+                  pipeline=1, profile=False, progress_file=None, resume=False,
+                  diff_params=False, max_output_bytes=0, spool_output=False, checkpoint_key=None, check_mode=False)
+    params.update(kwargs)
+    return params
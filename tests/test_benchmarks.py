@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+import unittest
+
+from helpers import load_plugin
+from run_benchmarks import bench, percentile, report
+
+
+class ReportTest(unittest.TestCase):
+
+    def result(self, name, median):
+        return dict(name=name, iterations=1, median=median, p95=median, throughput=0.0, unit='ops')
+
+    def test_slower_than_threshold(self):
+        baseline = dict(a=self.result('a', 0.1), b=self.result('b', 0.1))
+        results = [self.result('a', 0.13), self.result('b', 0.11), self.result('c', 1.0)]
+        self.assertEqual(report(results, baseline, 20.0), ['a'])
+        self.assertEqual(report(results), [])
+
+    def test_bench(self):
+        calls = []
+        res = bench('calls', lambda: calls.append(1), 5, 10, 'rows')
+        self.assertEqual((len(calls), res['iterations'], res['unit']), (5, 5, 'rows'))
+        self.assertEqual(percentile([3, 1, 2, 4], 95), 4)
+
+    def test_plugin_is_loaded_once(self):
+        self.assertIs(load_plugin('srvrmgr_filters', 'filter_plugins', 'srvrmgr_filters.py'),
+                      load_plugin('srvrmgr_filters', 'filter_plugins', 'srvrmgr_filters.py'))
+
+
+if __name__ == '__main__':
+    unittest.main()
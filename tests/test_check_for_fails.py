@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+import unittest
+from os import close, unlink, write
+from tempfile import mkstemp
+
+from helpers import load_plugin
+
+fails = load_plugin('check_for_fails', 'test_plugins', 'check_for_fails.py')
+
+
+class PredicateTest(unittest.TestCase):
+
+    def test_predicate_is_compiled_once(self):
+        conds = [dict(cond='in', data='SBL-ADM'), dict(cond='regex', data='ERR.R')]
+        self.assertIs(fails.get_predicate(conds), fails.get_predicate([dict(c) for c in conds]))
+
+    def test_literals_are_merged_and_escaped(self):
+        conds = [dict(cond='in', data='SBL-ERR'), dict(cond='in', data='a.b')]
+        self.assertTrue(fails.has_fails('x a.b y', conds))
+        self.assertTrue(fails.has_fails('SBL-ERR-1', conds))
+        self.assertFalse(fails.has_fails('x axb y', conds))
+
+    def test_conditions(self):
+        self.assertFalse(fails.has_fails('a\nERROR x', [dict(cond='regex', data='^ERR')]))
+        self.assertTrue(fails.has_fails('one', [dict(cond='not in', data='two')]))
+        self.assertTrue(fails.has_fails(5, [dict(cond='>', data=3)]))
+        self.assertFalse(fails.has_fails([], [dict(cond='not empty')]))
+
+    def test_unknown_condition_fails(self):
+        self.assertTrue(fails.has_fails('ok', [dict(cond='like', data='x')]))
+
+    def test_filter_shares_compiled_conditions(self):
+        filters = load_plugin('check_for_fails_filter', 'filter_plugins', 'check_for_fails.py')
+        self.assertIs(filters.load_check_for_fails(), fails)
+        self.assertIs(filters.find_fail, fails.find_fail)
+
+
+CASES = [
+    ('abc\n', dict(cond='==', data='abc\n')),
+    ('abc\n', dict(cond='!=', data='abc\n')),
+    ('abc\n', dict(cond='==', data='abc')),
+    ('', dict(cond='in', data='')),
+    ('x a\r\nb y', dict(cond='in', data='a\r\nb')),
+    ('abc\nSBL-ADM-01067 x\n', dict(cond='in', data='SBL-ADM')),
+    ('abc\n', dict(cond='not in', data='')),
+    ('', dict(cond='not in', data='x')),
+    ('one\ntwo\n', dict(cond='not in', data='two')),
+    ('a\nERROR x', dict(cond='regex', data='^ERROR')),
+    ('a\nERROR x', dict(cond='regex', data='ERR.R')),
+    ('a\nb', dict(cond='regex', data='a\\sb')),
+    ('', dict(cond='not empty')),
+    ('\n', dict(cond='not empty')),
+]
+
+
+class OutsAndLinesTest(unittest.TestCase):
+    """fails_in_lines streams lines of the output, it must answer as fails_in_outs over the whole text."""
+
+    def test_same_answer(self):
+        for stdout, cond in CASES:
+            target = dict(stdout=stdout, stderr='')
+            conds = dict(STDOUT=[cond])
+            self.assertEqual(fails.fails_in_lines(target, conds), fails.fails_in_outs(target, conds),
+                             '{0!r} {1}'.format(stdout, cond))
+
+    def test_same_answer_for_output_in_file(self):
+        fd, f_path = mkstemp()
+        try:
+            write(fd, b'x a\r\nb y\n')
+            close(fd)
+            conds = dict(STDOUT=[dict(cond='in', data='a\r\nb')])
+            self.assertTrue(fails.fails_in_lines(dict(stdout='', stdout_path=f_path, stderr=''), conds))
+            conds = dict(STDOUT=[dict(cond='in', data='b y')])
+            self.assertTrue(fails.fails_in_lines(dict(stdout='', stdout_path=f_path, stderr=''), conds))
+        finally:
+            unlink(f_path)
+
+    def test_find_fail_reports_line(self):
+        fail = fails.find_fail(dict(stdout='ok\nSBL-ADM-01067 x\n', stderr=''),
+                               dict(STDOUT=[dict(cond='in', data='SBL-ADM')]))
+        self.assertEqual((fail['stream'], fail['line'], fail['text']), ('STDOUT', 2, 'SBL-ADM-01067 x'))
+
+    def test_text_search_matches_line_scan(self):
+        conds = [dict(cond='regex', data='ERR[^-]'), dict(cond='in', data='SBL-ADM'), dict(cond='not in', data='ok')]
+        checker = fails.LineChecker(conds)
+        for text in ['ok\nx ERR\nSBL-ADM', 'ok\nSBL-ADM ERRx', 'ERR\nok', 'a\nb', 'ok\n\n', 'ok\nERR-1\nERR\n']:
+            self.assertEqual(checker.search(text), checker.scan(fails.iter_text_lines(text)), repr(text))
+
+    def test_lines_of_target(self):
+        conds = dict(STDOUT=[dict(cond='in', data='SBL-ADM')], STDERR=[dict(cond='not empty')])
+        fail = fails.find_fail(dict(stdout_lines=['ok', 'SBL-ADM-01067'], stderr=''), conds)
+        self.assertEqual((fail['line'], fail['text']), (2, 'SBL-ADM-01067'))
+        fail = fails.find_fail(dict(stdout='ok', stderr='x'), conds)
+        self.assertEqual((fail['stream'], fail['line']), ('STDERR', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
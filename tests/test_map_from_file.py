@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+import unittest
+from os import listdir, path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from helpers import load_plugin
+
+lookup = load_plugin('map_from_file', 'lookup_plugins', 'map_from_file.py')
+
+
+class PathTrieTest(unittest.TestCase):
+
+    def test_longest_prefix_wins(self):
+        trie = lookup.PathTrie({'/home': '/mnt/home', '/home/usr1': ['/mnt/a/', '/mnt/b']})
+        self.assertEqual(trie.map_path('/home/usr1/x/y.txt'), ['/mnt/a/x/y.txt', '/mnt/b/x/y.txt'])
+        self.assertEqual(trie.map_path('/home/usr2/y.txt'), ['/mnt/home/usr2/y.txt'])
+
+    def test_prefix_of_whole_components(self):
+        trie = lookup.PathTrie({'/home/usr1': '/mnt/usr1'})
+        self.assertEqual(trie.map_path('/home/usr10/y.txt'), None)
+        self.assertEqual(trie.map_path('/home//usr1/'), ['/mnt/usr1'])
+        self.assertEqual(trie.map_path('home/usr1/y.txt'), None)
+
+    def test_invalid_value(self):
+        self.assertRaises(lookup.AnsibleFilterError, lookup.PathTrie, {'/home': 1})
+
+
+class Loader(object):
+    def _get_file_contents(self, f_path):
+        with open(f_path, 'rb') as f_data:
+            return f_data.read(), False
+
+
+class Lookup(lookup.LookupModule):
+    def find_file_in_search_path(self, variables, subdir, needle, ignore_missing=False):
+        return needle
+
+
+class MappingFileTest(unittest.TestCase):
+    paths = '/home/usr1/b.txt /home/usr2/a.txt\n/home/usr1/b.txt\n/home/usr1/c.txt\n'
+    m_dict = {'/home/usr1': '/mnt/u1', '/home/usr2': ['/mnt/u2', '/mnt/u1']}
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.addCleanup(rmtree, self.work_dir)
+        self.paths_file = path.join(self.work_dir, 'paths.txt')
+        self.write_paths(self.paths)
+        self.term = 'file={0} map_dict={1}'.format(self.paths_file, self.m_dict)
+
+    def write_paths(self, data):
+        with open(self.paths_file, 'w') as paths_f:
+            paths_f.write(data)
+
+    def run_lookup(self, **kwargs):
+        return Lookup(loader=Loader()).run([self.term], {}, **kwargs)
+
+
+class StreamTest(MappingFileTest):
+
+    def test_order_of_file_is_kept(self):
+        self.assertEqual(self.run_lookup(stream=True), ['/mnt/u1/b.txt', '/mnt/u2/a.txt', '/mnt/u1/a.txt',
+                                                        '/mnt/u1/c.txt'])
+        self.assertEqual(self.run_lookup(stream=True, dedup=True), self.run_lookup(stream=True))
+        self.assertEqual(sorted(self.run_lookup()), sorted(self.run_lookup(stream=True)))
+
+    def test_without_dedup(self):
+        self.assertEqual(self.run_lookup(stream=True, dedup='none'), ['/mnt/u1/b.txt', '/mnt/u2/a.txt',
+                                                                      '/mnt/u1/a.txt', '/mnt/u1/b.txt',
+                                                                      '/mnt/u1/c.txt'])
+        self.assertEqual(self.run_lookup(stream=True, dedup=False), self.run_lookup(stream=True, dedup='none'))
+
+    def test_dedup_window(self):
+        seen = lookup.SeenPaths('2')
+        self.assertEqual([seen.add(p) for p in ['a', 'b', 'a', 'c', 'b', 'c']],
+                         [True, True, False, True, True, False])
+
+    def test_dest(self):
+        dest = path.join(self.work_dir, 'mapped.txt')
+        self.assertEqual(self.run_lookup(dest=dest), [dest])
+        with open(dest) as dest_f:
+            self.assertEqual(dest_f.read().split(), self.run_lookup(stream=True))
+
+    def test_dest_is_kept_on_error(self):
+        dest = path.join(self.work_dir, 'mapped.txt')
+        with open(dest, 'w') as dest_f:
+            dest_f.write('old\n')
+        self.write_paths(self.paths + '/opt/x.txt\n')
+        self.assertRaises(lookup.AnsibleError, self.run_lookup, dest=dest)
+        with open(dest) as dest_f:
+            self.assertEqual(dest_f.read(), 'old\n')
+        self.assertEqual(sorted(listdir(self.work_dir)), ['mapped.txt', 'paths.txt'])
+
+
+class CacheTest(MappingFileTest):
+
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        lookup.MAPPING_CACHE.data.clear()
+        lookup.FILE_CACHE.data.clear()
+
+    def test_mapping_and_file_are_cached(self):
+        self.run_lookup()
+        hits = lookup.MAPPING_CACHE.hits, lookup.FILE_CACHE.hits
+        self.run_lookup()
+        self.assertEqual((lookup.MAPPING_CACHE.hits, lookup.FILE_CACHE.hits), (hits[0] + 1, hits[1] + 1))
+
+    def test_changed_file_is_read_again(self):
+        self.run_lookup()
+        self.write_paths(self.paths + '/home/usr1/d.txt\n')
+        self.assertIn('/mnt/u1/d.txt', self.run_lookup())
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = lookup.LRUCache('test', 2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual((cache.get('b'), cache.get('a'), cache.get('c')), (None, 1, 3))
+        self.assertEqual(cache.evictions, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+import unittest
+from hashlib import sha1
+from os import makedirs, path
+from shutil import copyfile, rmtree
+from subprocess import PIPE, Popen
+from tarfile import open as tar_open
+from tempfile import mkdtemp
+
+from ansible.module_utils._text import to_text
+
+from helpers import load_plugin
+
+action = load_plugin('srvrmgr_action', 'action_plugins', 'srvrmgr.py')
+
+
+class LocalAction(action.ActionModule):
+    """Action plugin with the target on the local host, nothing is sent over a connection."""
+
+    def __init__(self):
+        pass
+
+    def _transfer_file(self, local_path, remote_path):
+        copyfile(local_path, remote_path)
+        return remote_path
+
+    def _low_level_execute_command(self, cmd, sudoable=True, **kwargs):
+        proc = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        return dict(rc=proc.returncode, stdout=to_text(out), stderr=to_text(err))
+
+
+class ActionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.addCleanup(rmtree, self.work_dir)
+        self.action = LocalAction()
+
+    def script(self, rel_path, data):
+        scr_path = path.join(self.work_dir, rel_path)
+        if not path.isdir(path.dirname(scr_path)):
+            makedirs(path.dirname(scr_path))
+        with open(scr_path, 'w') as scr_f:
+            scr_f.write(data)
+        return scr_path
+
+
+class TransferScriptsTest(ActionTest):
+
+    def test_scripts_are_sent_in_one_archive(self):
+        members = [('a.cmd', self.script('src/a.cmd', 'list comp\n')),
+                   ('b.cmd', self.script('src/sub/b.cmd', 'list servers\n'))]
+        arc = tar_open(self.action._transfer_scripts(members, self.work_dir))
+        try:
+            self.assertEqual(sorted(arc.getnames()), ['a.cmd', 'b.cmd'])
+            self.assertEqual(arc.extractfile('b.cmd').read(), b'list servers\n')
+        finally:
+            arc.close()
+
+
+class ScriptCacheTest(ActionTest):
+
+    def setUp(self):
+        super(ScriptCacheTest, self).setUp()
+        self.cache_dir = path.join(self.work_dir, 'cache')
+        self.scripts = {1.0: self.script('a.cmd', 'list comp\n'), 2.0: self.script('b.cmd', 'list servers\n')}
+
+    def upload(self, missing):
+        for blob, f_name in missing:
+            if not path.isdir(path.join(self.cache_dir, path.dirname(blob))):
+                makedirs(path.join(self.cache_dir, path.dirname(blob)))
+            copyfile(f_name, path.join(self.cache_dir, blob))
+
+    def test_only_missing_scripts_are_sent(self):
+        remote, missing = self.action._cached_scripts(self.scripts, self.cache_dir)
+        self.assertEqual(remote[1.0], path.join(self.cache_dir, sha1(b'list comp\n').hexdigest(), 'a.cmd'))
+        self.assertEqual(sorted(f_name for blob, f_name in missing), sorted(self.scripts.values()))
+        self.upload(missing)
+        self.assertEqual(self.action._cached_scripts(self.scripts, self.cache_dir), (remote, []))
+
+    def test_damaged_blob_is_sent_again(self):
+        remote, missing = self.action._cached_scripts(self.scripts, self.cache_dir)
+        self.upload(missing)
+        with open(remote[2.0], 'w') as blob_f:
+            blob_f.write('list comp\n')
+        remote, missing = self.action._cached_scripts(self.scripts, self.cache_dir)
+        self.assertEqual(missing, [(path.relpath(remote[2.0], self.cache_dir), self.scripts[2.0])])
+        self.assertFalse(path.exists(remote[2.0]))
+
+
+class FilterTest(ActionTest):
+
+    def setUp(self):
+        super(FilterTest, self).setUp()
+        self.addCleanup(setattr, action, 'FILTER_CACHE', action.FILTER_CACHE)
+        action.FILTER_CACHE = path.join(self.work_dir, 'filter_cache.json')
+        self.root = path.join(self.work_dir, 'scripts')
+        self.matched = [self.script('scripts/01_dir.cmd/01_a.cmd', 'list comp\nactivate comp A\n'),
+                        self.script('scripts/02_c.cmd', 'activate comp C\n')]
+        self.script('scripts/01_dir.cmd/02_b.cmd', 'list comp\n')
+        self.script('scripts/01_dir.cmd/.03_hidden.cmd', 'activate comp H\n')
+        self.script('scripts/notes.txt', 'activate comp N\n')
+
+    def test_filter_selects_scripts(self):
+        files, stack = action.parse_data([self.root, 'list servers'], filter_str='activate')
+        self.assertEqual(files, {1.1: self.matched[0], 1.2: self.matched[1]})
+        self.assertEqual(stack, {1.1: None, 1.2: None, 2.0: 'list servers'})
+
+    def test_results_are_cached(self):
+        action.parse_data([self.root], filter_str='activate')
+        searched = []
+        search_script = action.search_script
+        self.addCleanup(setattr, action, 'search_script', search_script)
+        action.search_script = lambda scr_path, regex, overlap: searched.append(scr_path) or search_script(
+            scr_path, regex, overlap)
+        action.parse_data([self.root], filter_str='activate')
+        self.assertEqual(searched, [])
+        with open(self.matched[1], 'a') as scr_f:
+            scr_f.write('list comp\n')
+        self.assertEqual(len(action.parse_data([self.root], filter_str='activate')[0]), 2)
+        self.assertEqual(searched, [self.matched[1]])
+
+    def test_filter_across_chunks(self):
+        self.addCleanup(setattr, action, 'FILTER_CHUNK', action.FILTER_CHUNK)
+        action.FILTER_CHUNK = 8
+        scr_path = self.script('chunks.cmd', 'list comp\nactivate comp A\n')
+        self.assertEqual(action.check_filter([scr_path], 'activate comp'), {scr_path: True})
+        self.assertEqual(action.check_filter([scr_path], 'act.vate comp A'), {scr_path: True})
+        self.assertEqual(action.check_filter([scr_path], 'comp B'), {scr_path: False})
+
+
+class ProfileTest(ActionTest):
+    results = [dict(cmd='Authorization'),
+               dict(cmd='list comp, servers', timing=dict(queue=0.0, first_byte=0.01, total=0.02, bytes=100, rows=3))]
+
+    def test_table(self):
+        lines = action.profile_table(self.results, dict(login=0.1, commands=0.02)).split('\n')
+        self.assertEqual(lines[0].split(), ['cmd'] + action.PROFILE_FIELDS)
+        self.assertEqual(lines[1].split()[-5:], ['0.0', '0.01', '0.02', '100', '3'])
+        self.assertEqual(lines[2], 'commands: 0.02, login: 0.1')
+
+    def test_csv_header_is_written_once(self):
+        profile_file = path.join(self.work_dir, 'profile.csv')
+        action.save_profile(profile_file, 'host1', self.results, {})
+        action.save_profile(profile_file, 'host2', self.results, {})
+        with open(profile_file) as prof_f:
+            rows = [line.split(',', 1)[1] for line in prof_f.read().splitlines()]
+        self.assertEqual(rows, ['host,cmd,queue,first_byte,total,bytes,rows',
+                                'host1,"list comp, servers",0.0,0.01,0.02,100,3',
+                                'host2,"list comp, servers",0.0,0.01,0.02,100,3'])
+
+
+class ReportProgressTest(ActionTest):
+
+    def test_incomplete_line_is_reported_later(self):
+        progress_file = path.join(self.work_dir, 'progress.jsonl')
+        with open(progress_file, 'w') as progress_f:
+            progress_f.write('{"cmd": "list comp"}\n{"cmd": "li')
+        offset = self.action._report_progress(progress_file, 0)
+        self.assertEqual(offset, len('{"cmd": "list comp"}\n'))
+        with open(progress_file, 'a') as progress_f:
+            progress_f.write('st servers"}\n')
+        self.assertEqual(self.action._report_progress(progress_file, offset), path.getsize(progress_file))
+        self.assertEqual(self.action._report_progress(progress_file, path.getsize(progress_file)),
+                         path.getsize(progress_file))
+        self.assertEqual(self.action._report_progress(path.join(self.work_dir, 'missing.jsonl'), 0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
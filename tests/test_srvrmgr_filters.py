@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+import unittest
+
+from helpers import load_plugin
+
+filters = load_plugin('srvrmgr_filters', 'filter_plugins', 'srvrmgr_filters.py')
+
+ROWS = [dict(SV_NAME='srv1', CC_ALIAS='SCBroker', CP_MAX_TASKS='20'),
+        dict(SV_NAME='srv1', CC_ALIAS='EAIObjMgr', CP_MAX_TASKS=''),
+        dict(SV_NAME='srv2', CC_ALIAS='SCBroker', CP_MAX_TASKS='100'),
+        dict(SV_NAME='srv2', CC_ALIAS='EAIObjMgr', CP_MAX_TASKS='n/a')]
+
+
+def aliases(rows):
+    return [(r['SV_NAME'], r['CC_ALIAS']) for r in rows]
+
+
+class WhereTest(unittest.TestCase):
+
+    def test_numeric_operators_skip_empty_and_text_cells(self):
+        self.assertEqual(aliases(filters.srvrmgr_where(ROWS, CP_MAX_TASKS__gt=10)),
+                         [('srv1', 'SCBroker'), ('srv2', 'SCBroker')])
+        self.assertEqual(aliases(filters.srvrmgr_where(ROWS, CP_MAX_TASKS__le='20')), [('srv1', 'SCBroker')])
+
+    def test_equality_compares_numeric_strings_as_numbers(self):
+        self.assertEqual(aliases(filters.srvrmgr_where(ROWS, CP_MAX_TASKS=20)), [('srv1', 'SCBroker')])
+        self.assertEqual(aliases(filters.srvrmgr_where(ROWS, CP_MAX_TASKS=['100.0', ''])),
+                         [('srv1', 'EAIObjMgr'), ('srv2', 'SCBroker')])
+        self.assertEqual(len(filters.srvrmgr_where(ROWS, CP_MAX_TASKS__ne=20)), 3)
+
+    def test_leading_zeros_are_compared_as_text(self):
+        rows = [dict(CP_ID='0012'), dict(CP_ID='12'), dict(CP_ID='12.0')]
+        self.assertEqual(filters.srvrmgr_where(rows, CP_ID=12), [dict(CP_ID='12'), dict(CP_ID='12.0')])
+        self.assertEqual(filters.srvrmgr_where(rows, CP_ID='0012'), [dict(CP_ID='0012')])
+        self.assertEqual(filters.srvrmgr_where(rows, CP_ID__gt=11), [dict(CP_ID='12'), dict(CP_ID='12.0')])
+
+    def test_conditions_are_combined(self):
+        self.assertEqual(aliases(filters.srvrmgr_where(ROWS, {'SV_NAME': 'srv2'}, CC_ALIAS='SCBroker')),
+                         [('srv2', 'SCBroker')])
+
+    def test_unknown_operator(self):
+        self.assertRaises(filters.AnsibleFilterError, filters.srvrmgr_where, ROWS, CP_MAX_TASKS__like='1')
+
+    def test_columnar_table_keeps_its_format(self):
+        table = dict(columns=['SV_NAME', 'CP_MAX_TASKS'], rows=[['srv1', 20], ['srv2', None]])
+        self.assertEqual(filters.srvrmgr_where(table, CP_MAX_TASKS__ge=20),
+                         dict(columns=['SV_NAME', 'CP_MAX_TASKS'], rows=[['srv1', 20]]))
+
+
+class GroupTest(unittest.TestCase):
+
+    def test_group_by(self):
+        groups = filters.srvrmgr_group_by(ROWS, 'SV_NAME', CC_ALIAS='SCBroker')
+        self.assertEqual(sorted(groups), ['srv1', 'srv2'])
+        self.assertEqual(aliases(groups['srv2']), [('srv2', 'SCBroker')])
+
+    def test_index_by_several_columns(self):
+        index = filters.srvrmgr_index_by(ROWS, ['SV_NAME', 'CC_ALIAS'])
+        self.assertEqual(index['srv2/EAIObjMgr']['CP_MAX_TASKS'], 'n/a')
+
+    def test_count(self):
+        self.assertEqual(filters.srvrmgr_count(ROWS), 4)
+        self.assertEqual(filters.srvrmgr_count(ROWS, 'SV_NAME', CP_MAX_TASKS__gt=0), {'srv1': 1, 'srv2': 1})
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_diff_by_key(self):
+        new = [dict(r) for r in ROWS[1:]] + [dict(SV_NAME='srv3', CC_ALIAS='SCBroker', CP_MAX_TASKS='20')]
+        new[1]['CP_MAX_TASKS'] = '200'
+        diff = filters.srvrmgr_diff(ROWS, new, key=['SV_NAME', 'CC_ALIAS'])
+        self.assertEqual(aliases(diff['added']), [('srv3', 'SCBroker')])
+        self.assertEqual(aliases(diff['removed']), [('srv1', 'SCBroker')])
+        self.assertEqual(diff['changed'], [dict(key=dict(SV_NAME='srv2', CC_ALIAS='SCBroker'),
+                                                changes=dict(CP_MAX_TASKS=dict(old='100', new='200')))])
+
+
+if __name__ == '__main__':
+    unittest.main()
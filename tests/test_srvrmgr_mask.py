@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+import unittest
+
+from helpers import load_plugin
+
+mask = load_plugin('srvrmgr_mask', 'module_utils', 'srvrmgr_mask.py')
+
+
+class SecretMaskerTest(unittest.TestCase):
+
+    def test_longest_secret_is_masked_first(self):
+        masker = mask.SecretMasker(dict(sadmin_pw='pass', other=['password', '']), 'Authorization')
+        self.assertEqual(masker.mask_str('password pass'), '****** Authorization')
+
+    def test_nested_data(self):
+        masker = mask.SecretMasker(dict(sadmin_pw='pass'))
+        self.assertEqual(masker.mask(dict(cmd=['x pass', ('pass',)], rc=1)), dict(cmd=['x ******', ['******']], rc=1))
+
+    def test_without_secrets(self):
+        self.assertEqual(mask.SecretMasker(None).mask_str('pass'), 'pass')
+
+    def test_secret_split_between_chunks(self):
+        stream = mask.SecretMasker(dict(sadmin_pw='pass')).stream()
+        masked = stream.feed('login pa') + stream.feed('ss\nnext pa') + stream.feed('ss')
+        self.assertEqual(masked, 'login ******\n')
+        self.assertEqual(masked + stream.flush(), 'login ******\nnext ******')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function)
+
+import json
+import unittest
+from os import listdir, path, stat, utime
+from shutil import rmtree
+from tarfile import open as tar_open
+from tempfile import mkdtemp
+
+from helpers import PASSWORD, load_module, module_params, sieb_dir
+
+srvrmgr = load_module()
+
+LIST_OUTPUT = ('\nSV_NAME^$^CP_NUM_RUN_TASKS^$^CP_ID^$^\n-------^$^-----------------^$^-----^$^\n'
+               'srv1   ^$^5                ^$^0012 ^$^\nsrv2   ^$^               ^$^7    ^$^\n\n'
+               '2 rows returned.\n\nsrvrmgr> ')
+
+
+class OutputParserTest(unittest.TestCase):
+
+    def test_records(self):
+        self.assertEqual(srvrmgr.parse_data(LIST_OUTPUT),
+                         [dict(SV_NAME='srv1', CP_NUM_RUN_TASKS='5', CP_ID='0012'),
+                          dict(SV_NAME='srv2', CP_NUM_RUN_TASKS='', CP_ID='7')])
+
+    def test_output_fed_by_chunks(self):
+        parser = srvrmgr.OutputParser()
+        for ch in LIST_OUTPUT:
+            parser.feed(ch)
+        self.assertEqual(parser.finish(), srvrmgr.parse_data(LIST_OUTPUT))
+
+    def test_columnar_coerce_keeps_leading_zeros(self):
+        parser = srvrmgr.OutputParser(result_format='columnar', coerce=True)
+        parser.feed(LIST_OUTPUT[:40])
+        parser.feed(LIST_OUTPUT[40:])
+        self.assertEqual(parser.finish(), dict(columns=['SV_NAME', 'CP_NUM_RUN_TASKS', 'CP_ID'],
+                                               rows=[['srv1', 5, '0012'], ['srv2', None, '7']]))
+
+    def test_where_and_columns(self):
+        parser = srvrmgr.OutputParser(columns=['CP_ID'], where=dict(SV_NAME='srv2'))
+        parser.feed(LIST_OUTPUT)
+        self.assertEqual(parser.finish(), [dict(CP_ID='7')])
+
+    def test_limit_counts_bytes(self):
+        parser = srvrmgr.OutputParser(limit=6)
+        parser.feed(u'аб\nвг\n')
+        self.assertEqual(parser.finish(), [u'аб'])
+        self.assertTrue(parser.truncated)
+        self.assertEqual(parser.size, 10)
+
+
+class OutputBufferTest(unittest.TestCase):
+
+    def test_without_limit(self):
+        buf = srvrmgr.OutputBuffer()
+        buf.write(u'абв')
+        self.assertEqual(buf.value(), u'абв')
+        self.assertFalse(buf.truncated)
+
+    def test_limit_counts_bytes_and_keeps_whole_characters(self):
+        buf = srvrmgr.OutputBuffer(10)
+        buf.write(u'абвгд')
+        self.assertFalse(buf.truncated)
+        buf.write(u'ежзий')
+        self.assertTrue(buf.truncated)
+        self.assertEqual(buf.value(), u'аб\n... 12 bytes truncated ...\nий')
+
+    def test_spool_gets_whole_output(self):
+        spool_dir = mkdtemp()
+        try:
+            buf = srvrmgr.OutputBuffer(4, spool_dir)
+            buf.write(u'0123')
+            buf.write(u'456789')
+            buf.close()
+            with open(buf.spool_path, 'rb') as spool_f:
+                self.assertEqual(spool_f.read(), b'0123456789')
+        finally:
+            rmtree(spool_dir)
+
+
+class SiebenvCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.addCleanup(rmtree, self.work_dir)
+        self.addCleanup(setattr, srvrmgr, 'ENV_CACHE_DIR', srvrmgr.ENV_CACHE_DIR)
+        srvrmgr.ENV_CACHE_DIR = path.join(self.work_dir, 'env_cache')
+        self.write('siebenv.sh', 'export SIEB_DIR={0}\n. $SIEB_DIR/extra.sh\n'.format(self.work_dir))
+        self.write('extra.sh', 'export EXTRA=1\n')
+
+    def write(self, name, data):
+        with open(path.join(self.work_dir, name), 'w') as env_f:
+            env_f.write(data)
+
+    def test_cached_env_is_used(self):
+        self.assertEqual(srvrmgr.load_siebenv(self.work_dir)['EXTRA'], '1')
+        self.addCleanup(setattr, srvrmgr, 'source_siebenv', srvrmgr.source_siebenv)
+        srvrmgr.source_siebenv = lambda siebenv_path: self.fail('siebenv.sh is sourced again')
+        self.assertEqual(srvrmgr.load_siebenv(self.work_dir)['EXTRA'], '1')
+
+    def test_change_of_sourced_script_invalidates_cache(self):
+        srvrmgr.load_siebenv(self.work_dir)
+        self.write('extra.sh', 'export EXTRA=22\n')
+        self.assertEqual(srvrmgr.load_siebenv(self.work_dir)['EXTRA'], '22')
+
+    def test_refresh(self):
+        srvrmgr.load_siebenv(self.work_dir)
+        extra = path.join(self.work_dir, 'extra.sh')
+        st = stat(extra)
+        self.write('extra.sh', 'export EXTRA=2\n')
+        utime(extra, (st.st_atime, st.st_mtime))
+        self.assertEqual(srvrmgr.load_siebenv(self.work_dir)['EXTRA'], '1')
+        self.assertEqual(srvrmgr.load_siebenv(self.work_dir, refresh=True)['EXTRA'], '2')
+
+    def test_add_env_values_are_text(self):
+        env = srvrmgr.prepare_env(self.work_dir, dict(COUNT=5, FLAG=True))
+        self.assertEqual((env['COUNT'], env['FLAG']), (u'5', u'True'))
+
+
+class UnpackScriptsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.addCleanup(rmtree, self.work_dir)
+
+    def archive(self, names):
+        arc_path = path.join(self.work_dir, 'srvrmgr_scripts.tar.gz')
+        arc = tar_open(arc_path, 'w:gz')
+        try:
+            for name in names:
+                scr_path = path.join(self.work_dir, path.basename(name))
+                with open(scr_path, 'w') as scr_f:
+                    scr_f.write('list comp\n')
+                arc.add(scr_path, arcname=name)
+        finally:
+            arc.close()
+        return arc_path
+
+    def test_scripts_are_extracted(self):
+        arc_path = self.archive(['a.cmd', 'sha/b.cmd'])
+        dest = path.join(self.work_dir, 'dest')
+        srvrmgr.unpack_scripts(arc_path, dest)
+        self.assertFalse(path.exists(arc_path))
+        with open(path.join(dest, 'sha', 'b.cmd')) as scr_f:
+            self.assertEqual(scr_f.read(), 'list comp\n')
+
+    def test_member_outside_of_dest(self):
+        arc_path = self.archive(['../a.cmd'])
+        self.assertRaises(RuntimeError, srvrmgr.unpack_scripts, arc_path, path.join(self.work_dir, 'dest'))
+
+
+class FakeSrvrmgrTest(unittest.TestCase):
+    settings = dict(rows=3)
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.sieb_path = sieb_dir(path.join(self.work_dir, 'sieb'), **self.settings)
+        self.session_dir = path.join(self.work_dir, 'sessions')
+        self.addCleanup(setattr, srvrmgr, 'ENV_CACHE_DIR', srvrmgr.ENV_CACHE_DIR)
+        srvrmgr.ENV_CACHE_DIR = path.join(self.work_dir, 'env_cache')
+
+    def tearDown(self):
+        # a request with wrong credentials stops the session daemon
+        if path.isdir(self.session_dir):
+            for name in listdir(self.session_dir):
+                if name.endswith('.sock'):
+                    srvrmgr.send_request(path.join(self.session_dir, name), dict(auth='stop'))
+        rmtree(self.work_dir)
+
+    def params(self, **kwargs):
+        kwargs.setdefault('session_dir', self.session_dir)
+        return module_params(self.sieb_path, **kwargs)
+
+    def login(self, params):
+        env = srvrmgr.prepare_env(self.sieb_path)
+        srvrmgr_pipe = srvrmgr.spawn_srvrmgr(params, env)
+        self.addCleanup(srvrmgr.kill_srvrmgr, srvrmgr_pipe)
+        srvrmgr.exec_cmd(srvrmgr_pipe, PASSWORD, [], srvrmgr.masker_for(params['creds']))
+        return srvrmgr_pipe
+
+    def exec_cmd(self, cmd, skip_errors=(), timeout=0):
+        params = self.params()
+        return srvrmgr.exec_cmd(self.login(params), cmd, list(skip_errors), srvrmgr.masker_for(params['creds']),
+                                timeout)
+
+    def run_stack(self, cmd_stack, **kwargs):
+        params = self.params(**kwargs)
+        results = []
+        error = srvrmgr.run_stack(self.login(params), list(enumerate(cmd_stack, 1)), params, results)
+        return error, [(r['cmd'], r.get('out'), r.get('err')) for r in results]
+
+    def run_target(self, cmd_stack, **kwargs):
+        params = self.params(**kwargs)
+        env = None if params['persistent'] else srvrmgr.prepare_env(self.sieb_path)
+        return srvrmgr.run_target(params, list(enumerate(cmd_stack, 1)), env, {})
+
+
+class ExecCmdTest(FakeSrvrmgrTest):
+
+    def test_output_is_read_up_to_prompt(self):
+        res = self.exec_cmd('list comp')
+        self.assertEqual(len(res['out_parsed']), 3)
+        self.assertEqual(res['err'], '')
+        self.assertNotIn('srvrmgr>', res['out'])
+
+    def test_stderr_is_read_with_output(self):
+        res = self.exec_cmd('error x')
+        self.assertIn('SBL-ADM-01067', res['err'])
+
+    def test_skipped_error_is_warning(self):
+        res = self.exec_cmd('list comp Missing', ['SBL-ADM-60070'])
+        self.assertEqual(res['err'], '')
+        self.assertIn('SBL-ADM-60070', res['warn'])
+
+
+class ExecTimeoutTest(FakeSrvrmgrTest):
+    settings = dict(rows=3, latency=1)
+
+    def test_timeout(self):
+        self.assertRaises(RuntimeError, self.exec_cmd, 'list comp', timeout=0.2)
+
+
+class PersistentSessionTest(FakeSrvrmgrTest):
+
+    def test_session_is_reused(self):
+        first = self.run_target(['list comp'], persistent=True)
+        second = self.run_target(['list servers'], persistent=True)
+        self.assertEqual([r['cmd'] for r in first['results']], ['Authorization', 'list comp'])
+        self.assertEqual([r['cmd'] for r in second['results']], ['list servers'])
+        self.assertEqual(len(second['results'][0]['out']['parsed']), 3)
+
+    def test_changed_credentials_restart_session(self):
+        self.run_target(['list comp'], persistent=True)
+        outcome = self.run_target(['list comp'], persistent=True, creds=dict(sadmin_pw='other'))
+        self.assertEqual(outcome['results'][0]['cmd'], 'Authorization')
+        self.assertTrue(outcome['error'])
+
+
+class PersistentTimeoutTest(FakeSrvrmgrTest):
+    settings = dict(rows=3, latency=1.5)
+
+    def test_session_is_restarted_after_timeout(self):
+        outcome = self.run_target(['list comp'], persistent=True, cmd_timeout=1)
+        self.assertIn('Timeout', outcome['error'][1])
+        outcome = self.run_target(['set server srv1'], persistent=True, cmd_timeout=5)
+        self.assertEqual(outcome.get('error'), None)
+        self.assertEqual([r['cmd'] for r in outcome['results']], ['Authorization', 'set server srv1'])
+        self.assertEqual(outcome['results'][1]['out']['parsed'], ['Command completed successfully.'])
+
+
+class ParallelTest(FakeSrvrmgrTest):
+    settings = dict(rows=3, latency=0.2)
+    stack = [(1.0, 'set server srv1'), (2.1, 'list comp'), (2.2, 'list servers'), (2.3, 'list comp'),
+             (3.0, 'unset server'), (4.1, 'list comp'), (4.2, 'list comp')]
+
+    def run_steps(self, steps, **kwargs):
+        params = self.params(**kwargs)
+        env = None if params['persistent'] else srvrmgr.prepare_env(self.sieb_path)
+        return srvrmgr.run_target(params, steps, env, {})
+
+    def servers(self, result):
+        return set(row['SV_NAME'] for row in result['out']['parsed'])
+
+    def test_results_in_order_with_session_state(self):
+        outcome = self.run_steps(self.stack, parallel=3)
+        self.assertEqual(outcome.get('error'), None)
+        self.assertEqual([r['cmd'] for r in outcome['results']],
+                         ['Authorization'] + [cmd for ndx, cmd in self.stack] + ['quit'])
+        for result in outcome['results'][2:5]:
+            self.assertEqual(self.servers(result), set(['srv1']))
+        for result in outcome['results'][6:8]:
+            self.assertEqual(self.servers(result), set(['srv0', 'srv1', 'srv2']))
+
+    def test_persistent_session_state(self):
+        self.run_steps(self.stack[:1], persistent=True)
+        outcome = self.run_steps(self.stack[1:4], persistent=True, parallel=3)
+        self.assertEqual(outcome.get('error'), None)
+        self.assertEqual([r['cmd'] for r in outcome['results']], [cmd for ndx, cmd in self.stack[1:4]])
+        for result in outcome['results']:
+            self.assertEqual(self.servers(result), set(['srv1']))
+
+    def test_stops_on_error(self):
+        outcome = self.run_steps([(1.1, 'list comp'), (1.2, 'error x'), (1.3, 'list comp'), (1.4, 'list comp'),
+                                  (2.0, 'list servers')], parallel=2)
+        self.assertEqual(outcome['error'][0], 'error x')
+        self.assertNotIn('list servers', [r['cmd'] for r in outcome['results']])
+
+
+class ProfileTest(FakeSrvrmgrTest):
+
+    def test_timing_of_commands_and_phases(self):
+        phases = {}
+        outcome = srvrmgr.run_target(self.params(profile=True), [(1, 'list comp'), (2, 'set server srv1')],
+                                     srvrmgr.prepare_env(self.sieb_path), phases)
+        timing = outcome['results'][1]['timing']
+        self.assertEqual(sorted(timing), ['bytes', 'first_byte', 'queue', 'rows', 'total'])
+        self.assertEqual(timing['rows'], 3)
+        self.assertGreater(timing['bytes'], 0)
+        self.assertEqual(sorted(phases), ['commands', 'login', 'teardown'])
+
+
+class PipelineTest(FakeSrvrmgrTest):
+    stack = ['list comp', 'set server srv1', 'list servers', 'list comp', 'unset server']
+
+    def test_pipelined_results_match_sequential(self):
+        expected = self.run_stack(self.stack)
+        self.assertEqual(expected[0], None)
+        self.assertEqual(len(expected[1]), len(self.stack))
+        self.assertEqual(self.run_stack(self.stack, pipeline=3), expected)
+
+    def test_stderr_belongs_to_its_command(self):
+        stack = ['list comp', 'list comp Missing', 'list servers', 'list comp']
+        expected = self.run_stack(stack, skip_errors=['SBL-ADM-60070'])
+        for _ in range(5):
+            self.assertEqual(self.run_stack(stack, pipeline=4, skip_errors=['SBL-ADM-60070']), expected)
+            error, results = self.run_stack(stack, pipeline=4)
+            self.assertEqual(error[0], 'list comp Missing')
+            self.assertEqual([r[0] for r in results], ['list comp', 'list comp Missing'])
+
+    def test_pipeline_stops_on_error(self):
+        error, results = self.run_stack(['list comp', 'error x', 'list comp'], pipeline=3)
+        self.assertEqual(error[0], 'error x')
+        self.assertEqual([r[0] for r in results], ['list comp', 'error x'])
+
+
+class PipelineEchoTest(FakeSrvrmgrTest):
+    settings = dict(rows=3, echo=1)
+
+    def test_echoed_commands_are_detected(self):
+        error, results = self.run_stack(['list comp', 'list servers'], pipeline=2)
+        self.assertIn('set pipeline to 1', error[1])
+
+
+class ProgressTest(FakeSrvrmgrTest):
+
+    def test_finished_commands_are_appended(self):
+        progress_file = path.join(self.work_dir, 'progress.jsonl')
+        self.run_target(['list comp', 'error x'], progress_file=progress_file, profile=True)
+        with open(progress_file) as progress_f:
+            rows = [json.loads(line) for line in progress_f]
+        self.assertEqual([r['cmd'] for r in rows], ['Authorization', 'list comp', 'error x'])
+        self.assertNotIn('out', rows[1])
+        self.assertEqual(rows[1]['timing']['rows'], 3)
+        self.assertIn('SBL-ADM-01067', rows[2]['err']['parsed'][0])
+
+
+class ResumeTest(FakeSrvrmgrTest):
+
+    def test_resume_skips_completed_steps(self):
+        failed = self.run_target(['list comp', 'error x', 'list servers'], resume=True, checkpoint_key='stack')
+        self.assertEqual(failed['error'][0], 'error x')
+        resumed = self.run_target(['list comp', 'set server srv1', 'list servers'], resume=True,
+                                  checkpoint_key='stack')
+        self.assertEqual(resumed['skipped_steps'], [1])
+        self.assertEqual([r['cmd'] for r in resumed['results']],
+                         ['Authorization', 'set server srv1', 'list servers', 'quit'])
+        self.assertEqual(listdir(path.join(self.session_dir, srvrmgr.CHECKPOINT_SUBDIR)), [])
+
+    def test_session_commands_are_replayed(self):
+        failed = self.run_target(['set server srv1', 'list servers', 'error x', 'list comp'], resume=True,
+                                 checkpoint_key='stack')
+        self.assertEqual(failed['error'][0], 'error x')
+        resumed = self.run_target(['set server srv1', 'list servers', 'list servers', 'list comp'], resume=True,
+                                  checkpoint_key='stack')
+        self.assertEqual(resumed['skipped_steps'], [2])
+        self.assertEqual([r['cmd'] for r in resumed['results']],
+                         ['Authorization', 'set server srv1', 'list servers', 'list comp', 'quit'])
+        self.assertEqual(set(row['SV_NAME'] for row in resumed['results'][3]['out']['parsed']), set(['srv1']))
+
+    def test_empty_stack(self):
+        self.assertEqual(self.run_target([], resume=True), dict(results=[]))
+
+
+class TargetsTest(FakeSrvrmgrTest):
+    targets = [dict(gateway='gw1', enterprise='ent'), dict(gateway='gw2', enterprise='ent', user='sadmin')]
+
+    def run_targets(self, cmd_stack, **kwargs):
+        params = self.params(targets=self.targets, **kwargs)
+        env = None if params['persistent'] else srvrmgr.prepare_env(self.sieb_path)
+        return srvrmgr.run_targets(params, list(enumerate(cmd_stack, 1)), env)
+
+    def test_outcomes_by_target(self):
+        outcomes = self.run_targets(['list comp'], profile=True)
+        self.assertEqual(sorted(outcomes), ['gw1/ent', 'gw2/ent/sadmin'])
+        for outcome in outcomes.values():
+            self.assertEqual(outcome.get('error'), None)
+            self.assertEqual([r['cmd'] for r in outcome['results']], ['Authorization', 'list comp', 'quit'])
+            self.assertIn('login', outcome['profile'])
+
+    def test_persistent_sessions_of_targets(self):
+        outcomes = self.run_targets(['list comp'], persistent=True, target_workers=2)
+        for outcome in outcomes.values():
+            self.assertEqual(outcome.get('error'), None)
+            self.assertEqual([r['cmd'] for r in outcome['results']], ['Authorization', 'list comp'])
+        self.assertEqual(len([n for n in listdir(self.session_dir) if n.endswith('.sock')]), 2)
+
+
+class DiffParamsTest(FakeSrvrmgrTest):
+    stack = ['change param MaxTasks=100,MinMTServers=2 for comp SCBroker', 'change param MaxTasks=100 for comp EAI']
+
+    def test_only_changed_params_are_applied(self):
+        outcome = self.run_target(self.stack, diff_params=True)
+        self.assertEqual(outcome.get('error'), None)
+        self.assertTrue(outcome['changed'])
+        self.assertEqual(outcome['param_diff'], [dict(scope='comp SCBroker', param='MinMTServers', before='1',
+                                                      after='2')])
+        self.assertEqual([r['cmd'] for r in outcome['results']],
+                         ['Authorization', 'change param MinMTServers=2 for comp SCBroker', 'quit'])
+
+    def test_nothing_to_change(self):
+        outcome = self.run_target(self.stack[1:], diff_params=True)
+        self.assertFalse(outcome['changed'])
+        self.assertEqual(outcome['param_diff'], [])
+        self.assertEqual([r['cmd'] for r in outcome['results']], ['Authorization', 'quit'])
+
+    def test_check_mode_runs_queries_and_session_commands(self):
+        outcome = self.run_target(['set server srv1', 'list comp', 'shutdown comp SCBroker', 'unset server'],
+                                  check_mode=True)
+        self.assertTrue(outcome['changed'])
+        self.assertEqual(outcome['check_skipped'], ['shutdown comp SCBroker'])
+        self.assertEqual([r['cmd'] for r in outcome['results']],
+                         ['Authorization', 'set server srv1', 'list comp', 'unset server', 'quit'])
+        self.assertEqual(set(row['SV_NAME'] for row in outcome['results'][2]['out']['parsed']), set(['srv1']))
+
+    def test_check_mode_without_queries_needs_no_login(self):
+        outcome = self.run_target(['shutdown comp SCBroker'], check_mode=True)
+        self.assertEqual(outcome, dict(results=[], changed=True, check_skipped=['shutdown comp SCBroker']))
+
+
+class MaxOutputTest(FakeSrvrmgrTest):
+
+    def test_output_is_truncated_and_spooled(self):
+        outcome = self.run_target(['list comp'], max_output_bytes=200, spool_output=True)
+        out = outcome['results'][1]['out']
+        self.assertTrue(out['truncated'])
+        self.assertGreater(out['size'], 200)
+        self.assertIn('bytes truncated', out['raw'])
+        with open(out['spool']) as spool_f:
+            self.assertIn('Component number 2', spool_f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()